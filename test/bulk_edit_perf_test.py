@@ -0,0 +1,57 @@
+#!/usr/bin/python
+import versioning_base
+from pyspatialite import dbapi2
+import os
+import time
+
+tmp_dir = "/tmp"
+test_data_dir = os.path.dirname(os.path.realpath(__file__))
+
+sqlite_test_filename = tmp_dir+"/bulk_edit_perf_test.sqlite"
+
+# create the test database
+
+os.system("dropdb epanet_test_db")
+os.system("createdb epanet_test_db")
+os.system("psql epanet_test_db -c 'CREATE EXTENSION postgis'")
+os.system("psql epanet_test_db -f "+test_data_dir+"/epanet_test_db.sql")
+
+# time inserts through the view, the time per feature must not grow with
+# the number of features already in the table
+time_per_feature = {}
+for nb in [10000, 100000, 1000000]:
+    if os.path.isfile(sqlite_test_filename): os.remove(sqlite_test_filename)
+    versioning_base.checkout("dbname=epanet_test_db",
+            ["epanet_trunk_rev_head.junctions"], sqlite_test_filename)
+    scur = versioning_base.Db( dbapi2.connect( sqlite_test_filename ) )
+    # each checkout reserves its own block of ids
+    scur.execute("SELECT last_fid FROM fid_counter "
+        "WHERE table_name = 'junctions'")
+    [first] = scur.fetchone()
+    start = time.time()
+    scur.executemany("INSERT INTO junctions_view(id, elevation, GEOMETRY) "
+        "VALUES (?, ?, GeomFromText(?, 2154))",
+        ( (str(i), i, 'POINT(%d %d)'%(i, i)) for i in xrange(nb) ))
+    scur.commit()
+    time_per_feature[nb] = (time.time() - start)/nb
+    print nb, "inserts in", time.time() - start, "s"
+
+    scur.execute("SELECT COUNT(*), COUNT(DISTINCT OGC_FID), MAX(OGC_FID) "
+        "FROM junctions")
+    assert( scur.fetchone() == (nb+2, nb+2, first+nb) )
+    scur.execute("SELECT last_fid FROM fid_counter "
+        "WHERE table_name = 'junctions'")
+    assert( scur.fetchone()[0] == first+nb )
+
+    # update the old features and the new ones
+    scur.execute("UPDATE junctions_view SET elevation = -1 "
+        "WHERE OGC_FID <= 2 OR OGC_FID > "+str(first+nb-2))
+    scur.commit()
+    scur.execute("SELECT COUNT(*) FROM junctions_view WHERE elevation = -1")
+    assert( scur.fetchone()[0] == 4 )
+    scur.execute("SELECT last_fid FROM fid_counter "
+        "WHERE table_name = 'junctions'")
+    assert( scur.fetchone()[0] == first+nb+2 )
+    scur.close()
+
+assert( time_per_feature[1000000] < 3*time_per_feature[10000] )
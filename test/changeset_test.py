@@ -0,0 +1,103 @@
+#!/usr/bin/python
+import versioning_base
+from pyspatialite import dbapi2
+import psycopg2
+import os
+
+tmp_dir = "/tmp"
+test_data_dir = os.path.dirname(os.path.realpath(__file__))
+
+wc = [tmp_dir+"/changeset_test_wc0.sqlite",
+      tmp_dir+"/changeset_test_wc1.sqlite"]
+changeset = tmp_dir+"/changeset_test_commit.json.gz"
+reply = tmp_dir+"/changeset_test_update.json.gz"
+for f in wc+[changeset, reply]:
+    if os.path.isfile(f): os.remove(f)
+
+# create the test database
+
+os.system("dropdb epanet_test_db")
+os.system("createdb epanet_test_db")
+os.system("psql epanet_test_db -c 'CREATE EXTENSION postgis'")
+os.system("psql epanet_test_db -f "+test_data_dir+"/epanet_test_db.sql")
+
+tables = ['epanet_trunk_rev_head.junctions', 'epanet_trunk_rev_head.pipes']
+for f in wc:
+    versioning_base.checkout("dbname=epanet_test_db", tables, f)
+
+def set_length(f, length):
+    scur = versioning_base.Db( dbapi2.connect( f ) )
+    scur.execute("UPDATE pipes_view SET length = "+str(length))
+    scur.commit()
+    scur.close()
+
+def length(f):
+    scur = versioning_base.Db( dbapi2.connect( f ) )
+    scur.execute("SELECT length FROM pipes_view")
+    res = scur.fetchall()
+    scur.close()
+    return res
+
+pcur = versioning_base.Db( psycopg2.connect("dbname=epanet_test_db") )
+
+# the modified pipe ends and its new version begins
+set_length(wc[0], 2)
+assert( versioning_base.export_changeset(wc[0], changeset, 'offline') == 2 )
+assert( versioning_base.revision(wc[0]) == 2 )
+assert( versioning_base.apply_changeset(changeset, "dbname=epanet_test_db",
+    reply) )
+pcur.execute("SELECT rev, commit_msg FROM epanet.revisions ORDER BY rev")
+assert( pcur.fetchall() == [(1, 'initial commit'), (2, 'offline')] )
+pcur.execute("SELECT length FROM epanet_trunk_rev_head.pipes")
+assert( pcur.fetchall() == [(2,)] )
+pcur.commit()
+
+# a changeset delivered twice is committed once
+assert( versioning_base.apply_changeset(changeset, "dbname=epanet_test_db",
+    reply) )
+pcur.execute("SELECT COUNT(*) FROM epanet.revisions")
+assert( pcur.fetchone()[0] == 2 )
+pcur.commit()
+assert( 'changesets' not in
+    versioning_base.pg_versioned_tables( pcur, 'epanet' ) )
+
+# the reply moves the working copy to the committed revision
+assert( versioning_base.import_changeset(wc[0], reply) )
+assert( versioning_base.revision(wc[0]) == 3 )
+assert( versioning_base.late(wc[0], "dbname=epanet_test_db") == 0 )
+assert( versioning_base.commit(wc[0], 'nothing', "dbname=epanet_test_db")
+    == 0 )
+
+# without modifications a changeset only asks for an update
+assert( versioning_base.export_changeset(wc[1], changeset, 'none') == 0 )
+assert( not versioning_base.apply_changeset(changeset,
+    "dbname=epanet_test_db", reply) )
+assert( not versioning_base.import_changeset(wc[1], reply) )
+assert( length(wc[1]) == [(2,)] )
+assert( versioning_base.late(wc[1], "dbname=epanet_test_db") == 0 )
+
+# a late working copy is not committed, the reply brings the conflict
+set_length(wc[0], 3)
+versioning_base.commit(wc[0], 'online', "dbname=epanet_test_db")
+set_length(wc[1], 4)
+assert( versioning_base.export_changeset(wc[1], changeset, 'late') == 2 )
+assert( not versioning_base.apply_changeset(changeset,
+    "dbname=epanet_test_db", reply) )
+assert( not versioning_base.import_changeset(wc[1], reply) )
+assert( versioning_base.unresolved_conflicts(wc[1]) == ['pipes'] )
+scur = versioning_base.Db( dbapi2.connect( wc[1] ) )
+scur.execute("DELETE FROM pipes_conflicts WHERE origin = 'theirs'")
+scur.commit()
+scur.close()
+
+# the working copy must not change between the export and the reply
+assert( versioning_base.export_changeset(wc[1], changeset, 'mine') > 0 )
+set_length(wc[1], 5)
+assert( versioning_base.apply_changeset(changeset, "dbname=epanet_test_db",
+    reply) )
+try:
+    versioning_base.import_changeset(wc[1], reply)
+    assert( False )
+except RuntimeError:
+    pass
+pcur.close()
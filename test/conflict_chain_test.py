@@ -0,0 +1,77 @@
+#!/usr/bin/python
+import versioning_base
+from pyspatialite import dbapi2
+import psycopg2
+import os
+
+tmp_dir = "/tmp"
+test_data_dir = os.path.dirname(os.path.realpath(__file__))
+
+wc = [tmp_dir+"/conflict_chain_test_wc0.sqlite",
+      tmp_dir+"/conflict_chain_test_wc1.sqlite"]
+for f in wc:
+    if os.path.isfile(f): os.remove(f)
+
+# create the test database
+
+os.system("dropdb epanet_test_db")
+os.system("createdb epanet_test_db")
+os.system("psql epanet_test_db -c 'CREATE EXTENSION postgis'")
+os.system("psql epanet_test_db -f "+test_data_dir+"/epanet_test_db.sql")
+
+tables = ['epanet_trunk_rev_head.junctions', 'epanet_trunk_rev_head.pipes']
+for f in wc:
+    versioning_base.checkout("dbname=epanet_test_db", tables, f)
+versioning_base.pg_checkout("dbname=epanet_test_db", tables, "epanet_wc")
+
+# local edits in the second working copies
+scur = versioning_base.Db( dbapi2.connect( wc[1] ) )
+scur.execute("UPDATE junctions_view SET elevation = 10 WHERE id = '0'")
+scur.execute("UPDATE pipes_view SET length = 10")
+scur.commit()
+scur.close()
+pcur = versioning_base.Db( psycopg2.connect("dbname=epanet_test_db") )
+pcur.execute("UPDATE epanet_wc.junctions_view SET elevation = 10 "
+    "WHERE id = '0'")
+pcur.execute("UPDATE epanet_wc.pipes_view SET length = 10")
+pcur.commit()
+
+# long edit chains in the first one, the pipe ends up deleted
+for i in [2, 3, 4]:
+    scur = versioning_base.Db( dbapi2.connect( wc[0] ) )
+    scur.execute("UPDATE junctions_view SET elevation = "+str(i)+" "
+        "WHERE id = '0'")
+    if i < 4:
+        scur.execute("UPDATE pipes_view SET length = "+str(i))
+    else:
+        scur.execute("DELETE FROM pipes_view")
+    scur.commit()
+    scur.close()
+    versioning_base.commit(wc[0], 'edit '+str(i), "dbname=epanet_test_db")
+
+# each conflict is resolved to the last descendant of theirs
+versioning_base.update(wc[1], "dbname=epanet_test_db")
+scur = versioning_base.Db( dbapi2.connect( wc[1] ) )
+scur.execute("SELECT conflict_id, origin, action FROM junctions_conflicts "
+    "ORDER BY origin")
+assert( scur.fetchall() == [(1, u'mine', u'modified'),
+                            (1, u'theirs', u'modified')] )
+scur.execute("SELECT OGC_FID, elevation FROM junctions_conflicts "
+    "WHERE origin = 'theirs'")
+assert( scur.fetchall() == [(5, 4)] )
+scur.execute("SELECT conflict_id, origin, action, OGC_FID FROM pipes_conflicts "
+    "WHERE origin = 'theirs'")
+assert( scur.fetchall() == [(1, u'theirs', u'deleted', 3)] )
+scur.close()
+
+versioning_base.pg_update("dbname=epanet_test_db", "epanet_wc")
+pcur.execute("SELECT conflict_id, origin, action, jid "
+    "FROM epanet_wc.junctions_conflicts WHERE origin = 'theirs'")
+assert( pcur.fetchall() == [(1, 'theirs', 'modified', 5)] )
+pcur.execute("SELECT conflict_id, origin, action, pid "
+    "FROM epanet_wc.pipes_conflicts WHERE origin = 'theirs'")
+assert( pcur.fetchall() == [(1, 'theirs', 'deleted', 3)] )
+pcur.execute("SELECT COUNT(*) FROM epanet_wc.pipes_conflicts "
+    "WHERE origin = 'mine'")
+assert( pcur.fetchone()[0] == 1 )
+pcur.close()
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+import versioning_base
+from pyspatialite import dbapi2
+import psycopg2
+import os
+
+tmp_dir = "/tmp"
+test_data_dir = os.path.dirname(os.path.realpath(__file__))
+
+wc = [tmp_dir+"/diff_cache_test_wc0.sqlite",
+      tmp_dir+"/diff_cache_test_wc1.sqlite",
+      tmp_dir+"/diff_cache_test_wc2.sqlite"]
+for f in wc:
+    if os.path.isfile(f): os.remove(f)
+
+# create the test database
+
+os.system("dropdb epanet_test_db")
+os.system("createdb epanet_test_db")
+os.system("psql epanet_test_db -c 'CREATE EXTENSION postgis'")
+os.system("psql epanet_test_db -f "+test_data_dir+"/epanet_test_db.sql")
+
+versioning_base.enable_diff_cache("dbname=epanet_test_db", 'epanet')
+
+tables = ['epanet_trunk_rev_head.junctions', 'epanet_trunk_rev_head.pipes']
+for f in wc:
+    versioning_base.checkout("dbname=epanet_test_db", tables, f)
+
+scur = versioning_base.Db( dbapi2.connect( wc[0] ) )
+scur.execute("UPDATE pipes_view SET length = 2")
+scur.commit()
+scur.close()
+versioning_base.commit(wc[0], 'rev 2', "dbname=epanet_test_db")
+
+pcur = versioning_base.Db( psycopg2.connect("dbname=epanet_test_db") )
+def cached():
+    pcur.execute("SELECT cache_table, hits FROM epanet.diff_cache "
+        "ORDER BY cache_table")
+    res = pcur.fetchall()
+    pcur.commit()
+    return res
+
+# the bookkeeping table is not versioned
+assert( 'diff_cache' not in
+    versioning_base.pg_versioned_tables( pcur, 'epanet' ) )
+
+# the first update computes the diff, the second one reads it
+versioning_base.update(wc[1], "dbname=epanet_test_db")
+assert( cached() == [('epanet_diff_cache.junctions_trunk_1_to_2', 0),
+    ('epanet_diff_cache.pipes_trunk_1_to_2', 0)] )
+versioning_base.update(wc[2], "dbname=epanet_test_db")
+assert( cached() == [('epanet_diff_cache.junctions_trunk_1_to_2', 1),
+    ('epanet_diff_cache.pipes_trunk_1_to_2', 1)] )
+
+for f in wc[1:]:
+    scur = versioning_base.Db( dbapi2.connect( f ) )
+    scur.execute("SELECT length FROM pipes_view")
+    assert( scur.fetchall() == [(2,)] )
+    scur.close()
+
+# a new revision makes the cached diff stale, it is dropped by the next
+# diff put in the cache
+scur = versioning_base.Db( dbapi2.connect( wc[0] ) )
+scur.execute("UPDATE pipes_view SET length = 3")
+scur.commit()
+scur.close()
+versioning_base.commit(wc[0], 'rev 3', "dbname=epanet_test_db")
+versioning_base.update(wc[1], "dbname=epanet_test_db")
+assert( cached() == [('epanet_diff_cache.junctions_trunk_2_to_3', 0),
+    ('epanet_diff_cache.pipes_trunk_2_to_3', 0)] )
+pcur.execute("SELECT table_name FROM information_schema.tables "
+    "WHERE table_schema = 'epanet_diff_cache' ORDER BY table_name")
+assert( pcur.fetchall() == [('junctions_trunk_2_to_3',),
+    ('pipes_trunk_2_to_3',)] )
+pcur.commit()
+
+# a budget of 0 empties the cache
+assert( len(versioning_base.evict_diff_cache("dbname=epanet_test_db",
+    'epanet', 0)) == 2 )
+assert( cached() == [] )
+
+# updates still work without the cached diff
+versioning_base.update(wc[2], "dbname=epanet_test_db")
+scur = versioning_base.Db( dbapi2.connect( wc[2] ) )
+scur.execute("SELECT length FROM pipes_view")
+assert( scur.fetchall() == [(3,)] )
+scur.close()
+pcur.close()
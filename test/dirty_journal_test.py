@@ -0,0 +1,63 @@
+#!/usr/bin/python
+import versioning_base
+from pyspatialite import dbapi2
+import psycopg2
+import os
+
+tmp_dir = "/tmp"
+test_data_dir = os.path.dirname(os.path.realpath(__file__))
+
+wc = [tmp_dir+"/dirty_journal_test_wc0.sqlite",
+      tmp_dir+"/dirty_journal_test_wc1.sqlite"]
+for f in wc:
+    if os.path.isfile(f): os.remove(f)
+
+# create the test database
+
+os.system("dropdb epanet_test_db")
+os.system("createdb epanet_test_db")
+os.system("psql epanet_test_db -c 'CREATE EXTENSION postgis'")
+os.system("psql epanet_test_db -f "+test_data_dir+"/epanet_test_db.sql")
+
+tables = ['epanet_trunk_rev_head.junctions', 'epanet_trunk_rev_head.pipes']
+for f in wc:
+    versioning_base.checkout("dbname=epanet_test_db", tables, f)
+
+def journal(f, table):
+    scur = versioning_base.Db( dbapi2.connect( f ) )
+    scur.execute("SELECT OGC_FID FROM "+table+"_dirty ORDER BY OGC_FID")
+    res = [r[0] for r in scur.fetchall()]
+    scur.close()
+    return res
+
+# the modified feature and its new version are recorded
+scur = versioning_base.Db( dbapi2.connect( wc[0] ) )
+scur.execute("UPDATE pipes_view SET length = 2")
+scur.commit()
+scur.close()
+assert( journal(wc[0], 'pipes') == [1, 2] )
+assert( journal(wc[0], 'junctions') == [] )
+
+# the clean table is skipped and the journal is emptied
+assert( versioning_base.commit(wc[0], 'edit pipe', "dbname=epanet_test_db") == 1 )
+assert( journal(wc[0], 'pipes') == [] )
+
+# inserted features get an id of the block reserved at checkout, they
+# are not renumbered on update
+scur = versioning_base.Db( dbapi2.connect( wc[1] ) )
+scur.execute("SELECT last_fid FROM fid_counter WHERE table_name = 'pipes'")
+[last_fid] = scur.fetchone()
+scur.execute("INSERT INTO pipes_view(id, start_node, end_node, GEOMETRY) "
+    "VALUES ('1', '1', '2', GeomFromText('LINESTRING(0 1,1 1)',2154))")
+scur.commit()
+scur.close()
+assert( journal(wc[1], 'pipes') == [last_fid+1] )
+versioning_base.update(wc[1], "dbname=epanet_test_db")
+assert( journal(wc[1], 'pipes') == [last_fid+1] )
+
+assert( versioning_base.commit(wc[1], 'add pipe', "dbname=epanet_test_db") == 1 )
+assert( journal(wc[1], 'pipes') == [] )
+pcur = versioning_base.Db( psycopg2.connect("dbname=epanet_test_db") )
+pcur.execute("SELECT COUNT(*) FROM epanet.pipes")
+assert( pcur.fetchone()[0] == 3 )
+pcur.close()
@@ -0,0 +1,75 @@
+#!/usr/bin/python
+import versioning_base
+from pyspatialite import dbapi2
+import psycopg2
+import csv
+import os
+
+tmp_dir = "/tmp"
+test_data_dir = os.path.dirname(os.path.realpath(__file__))
+
+wc = tmp_dir+"/features_test_wc.sqlite"
+if os.path.isfile(wc): os.remove(wc)
+csv_filename = tmp_dir+"/features_test_pipes.csv"
+if os.path.isfile(csv_filename): os.remove(csv_filename)
+
+# create the test database
+
+os.system("dropdb epanet_test_db")
+os.system("createdb epanet_test_db")
+os.system("psql epanet_test_db -c 'CREATE EXTENSION postgis'")
+os.system("psql epanet_test_db -f "+test_data_dir+"/epanet_test_db.sql")
+
+tables = ['epanet_trunk_rev_head.junctions', 'epanet_trunk_rev_head.pipes']
+versioning_base.checkout("dbname=epanet_test_db", tables, wc)
+
+scur = versioning_base.Db( dbapi2.connect( wc ) )
+scur.execute("UPDATE pipes_view SET length = 2")
+scur.execute("INSERT INTO junctions_view(id, elevation, GEOMETRY) "
+    "VALUES ('2', 2, GeomFromText('POINT(2 2)',2154))")
+scur.commit()
+scur.close()
+versioning_base.commit(wc, 'rev 2', "dbname=epanet_test_db")
+
+def features(table, rev, bbox = None):
+    return list(versioning_base.features("dbname=epanet_test_db", 'epanet',
+        table, 'trunk', rev, bbox, 1))
+
+# each revision has its own state
+assert( [f['length'] for f in features('pipes', 1)] == [1] )
+assert( [f['length'] for f in features('pipes', 2)] == [2] )
+assert( [f['length'] for f in features('pipes', 'head')] == [2] )
+assert( len(features('junctions', 1)) == 2 )
+assert( len(features('junctions', 'head')) == 3 )
+
+# history columns are left out, geometries are WKB
+assert( 'trunk_rev_begin' not in features('pipes', 1)[0] )
+pcur = versioning_base.Db( psycopg2.connect("dbname=epanet_test_db") )
+pcur.execute("SELECT ST_AsText(ST_GeomFromWKB(decode('"
+    +features('pipes', 1)[0]['geom'].encode('hex')+"', 'hex')))")
+assert( pcur.fetchone()[0] == 'LINESTRING(1 0,0 1)' )
+
+# no view is created
+pcur.execute("SELECT schema_name FROM information_schema.schemata "
+    "WHERE schema_name LIKE 'epanet_trunk_rev_%' "
+    "AND schema_name != 'epanet_trunk_rev_head'")
+assert( not pcur.fetchall() )
+pcur.close()
+
+# spatial filter
+assert( [f['id'] for f in features('junctions', 'head', (1.5, 1.5, 3, 3))]
+        == ['2'] )
+
+# unknown revision
+try:
+    features('pipes', 3)
+    assert( False )
+except RuntimeError:
+    pass
+
+# export
+assert( versioning_base.export_features("dbname=epanet_test_db", 'epanet',
+    'junctions', csv_filename, 'trunk', 1) == 2 )
+rows = list(csv.reader(open(csv_filename)))
+assert( len(rows) == 3 )
+assert( 'geom' in rows[0] and 'trunk_rev_end' not in rows[0] )
@@ -0,0 +1,94 @@
+#!/usr/bin/python
+import versioning_base
+from pyspatialite import dbapi2
+import psycopg2
+import os
+
+tmp_dir = "/tmp"
+test_data_dir = os.path.dirname(os.path.realpath(__file__))
+
+wc = [tmp_dir+"/fid_block_test_wc0.sqlite",
+      tmp_dir+"/fid_block_test_wc1.sqlite"]
+changeset = tmp_dir+"/fid_block_test_commit.json.gz"
+reply = tmp_dir+"/fid_block_test_update.json.gz"
+for f in wc+[changeset, reply]:
+    if os.path.isfile(f): os.remove(f)
+
+# create the test database
+
+os.system("dropdb epanet_test_db")
+os.system("createdb epanet_test_db")
+os.system("psql epanet_test_db -c 'CREATE EXTENSION postgis'")
+os.system("psql epanet_test_db -f "+test_data_dir+"/epanet_test_db.sql")
+
+pg_conn_info = "dbname=epanet_test_db"
+os.environ['VERSIONING_FID_BLOCK'] = '4'
+
+# each working copy reserves its own block of pipe ids
+for f in wc:
+    versioning_base.checkout(pg_conn_info, ['epanet_trunk_rev_head.pipes'], f)
+
+def fid_counter(f):
+    scur = versioning_base.Db( dbapi2.connect( f ) )
+    scur.execute("SELECT last_fid, max_fid FROM fid_counter")
+    res = scur.fetchone()
+    scur.close()
+    return res
+
+def insert(f, nb):
+    scur = versioning_base.Db( dbapi2.connect( f ) )
+    for i in range(nb):
+        scur.execute("INSERT INTO pipes_view(id, start_node, end_node, "
+            "GEOMETRY) VALUES ('"+str(i)+"', '1', '2', "
+            "GeomFromText('LINESTRING(1 1,0 1)',2154))")
+    scur.commit()
+    scur.close()
+
+def pids(f):
+    scur = versioning_base.Db( dbapi2.connect( f ) )
+    scur.execute("SELECT OGC_FID FROM pipes_view ORDER BY OGC_FID")
+    res = [r[0] for r in scur.fetchall()]
+    scur.close()
+    return res
+
+def pg_pids():
+    pcur = versioning_base.Db( psycopg2.connect(pg_conn_info) )
+    pcur.execute("SELECT pid FROM epanet_trunk_rev_head.pipes ORDER BY pid")
+    res = [r[0] for r in pcur.fetchall()]
+    pcur.close()
+    return res
+
+assert( fid_counter(wc[0]) == (1, 5) )
+assert( fid_counter(wc[1]) == (5, 9) )
+
+# the first working copy overflows its block
+insert(wc[0], 6)
+insert(wc[1], 1)
+assert( pids(wc[0]) == [1, 2, 3, 4, 5, 6, 7] )
+assert( pids(wc[1]) == [1, 6] )
+
+# a commit within the block keeps the ids
+versioning_base.commit(wc[1], 'within the block', pg_conn_info)
+assert( pg_pids() == [1, 6] )
+
+# the features inserted above the block are renumbered on update, the
+# others keep their id
+versioning_base.update(wc[0], pg_conn_info)
+assert( pids(wc[0]) == [1, 2, 3, 4, 5, 6, 10, 11] )
+assert( fid_counter(wc[0]) == (11, 15) )
+versioning_base.commit(wc[0], 'refilled', pg_conn_info)
+assert( pg_pids() == [1, 2, 3, 4, 5, 6, 10, 11] )
+
+# no renumbering of the features of others either
+versioning_base.update(wc[1], pg_conn_info)
+assert( pids(wc[1]) == pg_pids() )
+
+# offline, the new block comes with the reply of the changeset
+insert(wc[1], 5)
+assert( fid_counter(wc[1]) == (13, 9) )
+versioning_base.export_changeset(wc[1], changeset, 'offline')
+assert( versioning_base.apply_changeset(changeset, pg_conn_info, reply) )
+assert( versioning_base.import_changeset(wc[1], reply) )
+assert( pg_pids() == [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 16, 17] )
+assert( pids(wc[1]) == pg_pids() )
+assert( fid_counter(wc[1]) == (17, 21) )
@@ -0,0 +1,82 @@
+#!/usr/bin/python
+import versioning_base
+from pyspatialite import dbapi2
+import psycopg2
+import os
+
+test_data_dir = os.path.dirname(os.path.realpath(__file__))
+tmp_dir = "/tmp"
+
+# create the test database
+
+os.system("dropdb epanet_test_db")
+os.system("createdb epanet_test_db")
+os.system("psql epanet_test_db -c 'CREATE EXTENSION postgis'")
+
+pg_conn_info = "dbname=epanet_test_db"
+pcur = versioning_base.Db(psycopg2.connect(pg_conn_info))
+pcur.execute("CREATE SCHEMA epanet")
+pcur.execute("""
+    CREATE TABLE epanet.pipes (
+        hid serial PRIMARY KEY,
+        id varchar,
+        start_node varchar,
+        end_node varchar,
+        geometry geometry('LINESTRINGZ',2154)
+    )""")
+
+pcur.execute("""
+    INSERT INTO epanet.pipes
+        (id, start_node, end_node, geometry)
+        VALUES
+        ('0','0','1',ST_GeometryFromText('LINESTRING Z(1 0 5,0 1 6)',2154))""")
+pcur.commit()
+pcur.close()
+
+versioning_base.historize( pg_conn_info, 'epanet' )
+
+wc = [tmp_dir+'/wc0_geometry_3d_test.sqlite',
+      tmp_dir+'/wc1_geometry_3d_test.sqlite']
+for f in wc:
+    if os.path.isfile(f): os.remove(f)
+    versioning_base.checkout( pg_conn_info,
+            ['epanet_trunk_rev_head.pipes'], f )
+
+versioning_base.pg_checkout( pg_conn_info,
+        ['epanet_trunk_rev_head.pipes'], 'epanet_working_copy' )
+
+def sp_z(f):
+    scur = versioning_base.Db( dbapi2.connect(f) )
+    scur.execute("SELECT Z(StartPoint(GEOMETRY)) FROM pipes_view")
+    res = sorted([r[0] for r in scur.fetchall()])
+    scur.close()
+    return res
+
+def pg_z(table):
+    pcur = versioning_base.Db(psycopg2.connect(pg_conn_info))
+    pcur.execute("SELECT ST_Z(ST_StartPoint(geometry)) FROM "+table)
+    res = sorted([r[0] for r in pcur.fetchall()])
+    pcur.close()
+    return res
+
+# the working copies keep the third dimension
+assert( sp_z(wc[0]) == [5] )
+assert( pg_z('epanet_working_copy.pipes_view') == [5] )
+
+scur = versioning_base.Db( dbapi2.connect(wc[0]) )
+scur.execute("UPDATE pipes_view "
+    "SET GEOMETRY = GeomFromText('LINESTRINGZ(1 0 7,0 1 8)',2154)")
+scur.execute("INSERT INTO pipes_view(id, start_node, end_node, GEOMETRY) "
+    "VALUES ('1', '1', '2', "
+    "GeomFromText('LINESTRINGZ(1 1 9,0 1 10)',2154))")
+scur.commit()
+scur.close()
+versioning_base.commit( wc[0], '3d edit', pg_conn_info )
+assert( pg_z('epanet_trunk_rev_head.pipes') == [7, 9] )
+
+# and the updates too
+versioning_base.update( wc[1], pg_conn_info )
+assert( sp_z(wc[1]) == [7, 9] )
+
+versioning_base.pg_update( pg_conn_info, 'epanet_working_copy' )
+assert( pg_z('epanet_working_copy.pipes_view') == [7, 9] )
@@ -0,0 +1,53 @@
+#!/usr/bin/python
+import versioning_base
+import psycopg2
+import os
+
+test_data_dir = os.path.dirname(os.path.realpath(__file__))
+
+# create the test database
+
+os.system("dropdb epanet_test_db")
+os.system("createdb epanet_test_db")
+os.system("psql epanet_test_db -c 'CREATE EXTENSION postgis'")
+os.system("psql epanet_test_db -f "+test_data_dir+"/epanet_test_db_unversioned.sql")
+
+pg_conn_info = "dbname=epanet_test_db"
+
+def indexes():
+    pcur = versioning_base.Db(psycopg2.connect(pg_conn_info))
+    pcur.execute("SELECT indexname FROM pg_indexes "
+        "WHERE schemaname = 'epanet' AND indexname LIKE '%_idx'")
+    res = [r[0] for r in pcur.fetchall()]
+    pcur.close()
+    return res
+
+versioning_base.historize( pg_conn_info, 'epanet' )
+idx = indexes()
+assert( 'revisions_branch_rev_idx' in idx )
+for table in ['junctions', 'pipes']:
+    for col in ['rev_begin', 'rev_end', 'parent', 'child', 'live', 'live_geom']:
+        assert( table+'_trunk_'+col+'_idx' in idx )
+
+versioning_base.add_branch( pg_conn_info, 'epanet', 'mybranch', 'test msg' )
+idx = indexes()
+assert( 'pipes_mybranch_live_geom_idx' in idx )
+assert( len(idx) == 1 + 2*2*6 )
+
+# the head view uses the partial index
+pcur = versioning_base.Db(psycopg2.connect(pg_conn_info))
+pcur.execute("SET enable_seqscan = off")
+pcur.execute("EXPLAIN SELECT * FROM epanet_trunk_rev_head.pipes")
+assert( str(pcur.fetchall()).find('pipes_trunk_live') != -1 )
+pcur.close()
+
+# retrofit on a schema versionned without indexes
+os.system("dropdb epanet_test_db")
+os.system("createdb epanet_test_db")
+os.system("psql epanet_test_db -c 'CREATE EXTENSION postgis'")
+os.system("psql epanet_test_db -f "+test_data_dir+"/epanet_test_db.sql")
+assert( not indexes() )
+versioning_base.add_history_indexes( pg_conn_info, 'epanet' )
+assert( len(indexes()) == 1 + 2*6 )
+versioning_base.add_history_indexes( pg_conn_info, 'epanet' )
+assert( len(indexes()) == 1 + 2*6 )
@@ -79,7 +79,7 @@ print '################'
 for r in scur[1].fetchall():
     print r
 
-scur[1].execute("DELETE FROM pipes_conflicts WHERE origin='mine' AND OGC_FID = 11")
+scur[1].execute("DELETE FROM pipes_conflicts WHERE origin='mine' AND conflict_id = 2")
 scur[1].execute("DELETE FROM pipes_conflicts WHERE origin='theirs'")
 scur[1].commit()
 scur[1].execute("SELECT conflict_id FROM pipes_conflicts")
@@ -0,0 +1,44 @@
+#!/usr/bin/python
+import versioning_base
+from pyspatialite import dbapi2
+import psycopg2
+import os
+
+tmp_dir = "/tmp"
+test_data_dir = os.path.dirname(os.path.realpath(__file__))
+
+sqlite_test_filename = tmp_dir+"/iterate_test.sqlite"
+if os.path.isfile(sqlite_test_filename): os.remove(sqlite_test_filename)
+
+# create the test database
+
+os.system("dropdb epanet_test_db")
+os.system("createdb epanet_test_db")
+os.system("psql epanet_test_db -c 'CREATE EXTENSION postgis'")
+os.system("psql epanet_test_db -f "+test_data_dir+"/epanet_test_db.sql")
+
+# rows are fetched by batches from a server side cursor
+pcur = versioning_base.Db( psycopg2.connect("dbname=epanet_test_db") )
+rows = []
+for [i] in pcur.iterate("SELECT generate_series(1, 10)", 3):
+    # other commands can run meanwhile
+    pcur.execute("SELECT "+str(i)+" * 2")
+    rows.append(pcur.fetchone()[0])
+assert( rows == range(2, 21, 2) )
+pcur.execute("SELECT COUNT(*) FROM pg_cursors")
+assert( pcur.fetchone()[0] == 0 )
+
+# nested iterations use distinct cursors
+pairs = [(i, j) for [i] in pcur.iterate("SELECT generate_series(1, 3)")
+        for [j] in pcur.iterate("SELECT generate_series(1, 2)")]
+assert( len(pairs) == 6 )
+pcur.close()
+
+scur = versioning_base.Db( dbapi2.connect( sqlite_test_filename ) )
+scur.execute("CREATE TABLE t (i INTEGER)")
+scur.executemany("INSERT INTO t VALUES (?)", [(i,) for i in range(10)])
+assert( [i for [i] in scur.iterate("SELECT i FROM t ORDER BY i", 4)]
+        == range(10) )
+scur.close()
+
+assert( versioning_base.revisions("dbname=epanet_test_db", 'epanet') == [1] )
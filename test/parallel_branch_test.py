@@ -0,0 +1,73 @@
+#!/usr/bin/python
+import versioning_base
+from pyspatialite import dbapi2
+import psycopg2
+import os
+
+tmp_dir = "/tmp"
+test_data_dir = os.path.dirname(os.path.realpath(__file__))
+
+wc = tmp_dir+"/parallel_branch_test_wc.sqlite"
+if os.path.isfile(wc): os.remove(wc)
+
+# create the test database
+
+os.system("dropdb epanet_test_db")
+os.system("createdb epanet_test_db")
+os.system("psql epanet_test_db -c 'CREATE EXTENSION postgis'")
+os.system("psql epanet_test_db -f "+test_data_dir+"/epanet_test_db.sql")
+
+pcur = versioning_base.Db( psycopg2.connect("dbname=epanet_test_db") )
+
+def branch_state(branch):
+    pcur.execute("SELECT COUNT(*) FROM epanet_"+branch+"_rev_head.junctions")
+    junctions = pcur.fetchone()
+    pcur.execute("SELECT COUNT(*) FROM epanet_"+branch+"_rev_head.pipes")
+    pipes = pcur.fetchone()
+    pcur.execute("SELECT conname, convalidated FROM pg_constraint "
+        "WHERE conrelid IN ('epanet.junctions'::regclass, "
+            "'epanet.pipes'::regclass) "
+        "AND conname LIKE '%\\_"+branch+"\\_%' ORDER BY conname")
+    constraints = [ (name.replace(branch, 'branch'), valid)
+            for [name, valid] in pcur.fetchall() ]
+    pcur.commit()
+    return [junctions, pipes, constraints]
+
+# the per table timings are returned
+timings = versioning_base.add_branch("dbname=epanet_test_db", 'epanet',
+        'parallel', 'parallel branch', jobs = 2)
+assert( sorted([table for [table, seconds] in timings])
+        == ['junctions', 'pipes'] )
+versioning_base.add_branch("dbname=epanet_test_db", 'epanet',
+        'serial', 'serial branch')
+
+# both give the same branch, with validated foreign keys
+assert( branch_state('parallel') == branch_state('serial') )
+assert( len(branch_state('parallel')[2]) == 8 )
+assert( sorted(versioning_base.pg_branches( pcur, 'epanet' ))
+        == ['parallel', 'serial', 'trunk'] )
+
+# with a session, the jobs are capped to its pool
+session = versioning_base.Session("dbname=epanet_test_db", 3)
+versioning_base.add_branch(session, 'epanet', 'pooled', 'pooled branch',
+        jobs = 2)
+session.close()
+assert( branch_state('pooled') == branch_state('serial') )
+session = versioning_base.Session("dbname=epanet_test_db")
+versioning_base.add_branch(session, 'epanet', 'capped', 'capped branch',
+        jobs = 4)
+session.close()
+assert( branch_state('capped') == branch_state('serial') )
+
+# the branch can be checked out and committed to
+versioning_base.checkout("dbname=epanet_test_db",
+        ['epanet_parallel_rev_head.pipes'], wc)
+scur = versioning_base.Db( dbapi2.connect( wc ) )
+scur.execute("UPDATE pipes_view SET length = 4")
+scur.commit()
+scur.close()
+assert( versioning_base.commit(wc, 'on parallel', "dbname=epanet_test_db")
+        == 1 )
+pcur.execute("SELECT length FROM epanet_parallel_rev_head.pipes")
+assert( pcur.fetchall() == [(4,)] )
+pcur.close()
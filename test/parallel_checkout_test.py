@@ -0,0 +1,83 @@
+#!/usr/bin/python
+import versioning_base
+from pyspatialite import dbapi2
+import os
+import threading
+
+tmp_dir = "/tmp"
+test_data_dir = os.path.dirname(os.path.realpath(__file__))
+
+wc = [tmp_dir+"/parallel_checkout_test_wc0.sqlite",
+      tmp_dir+"/parallel_checkout_test_wc1.sqlite"]
+for f in wc:
+    if os.path.isfile(f): os.remove(f)
+
+# create the test database
+
+os.system("dropdb epanet_test_db")
+os.system("createdb epanet_test_db")
+os.system("psql epanet_test_db -c 'CREATE EXTENSION postgis'")
+os.system("psql epanet_test_db -f "+test_data_dir+"/epanet_test_db.sql")
+
+tables = ['epanet_trunk_rev_head.junctions', 'epanet_trunk_rev_head.pipes']
+
+# sequential and parallel checkout must give the same working copy
+versioning_base.checkout("dbname=epanet_test_db", tables, wc[0])
+versioning_base.checkout("dbname=epanet_test_db", tables, wc[1], 2)
+
+def content(filename):
+    scur = versioning_base.Db( dbapi2.connect( filename ) )
+    res = {}
+    for table in ['junctions', 'pipes', 'initial_revision']:
+        scur.execute("SELECT * FROM "+table+" ORDER BY 1, 2, 3")
+        res[table] = scur.fetchall()
+    scur.execute("SELECT COUNT(*) FROM idx_pipes_GEOMETRY")
+    [res['idx']] = scur.fetchone()
+    scur.close()
+    return res
+
+ref = content(wc[0])
+assert( len(ref['junctions']) == 2 )
+assert( len(ref['pipes']) == 1 )
+assert( ref['idx'] == 1 )
+assert( content(wc[1]) == ref )
+
+# the parallel working copy is usable
+scur = versioning_base.Db( dbapi2.connect( wc[1] ) )
+scur.execute("UPDATE pipes_view SET length = 4")
+scur.commit()
+scur.close()
+assert( versioning_base.commit(wc[1], 'parallel', "dbname=epanet_test_db") == 1 )
+
+# a session must provide a connection per job plus the coordinator
+session = versioning_base.Session("dbname=epanet_test_db", 3)
+os.remove(wc[1])
+versioning_base.checkout(session, tables, wc[1], 2)
+session.close()
+
+# the jobs are capped to the size of the pool
+session = versioning_base.Session("dbname=epanet_test_db")
+os.remove(wc[1])
+versioning_base.checkout(session, tables, wc[1], 4)
+session.close()
+assert( content(wc[1])['pipes'] == content(wc[0])['pipes'] )
+
+# a spatialite error ends the workers before it is raised
+pcur = versioning_base.pg_connect("dbname=epanet_test_db")
+scur = versioning_base.Db( dbapi2.connect( ':memory:' ) )
+scur.execute("CREATE TABLE pipes (OGC_FID INTEGER PRIMARY KEY, id TEXT)")
+mapping = versioning_base.sp_pg_columns( scur, 'pipes', 'pid', None,
+        versioning_base.pg_columns( pcur, 'epanet', 'pipes' ) )
+statements = versioning_base.pg_to_sp_statements( pcur, 'epanet.pipes',
+        None, 'pipes', mapping, None )
+scur.execute("DROP TABLE pipes")
+try:
+    versioning_base.pg_to_sp_parallel( "dbname=epanet_test_db", None,
+        [('epanet.pipes', statements)]*8, scur, 2 )
+    assert( False )
+except dbapi2.OperationalError:
+    pass
+assert( [t for t in threading.enumerate()
+    if t is not threading.current_thread()] == [] )
+scur.close()
+pcur.close()
@@ -0,0 +1,84 @@
+#!/usr/bin/python
+import versioning_base
+from pyspatialite import dbapi2
+import psycopg2
+import os
+
+tmp_dir = "/tmp"
+test_data_dir = os.path.dirname(os.path.realpath(__file__))
+
+wc = [tmp_dir+"/partial_checkout_test_wc0.sqlite",
+      tmp_dir+"/partial_checkout_test_wc1.sqlite"]
+for f in wc:
+    if os.path.isfile(f): os.remove(f)
+
+# create the test database
+
+os.system("dropdb epanet_test_db")
+os.system("createdb epanet_test_db")
+os.system("psql epanet_test_db -c 'CREATE EXTENSION postgis'")
+os.system("psql epanet_test_db -f "+test_data_dir+"/epanet_test_db.sql")
+
+tables = ['epanet_trunk_rev_head.junctions', 'epanet_trunk_rev_head.pipes']
+
+# full working copy and a partial one around junction '0'
+versioning_base.checkout("dbname=epanet_test_db", tables, wc[0])
+versioning_base.checkout("dbname=epanet_test_db", tables, wc[1],
+        extent = (0.5, -0.5, 1.5, 0.5),
+        filters = {'epanet_trunk_rev_head.pipes': "diameter > 2"})
+
+scur = versioning_base.Db( dbapi2.connect( wc[1] ) )
+scur.execute("SELECT id FROM junctions_view")
+assert( scur.fetchall() == [(u'0',)] )
+scur.execute("SELECT COUNT(*) FROM pipes_view")
+assert( scur.fetchone()[0] == 0 )
+scur.execute("SELECT selection FROM initial_revision "
+    "WHERE table_name = 'pipes'")
+assert( scur.fetchone()[0].find('diameter > 2') != -1 )
+scur.close()
+
+# edit both junctions in the full working copy
+scur = versioning_base.Db( dbapi2.connect( wc[0] ) )
+scur.execute("UPDATE junctions_view SET elevation = 10")
+scur.execute("UPDATE pipes_view SET diameter = 3")
+scur.commit()
+scur.close()
+versioning_base.commit(wc[0], 'edit all', "dbname=epanet_test_db")
+
+# only the selected features are pulled by the update, pipe 1 now
+# matches the filter
+versioning_base.update(wc[1], "dbname=epanet_test_db")
+scur = versioning_base.Db( dbapi2.connect( wc[1] ) )
+scur.execute("SELECT OGC_FID FROM junctions_diff ORDER BY OGC_FID")
+assert( scur.fetchall() == [(1,), (3,)] )
+scur.execute("SELECT id, elevation FROM junctions_view")
+assert( scur.fetchall() == [(u'0', 10)] )
+scur.execute("SELECT COUNT(*) FROM pipes_view")
+assert( scur.fetchone()[0] == 1 )
+
+# the child of a local feature is pulled even if it leaves the extent
+scur.execute("UPDATE junctions_view "
+    "SET GEOMETRY = GeomFromText('POINT(2 0)', 2154)")
+scur.commit()
+scur.close()
+versioning_base.commit(wc[1], 'move away', "dbname=epanet_test_db")
+versioning_base.update(wc[0], "dbname=epanet_test_db")
+scur = versioning_base.Db( dbapi2.connect( wc[0] ) )
+scur.execute("UPDATE junctions_view SET elevation = 20 "
+    "WHERE X(GEOMETRY) = 2")
+scur.commit()
+scur.close()
+versioning_base.commit(wc[0], 'edit moved', "dbname=epanet_test_db")
+versioning_base.update(wc[1], "dbname=epanet_test_db")
+scur = versioning_base.Db( dbapi2.connect( wc[1] ) )
+scur.execute("SELECT id, elevation FROM junctions_view")
+assert( scur.fetchall() == [(u'0', 20)] )
+scur.close()
+
+# partial postgres working copy
+versioning_base.pg_checkout("dbname=epanet_test_db", tables,
+        "epanet_partial_wc", extent = 'POLYGON((-1 0.5,0.5 0.5,0.5 2,-1 2,-1 0.5))')
+pcur = versioning_base.Db( psycopg2.connect("dbname=epanet_test_db") )
+pcur.execute("SELECT id FROM epanet_partial_wc.junctions_view")
+assert( pcur.fetchall() == [('1',)] )
+pcur.close()
@@ -0,0 +1,69 @@
+#!/usr/bin/python
+import versioning_base
+from pyspatialite import dbapi2
+import psycopg2
+import os
+
+tmp_dir = "/tmp"
+test_data_dir = os.path.dirname(os.path.realpath(__file__))
+
+wc = tmp_dir+"/partition_function_test_wc.sqlite"
+if os.path.isfile(wc): os.remove(wc)
+
+# create the test database
+
+os.system("dropdb epanet_test_db")
+os.system("createdb epanet_test_db")
+os.system("psql epanet_test_db -c 'CREATE EXTENSION postgis'")
+os.system("psql epanet_test_db -f "+test_data_dir+"/epanet_test_db_unversioned.sql")
+
+pg_conn_info = "dbname=epanet_test_db"
+pcur = versioning_base.Db( psycopg2.connect(pg_conn_info) )
+pcur.execute("SHOW server_version_num")
+if int(pcur.fetchone()[0]) < 110000:
+    print "partitioning requires PostgreSQL 11, skipping"
+    exit(0)
+pcur.close()
+
+# historized with the server function, commits go through it
+versioning_base.historize(pg_conn_info, 'epanet')
+versioning_base.partition_history(pg_conn_info, 'epanet')
+
+pcur = versioning_base.Db( psycopg2.connect(pg_conn_info) )
+assert( versioning_base.pg_has_function( pcur, 'epanet',
+    'versioning_apply_diff' ) )
+def partitions(table):
+    res = []
+    for part in ['live', 'history']:
+        pcur.execute("SELECT COUNT(*) FROM epanet_partitions."+table+"_"+part)
+        res.append(pcur.fetchone()[0])
+    pcur.commit()
+    return res
+
+tables = ['epanet_trunk_rev_head.junctions', 'epanet_trunk_rev_head.pipes']
+versioning_base.checkout(pg_conn_info, tables, wc)
+
+# the partitioning column is left to the server
+scur = versioning_base.Db( dbapi2.connect( wc ) )
+scur.execute("PRAGMA table_info(pipes)")
+assert( 'versioning_live' not in [col[1] for col in scur.fetchall()] )
+
+scur.execute("UPDATE pipes_view SET length = 2")
+scur.execute("INSERT INTO pipes_view(id, start_node, end_node, GEOMETRY) "
+    "VALUES ('1', '1', '2', GeomFromText('LINESTRING(1 1,0 1)',2154))")
+scur.commit()
+scur.close()
+assert( versioning_base.commit(wc, 'rev 2', pg_conn_info) == 1 )
+assert( partitions('pipes') == [2, 1] )
+pcur.execute("SELECT id, length FROM epanet_trunk_rev_head.pipes ORDER BY id")
+assert( pcur.fetchall() == [('0', 2), ('1', None)] )
+
+# and so do postgres working copies
+versioning_base.pg_checkout(pg_conn_info, tables, 'epanet_working_copy')
+pcur.execute("INSERT INTO epanet_working_copy.pipes_view"
+    "(id, start_node, end_node, geom) "
+    "VALUES ('2', '1', '2', ST_GeometryFromText('LINESTRING(1 2,0 1)',2154))")
+pcur.commit()
+versioning_base.pg_commit(pg_conn_info, 'epanet_working_copy', 'rev 3')
+assert( partitions('pipes') == [3, 1] )
+pcur.close()
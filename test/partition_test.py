@@ -0,0 +1,95 @@
+#!/usr/bin/python
+import versioning_base
+from pyspatialite import dbapi2
+import psycopg2
+import os
+
+tmp_dir = "/tmp"
+test_data_dir = os.path.dirname(os.path.realpath(__file__))
+
+wc = [tmp_dir+"/partition_test_wc0.sqlite", tmp_dir+"/partition_test_wc1.sqlite"]
+for f in wc:
+    if os.path.isfile(f): os.remove(f)
+
+# create the test database
+
+os.system("dropdb epanet_test_db")
+os.system("createdb epanet_test_db")
+os.system("psql epanet_test_db -c 'CREATE EXTENSION postgis'")
+os.system("psql epanet_test_db -f "+test_data_dir+"/epanet_test_db.sql")
+
+pcur = versioning_base.Db( psycopg2.connect("dbname=epanet_test_db") )
+pcur.execute("SHOW server_version_num")
+if int(pcur.fetchone()[0]) < 110000:
+    print "partitioning requires PostgreSQL 11, skipping"
+    exit(0)
+# the table keeps what it had besides its columns
+pcur.execute("ALTER TABLE epanet.pipes ADD CHECK (length >= 0)")
+pcur.execute("CREATE INDEX pipes_id_idx ON epanet.pipes (id)")
+pcur.execute("COMMENT ON TABLE epanet.pipes IS 'the pipes'")
+pcur.execute("GRANT SELECT ON epanet.pipes TO PUBLIC")
+pcur.commit()
+pcur.close()
+
+versioning_base.partition_history("dbname=epanet_test_db", 'epanet')
+
+pcur = versioning_base.Db( psycopg2.connect("dbname=epanet_test_db") )
+def partitions(table):
+    res = []
+    for part in ['live', 'history']:
+        pcur.execute("SELECT COUNT(*) FROM epanet_partitions."+table+"_"+part)
+        res.append(pcur.fetchone()[0])
+    pcur.commit()
+    return res
+
+pcur.execute("SELECT relkind FROM pg_class "
+    "WHERE oid = 'epanet.pipes'::regclass")
+assert( pcur.fetchone()[0] == 'p' )
+assert( partitions('pipes') == [1, 0] )
+assert( versioning_base.pg_pk( pcur, 'epanet', 'pipes' ) == 'pid' )
+assert( versioning_base.pg_versioned_tables( pcur, 'epanet' )
+        == ['junctions', 'pipes'] )
+pcur.execute("SELECT obj_description('epanet.pipes'::regclass, 'pg_class'), "
+    "has_table_privilege('public', 'epanet.pipes', 'SELECT')")
+assert( pcur.fetchone() == ('the pipes', True) )
+pcur.execute("SELECT COUNT(*) FROM pg_constraint "
+    "WHERE conrelid = 'epanet.pipes'::regclass AND contype = 'c'")
+assert( pcur.fetchone()[0] == 1 )
+pcur.execute("SELECT COUNT(*) FROM pg_indexes "
+    "WHERE schemaname = 'epanet' AND indexname = 'pipes_id_idx'")
+assert( pcur.fetchone()[0] == 1 )
+
+# the head view only reads the live partition
+pcur.execute("EXPLAIN SELECT * FROM epanet_trunk_rev_head.pipes")
+plan = '\n'.join([line for [line] in pcur.fetchall()])
+assert( 'pipes_live' in plan and 'pipes_history' not in plan )
+pcur.commit()
+
+# commits move the superseded rows to the historical partition
+tables = ['epanet_trunk_rev_head.junctions', 'epanet_trunk_rev_head.pipes']
+for f in wc:
+    versioning_base.checkout("dbname=epanet_test_db", tables, f)
+scur = versioning_base.Db( dbapi2.connect( wc[0] ) )
+scur.execute("UPDATE pipes_view SET length = 2")
+scur.commit()
+scur.close()
+assert( versioning_base.commit(wc[0], 'rev 2', "dbname=epanet_test_db") == 1 )
+assert( partitions('pipes') == [1, 1] )
+pcur.execute("SELECT length FROM epanet_trunk_rev_head.pipes")
+assert( pcur.fetchall() == [(2,)] )
+pcur.commit()
+
+# other working copies are updated as usual
+versioning_base.update(wc[1], "dbname=epanet_test_db")
+scur = versioning_base.Db( dbapi2.connect( wc[1] ) )
+scur.execute("SELECT length FROM pipes_view")
+assert( scur.fetchall() == [(2,)] )
+scur.close()
+
+# branches of partitioned tables
+versioning_base.add_branch("dbname=epanet_test_db", 'epanet', 'mybranch',
+    'branch')
+assert( partitions('pipes') == [1, 1] )
+pcur.execute("SELECT length FROM epanet_mybranch_rev_head.pipes")
+assert( pcur.fetchall() == [(2,)] )
+pcur.close()
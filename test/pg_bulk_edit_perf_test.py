@@ -0,0 +1,80 @@
+#!/usr/bin/python
+import versioning_base
+import psycopg2
+import os
+import time
+
+test_data_dir = os.path.dirname(os.path.realpath(__file__))
+
+# create the test database
+
+os.system("dropdb epanet_test_db")
+os.system("createdb epanet_test_db")
+os.system("psql epanet_test_db -c 'CREATE EXTENSION postgis'")
+os.system("psql epanet_test_db -f "+test_data_dir+"/epanet_test_db.sql")
+
+pg_conn_info = "dbname=epanet_test_db"
+pcur = versioning_base.Db(psycopg2.connect(pg_conn_info))
+
+# time edits of all the features through the view of a postgres working
+# copy, the time per feature must not grow with the number of features
+time_per_feature = {}
+total = 2
+for nb in [20000, 200000]:
+    pcur.execute("INSERT INTO epanet.junctions "
+        "(id, elevation, geom, trunk_rev_begin) "
+        "SELECT i::varchar, i, ST_SetSRID(ST_MakePoint(i, i), 2154), 1 "
+        "FROM generate_series(1, "+str(nb-total)+") AS i")
+    pcur.execute("ANALYZE epanet.junctions")
+    pcur.commit()
+    total = nb
+    wcs = "epanet_wc_"+str(nb)
+    versioning_base.pg_checkout(pg_conn_info,
+            ['epanet_trunk_rev_head.junctions'], wcs)
+    pcur.execute("SELECT MAX(jid) FROM epanet.junctions")
+    [max_pk] = pcur.fetchone()
+
+    start = time.time()
+    pcur.execute("UPDATE "+wcs+".junctions_view SET elevation = -1")
+    pcur.commit()
+    time_per_feature[nb] = (time.time() - start)/nb
+    print nb, "updates in", time.time() - start, "s"
+
+    # each feature has a copy ended in the diff and a child with a new id
+    pcur.execute("SELECT COUNT(*), COUNT(trunk_child), "
+        "MIN(trunk_child), MAX(trunk_child) "
+        "FROM "+wcs+".junctions_diff WHERE trunk_rev_end = 1")
+    assert( pcur.fetchone() == (nb, nb, max_pk+1, max_pk+nb) )
+    pcur.execute("SELECT COUNT(*), COUNT(DISTINCT jid) "
+        "FROM "+wcs+".junctions_view WHERE elevation = -1")
+    assert( pcur.fetchone() == (nb, nb) )
+
+    # children are updated in place
+    pcur.execute("UPDATE "+wcs+".junctions_view SET elevation = -2")
+    pcur.commit()
+    pcur.execute("SELECT COUNT(*) FROM "+wcs+".junctions_diff")
+    assert( pcur.fetchone()[0] == 2*nb )
+
+    # inserts get consecutive ids after the children
+    pcur.execute("INSERT INTO "+wcs+".junctions_view(id, elevation, geom) "
+        "SELECT 'new', i, ST_SetSRID(ST_MakePoint(i, -i), 2154) "
+        "FROM generate_series(1, 10) AS i")
+    pcur.commit()
+    pcur.execute("SELECT MIN(jid), MAX(jid) FROM "+wcs+".junctions_view "
+        "WHERE id = 'new'")
+    assert( pcur.fetchone() == (max_pk+nb+1, max_pk+nb+10) )
+
+    # deleted children leave their parent ended, new features disappear
+    pcur.execute("DELETE FROM "+wcs+".junctions_view "
+        "WHERE elevation = -2 AND jid <= "+str(max_pk+5)+" OR id = 'new'")
+    pcur.commit()
+    pcur.execute("SELECT COUNT(*) FROM "+wcs+".junctions_view")
+    assert( pcur.fetchone()[0] == nb-5 )
+    pcur.execute("SELECT COUNT(*) FROM "+wcs+".junctions_diff "
+        "WHERE trunk_rev_end = 1 AND trunk_child IS NULL")
+    assert( pcur.fetchone()[0] == 5 )
+    pcur.execute("SELECT COUNT(*) FROM "+wcs+".junctions_edits")
+    assert( pcur.fetchone()[0] == 0 )
+
+pcur.close()
+assert( time_per_feature[200000] < 3*time_per_feature[20000] )
@@ -0,0 +1,64 @@
+#!/usr/bin/python
+import versioning_base
+import psycopg2
+import os
+
+test_data_dir = os.path.dirname(os.path.realpath(__file__))
+
+# create the test database
+
+os.system("dropdb epanet_test_db")
+os.system("createdb epanet_test_db")
+os.system("psql epanet_test_db -c 'CREATE EXTENSION postgis'")
+os.system("psql epanet_test_db -f "+test_data_dir+"/epanet_test_db.sql")
+
+pg_conn_info = "dbname=epanet_test_db"
+tables = ['epanet_trunk_rev_head.junctions', 'epanet_trunk_rev_head.pipes']
+for wcs in ['wc1', 'wc2']:
+    versioning_base.pg_checkout(pg_conn_info, tables, wcs)
+
+pcur = versioning_base.Db(psycopg2.connect(pg_conn_info))
+
+# working copies only bind their views to the functions of the schema
+pcur.execute("SELECT n.nspname, COUNT(*) FROM pg_proc AS p "
+    "JOIN pg_namespace AS n ON n.oid = p.pronamespace "
+    "WHERE n.nspname IN ('wc1', 'wc2', 'epanet') "
+    "AND p.prorettype = 'trigger'::regtype GROUP BY n.nspname")
+assert( pcur.fetchall() == [('epanet', 2)] )
+pcur.execute("SELECT working_copy, table_name "
+    "FROM epanet.working_copy_edits ORDER BY 1, 2")
+assert( pcur.fetchall() == [('wc1', 'junctions'), ('wc1', 'pipes'),
+    ('wc2', 'junctions'), ('wc2', 'pipes')] )
+assert( 'working_copy_edits' not in
+        versioning_base.pg_versioned_tables( pcur, 'epanet' ) )
+
+# the same functions edit each working copy
+pcur.execute("INSERT INTO wc1.pipes_view(id, start_node, end_node, geom) "
+    "VALUES ('2', '1', '2', ST_GeometryFromText('LINESTRING(1 1,0 1)',2154))")
+pcur.execute("UPDATE wc2.pipes_view SET length = 4 WHERE pid = 1")
+pcur.execute("DELETE FROM wc2.junctions_view WHERE jid = 2")
+pcur.commit()
+
+pcur.execute("SELECT pid, trunk_rev_begin, trunk_parent FROM wc1.pipes_diff")
+assert( pcur.fetchall() == [(2, 2, None)] )
+# the ids are reserved from the sequence, whatever the working copy
+pcur.execute("SELECT pid, length FROM wc2.pipes_view ORDER BY pid")
+assert( pcur.fetchall() == [(3, 4)] )
+pcur.execute("SELECT COUNT(*) FROM wc2.junctions_view")
+assert( pcur.fetchone()[0] == 1 )
+pcur.execute("SELECT COUNT(*) FROM wc1.junctions_view")
+assert( pcur.fetchone()[0] == 2 )
+
+# recreating the triggers keeps the edits
+versioning_base.upgrade_working_copy_views(pg_conn_info, 'wc2')
+pcur.execute("SELECT COUNT(*) FROM epanet.working_copy_edits")
+assert( pcur.fetchone()[0] == 4 )
+pcur.execute("UPDATE wc2.pipes_view SET length = 5 WHERE pid = 3")
+pcur.commit()
+pcur.execute("SELECT pid, length FROM wc2.pipes_view ORDER BY pid")
+assert( pcur.fetchall() == [(3, 5)] )
+
+versioning_base.pg_commit(pg_conn_info, 'wc2', 'commit wc2')
+pcur.execute("SELECT COUNT(*) FROM epanet.pipes WHERE trunk_rev_begin = 2")
+assert( pcur.fetchone()[0] == 1 )
+pcur.close()
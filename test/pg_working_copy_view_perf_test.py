@@ -0,0 +1,103 @@
+#!/usr/bin/python
+import versioning_base
+import psycopg2
+import os
+import time
+
+# map extent queries on the view of a postgres working copy of a large
+# history must use the spatial index of the versioned table instead of
+# sorting the whole table, the number of rows can be set with the
+# environment variable VERSIONING_BENCH_ROWS
+
+nb = int(os.environ.get('VERSIONING_BENCH_ROWS', 1000000))
+test_data_dir = os.path.dirname(os.path.realpath(__file__))
+
+os.system("dropdb epanet_test_db")
+os.system("createdb epanet_test_db")
+os.system("psql epanet_test_db -c 'CREATE EXTENSION postgis'")
+os.system("psql epanet_test_db -f "+test_data_dir+"/epanet_test_db.sql")
+
+pg_conn_info = "dbname=epanet_test_db"
+pcur = versioning_base.Db(psycopg2.connect(pg_conn_info))
+pcur.execute("INSERT INTO epanet.revisions (rev, commit_msg, branch) "
+    "VALUES (2, 'bench', 'trunk')")
+# half of the rows are live, the other half ended in revision 1
+pcur.execute("INSERT INTO epanet.junctions "
+    "(id, elevation, geom, trunk_rev_begin, trunk_rev_end) "
+    "SELECT i::varchar, i%100, "
+        "ST_SetSRID(ST_MakePoint(i%1000, i/1000), 2154), "
+        "1, CASE WHEN i%2 = 0 THEN NULL ELSE 1 END "
+    "FROM generate_series(1, "+str(nb)+") AS i")
+pcur.commit()
+versioning_base.add_history_indexes(pg_conn_info, 'epanet')
+pcur.execute("ANALYZE epanet.junctions")
+pcur.commit()
+
+versioning_base.pg_checkout(pg_conn_info,
+        ['epanet_trunk_rev_head.junctions'], "epanet_wc")
+
+# local edits
+pcur.execute("UPDATE epanet_wc.junctions_view SET elevation = -1 "
+    "WHERE geom && ST_MakeEnvelope(100, 100, 110, 101, 2154)")
+pcur.execute("DELETE FROM epanet_wc.junctions_view "
+    "WHERE geom && ST_MakeEnvelope(100, 102, 104, 102, 2154)")
+pcur.commit()
+
+# rows ended on the server after the checkout stay in the working copy
+pcur.execute("INSERT INTO epanet.revisions (rev, commit_msg, branch) "
+    "VALUES (3, 'bench', 'trunk')")
+pcur.execute("UPDATE epanet.junctions SET trunk_rev_end = 2 "
+    "WHERE geom && ST_MakeEnvelope(100, 103, 110, 103, 2154) "
+    "AND trunk_rev_end IS NULL")
+pcur.execute("ANALYZE epanet.junctions")
+pcur.commit()
+
+def extent(i):
+    x = 10*(i%90)
+    y = 10*(i/90%90)
+    return ("ST_MakeEnvelope("+str(x)+", "+str(y)+", "
+        +str(x+10)+", "+str(y+10)+", 2154)")
+
+view_query = "SELECT * FROM epanet_wc.junctions_view WHERE geom && "
+direct_query = ("SELECT * FROM epanet.junctions "
+    "WHERE trunk_rev_end IS NULL AND trunk_rev_begin IS NOT NULL "
+    "AND geom && ")
+
+# same features as the revision checked out with the local edits
+env = extent(910)
+pcur.execute("SELECT COUNT(*), "
+    "SUM(CASE WHEN elevation = -1 THEN 1 ELSE 0 END) "
+    "FROM ("+view_query+env+") AS v")
+[count, edited] = pcur.fetchone()
+pcur.execute("SELECT COUNT(*) FROM epanet.junctions "
+    "WHERE geom && "+env+" AND trunk_rev_begin <= 2 "
+    "AND (trunk_rev_end IS NULL OR trunk_rev_end >= 2)")
+[expected] = pcur.fetchone()
+pcur.execute("SELECT COUNT(*) FROM ("+view_query+env+") AS v "
+    "WHERE geom && ST_MakeEnvelope(100, 102, 104, 102, 2154)")
+[deleted] = pcur.fetchone()
+print count, edited, expected, deleted
+assert( deleted == 0 )
+assert( edited > 0 )
+assert( count == expected - 3 )
+
+# no sort of the history, the spatial index is used
+pcur.execute("EXPLAIN "+view_query+env)
+plan = "\n".join([ line for [line] in pcur.fetchall() ])
+print plan
+assert( plan.find('Unique') == -1 )
+assert( plan.find('Sort') == -1 )
+assert( plan.find('junctions_trunk_live_geom_idx') != -1 )
+
+timing = {}
+for [name, query] in [['view', view_query], ['direct', direct_query]]:
+    start = time.time()
+    for i in range(100):
+        pcur.execute(query+extent(i))
+        pcur.fetchall()
+    timing[name] = time.time() - start
+
+print "100 map extents on %d rows: view %.3fs, table %.3fs"%(nb,
+    timing['view'], timing['direct'])
+assert( timing['view'] < 10*timing['direct'] + 1 )
+pcur.close()
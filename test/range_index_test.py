@@ -0,0 +1,82 @@
+#!/usr/bin/python
+import versioning_base
+from pyspatialite import dbapi2
+import psycopg2
+import datetime
+import os
+
+tmp_dir = "/tmp"
+test_data_dir = os.path.dirname(os.path.realpath(__file__))
+
+wc = tmp_dir+"/range_index_test_wc.sqlite"
+if os.path.isfile(wc): os.remove(wc)
+
+# create the test database
+
+os.system("dropdb epanet_test_db")
+os.system("createdb epanet_test_db")
+os.system("psql epanet_test_db -c 'CREATE EXTENSION postgis'")
+os.system("psql epanet_test_db -f "+test_data_dir+"/epanet_test_db.sql")
+
+versioning_base.add_range_indexes("dbname=epanet_test_db", 'epanet')
+
+pcur = versioning_base.Db( psycopg2.connect("dbname=epanet_test_db") )
+pcur.execute("SELECT indexname FROM pg_indexes "
+    "WHERE schemaname = 'epanet' AND indexname LIKE 'pipes_trunk_range%' "
+    "ORDER BY indexname")
+assert( pcur.fetchall() == [('pipes_trunk_range_geom_idx',),
+                            ('pipes_trunk_range_idx',)] )
+pcur.commit()
+
+tables = ['epanet_trunk_rev_head.junctions', 'epanet_trunk_rev_head.pipes']
+versioning_base.checkout("dbname=epanet_test_db", tables, wc)
+scur = versioning_base.Db( dbapi2.connect( wc ) )
+scur.execute("UPDATE pipes_view SET length = 2")
+scur.commit()
+scur.close()
+before_commit = datetime.datetime.now()
+versioning_base.commit(wc, 'rev 2', "dbname=epanet_test_db")
+
+# as of lookup
+assert( versioning_base.revision_at("dbname=epanet_test_db", 'epanet',
+    before_commit) == 1 )
+assert( versioning_base.revision_at("dbname=epanet_test_db", 'epanet',
+    datetime.datetime.now()) == 2 )
+assert( versioning_base.revision_at("dbname=epanet_test_db", 'epanet',
+    '1970-01-01') is None )
+
+# revision queries give the same results with ranges
+for rev in [1, 2]:
+    pcur.execute("SELECT pid FROM epanet.pipes WHERE "
+        +versioning_base.pg_revision_selection('trunk', rev))
+    scalars = pcur.fetchall()
+    pcur.execute("SELECT pid FROM epanet.pipes WHERE "
+        +versioning_base.pg_revision_selection('trunk', rev, True))
+    assert( pcur.fetchall() == scalars )
+
+# and are index driven with a bbox
+pcur.execute("SET enable_seqscan = off")
+pcur.execute("EXPLAIN SELECT pid FROM epanet.pipes WHERE "
+    +versioning_base.pg_revision_selection('trunk', 1, True)+" "
+    "AND geom && ST_MakeEnvelope(0, 0, 1, 1, 2154)")
+plan = '\n'.join([line for [line] in pcur.fetchall()])
+assert( 'pipes_trunk_range' in plan )
+pcur.close()
+
+versioning_base.add_revision_view("dbname=epanet_test_db", 'epanet', 'trunk', 1)
+assert( [f['length'] for f in versioning_base.features(
+    "dbname=epanet_test_db", 'epanet', 'pipes', 'trunk', 1)] == [1] )
+
+# new branches inherit the range indexes, table by table
+pcur = versioning_base.Db( psycopg2.connect("dbname=epanet_test_db") )
+pcur.execute("DROP INDEX epanet.junctions_trunk_range_idx")
+pcur.commit()
+versioning_base.add_branch("dbname=epanet_test_db", 'epanet', 'mybranch',
+    'branch')
+pcur.execute("SELECT indexname FROM pg_indexes "
+    "WHERE indexname = 'pipes_mybranch_range_idx'")
+assert( pcur.fetchone() )
+pcur.execute("SELECT indexname FROM pg_indexes "
+    "WHERE indexname = 'junctions_mybranch_range_idx'")
+assert( not pcur.fetchone() )
+pcur.close()
@@ -0,0 +1,94 @@
+#!/usr/bin/python
+import versioning_base
+import psycopg2
+import os
+import time
+
+# compare the time to historize and branch a large table by altering it in
+# place and by rebuilding it, the number of rows can be set with the
+# environment variable VERSIONING_BENCH_ROWS
+
+nb = int(os.environ.get('VERSIONING_BENCH_ROWS', 1000000))
+
+os.system("dropdb epanet_test_db")
+os.system("createdb epanet_test_db")
+os.system("psql epanet_test_db -c 'CREATE EXTENSION postgis'")
+
+pg_conn_info = "dbname=epanet_test_db"
+pcur = versioning_base.Db(psycopg2.connect(pg_conn_info))
+for schema in ['altered', 'rebuilt']:
+    pcur.execute("CREATE SCHEMA "+schema)
+    pcur.execute("CREATE TABLE "+schema+".junctions ("
+        "hid serial PRIMARY KEY, "
+        "id varchar NOT NULL, "
+        "elevation float DEFAULT 0 CHECK (elevation > -1000), "
+        "geom geometry('POINT',2154))")
+    pcur.execute("CREATE INDEX junctions_id_idx ON "+schema+".junctions(id)")
+    pcur.execute("CREATE INDEX junctions_geom_idx "
+        "ON "+schema+".junctions USING gist(geom)")
+    pcur.execute("INSERT INTO "+schema+".junctions (id, elevation, geom) "
+        "SELECT i::varchar, i%100, "
+            "ST_SetSRID(ST_MakePoint(i%1000, i/1000), 2154) "
+        "FROM generate_series(1, "+str(nb)+") AS i")
+    # a table of another schema refers to the versioned one
+    pcur.execute("CREATE TABLE public."+schema+"_meters ("
+        "id serial PRIMARY KEY, "
+        "junction integer REFERENCES "+schema+".junctions(hid))")
+    pcur.execute("INSERT INTO public."+schema+"_meters (junction) "
+        "VALUES (1)")
+    pcur.execute("GRANT SELECT ON "+schema+".junctions TO PUBLIC")
+pcur.commit()
+
+timing = {}
+for [schema, rebuild] in [['altered', False], ['rebuilt', True]]:
+    start = time.time()
+    versioning_base.historize(pg_conn_info, schema, rebuild = rebuild)
+    timing[(schema, 'historize')] = time.time() - start
+    start = time.time()
+    versioning_base.add_branch(pg_conn_info, schema, 'mybranch', 'branch',
+            rebuild = rebuild)
+    timing[(schema, 'add_branch')] = time.time() - start
+
+for operation in ['historize', 'add_branch']:
+    print "%s of %d rows: altered %.2fs, rebuilt %.2fs"%(operation, nb,
+        timing[('altered', operation)], timing[('rebuilt', operation)])
+
+# both paths give the same tables
+def describe(schema):
+    res = []
+    pcur.execute("SELECT COUNT(*), COUNT(trunk_rev_begin), "
+        "COUNT(mybranch_rev_begin), MAX(hid) "
+        "FROM "+schema+".junctions")
+    res.append(pcur.fetchone())
+    pcur.execute("SELECT column_name, column_default, is_nullable "
+        "FROM information_schema.columns "
+        "WHERE table_schema = '"+schema+"' AND table_name = 'junctions' "
+        "ORDER BY ordinal_position")
+    res.append(pcur.fetchall())
+    pcur.execute("SELECT contype, pg_get_constraintdef(oid), convalidated "
+        "FROM pg_constraint "
+        "WHERE conrelid = '"+schema+".junctions'::regclass "
+        "ORDER BY 1, 2")
+    res.append(pcur.fetchall())
+    pcur.execute("SELECT COUNT(*) FROM pg_indexes "
+        "WHERE schemaname = '"+schema+"' AND tablename = 'junctions'")
+    res.append(pcur.fetchone())
+    pcur.execute("SELECT COUNT(*) FROM pg_constraint "
+        "WHERE confrelid = '"+schema+".junctions'::regclass "
+        "AND conrelid = 'public."+schema+"_meters'::regclass")
+    res.append(pcur.fetchone())
+    pcur.execute("SELECT has_table_privilege('public', "
+        "'"+schema+".junctions', 'SELECT')")
+    res.append(pcur.fetchone())
+    return str(res).replace(schema, 'schema')
+
+assert( describe('altered') == describe('rebuilt') )
+
+# the pkey sequence still belongs to the table
+pcur.execute("SELECT pg_get_serial_sequence('rebuilt.junctions', 'hid')")
+assert( pcur.fetchone()[0] )
+pcur.execute("INSERT INTO rebuilt.junctions (id) VALUES ('x')")
+pcur.execute("SELECT hid, elevation FROM rebuilt.junctions WHERE id = 'x'")
+assert( pcur.fetchone() == (nb+1, 0) )
+pcur.commit()
+pcur.close()
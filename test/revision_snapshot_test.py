@@ -0,0 +1,72 @@
+#!/usr/bin/python
+import versioning_base
+from pyspatialite import dbapi2
+import psycopg2
+import os
+
+tmp_dir = "/tmp"
+test_data_dir = os.path.dirname(os.path.realpath(__file__))
+
+wc = tmp_dir+"/revision_snapshot_test_wc.sqlite"
+if os.path.isfile(wc): os.remove(wc)
+
+# create the test database
+
+os.system("dropdb epanet_test_db")
+os.system("createdb epanet_test_db")
+os.system("psql epanet_test_db -c 'CREATE EXTENSION postgis'")
+os.system("psql epanet_test_db -f "+test_data_dir+"/epanet_test_db.sql")
+
+tables = ['epanet_trunk_rev_head.junctions', 'epanet_trunk_rev_head.pipes']
+versioning_base.checkout("dbname=epanet_test_db", tables, wc)
+scur = versioning_base.Db( dbapi2.connect( wc ) )
+scur.execute("UPDATE pipes_view SET length = 2")
+scur.commit()
+scur.close()
+versioning_base.commit(wc, 'rev 2', "dbname=epanet_test_db")
+
+pcur = versioning_base.Db( psycopg2.connect("dbname=epanet_test_db") )
+def snapshots():
+    pcur.execute("SELECT rev_schema, nb_uses FROM epanet.revision_snapshots "
+        "ORDER BY rev_schema")
+    res = pcur.fetchall()
+    pcur.commit()
+    return res
+
+# materialized revisions are indexed tables
+versioning_base.add_revision_view("dbname=epanet_test_db", 'epanet', 'trunk',
+    1, True)
+pcur.execute("SELECT table_type FROM information_schema.tables "
+    "WHERE table_schema = 'epanet_trunk_rev_1' AND table_name = 'pipes'")
+assert( pcur.fetchone()[0] == 'BASE TABLE' )
+pcur.execute("SELECT length FROM epanet_trunk_rev_1.pipes")
+assert( pcur.fetchall() == [(1,)] )
+pcur.execute("SELECT indexdef FROM pg_indexes "
+    "WHERE schemaname = 'epanet_trunk_rev_1' AND tablename = 'pipes'")
+indexes = [idx for [idx] in pcur.fetchall()]
+assert( len(indexes) == 2 )
+assert( [idx for idx in indexes if 'gist' in idx] )
+assert( snapshots() == [('epanet_trunk_rev_1', 0)] )
+
+# the bookkeeping table is not versioned
+assert( 'revision_snapshots' not in
+    versioning_base.pg_versioned_tables( pcur, 'epanet' ) )
+
+# asking again for a revision counts as a use
+versioning_base.add_revision_view("dbname=epanet_test_db", 'epanet', 'trunk',
+    1, True)
+assert( snapshots() == [('epanet_trunk_rev_1', 1)] )
+
+# the least recently used revision is evicted when over budget
+versioning_base.add_revision_view("dbname=epanet_test_db", 'epanet', 'trunk',
+    2, True, 0)
+assert( snapshots() == [('epanet_trunk_rev_2', 0)] )
+pcur.execute("SELECT schema_name FROM information_schema.schemata "
+    "WHERE schema_name = 'epanet_trunk_rev_1'")
+assert( not pcur.fetchone() )
+pcur.commit()
+
+assert( versioning_base.evict_revision_snapshots("dbname=epanet_test_db",
+    'epanet', 0) == ['epanet_trunk_rev_2'] )
+assert( snapshots() == [] )
+pcur.close()
@@ -0,0 +1,66 @@
+#!/usr/bin/python
+import versioning_base
+from pyspatialite import dbapi2
+import psycopg2
+import os
+
+tmp_dir = "/tmp"
+test_data_dir = os.path.dirname(os.path.realpath(__file__))
+
+wc = tmp_dir+"/server_commit_test_wc.sqlite"
+if os.path.isfile(wc): os.remove(wc)
+
+# create the test database
+
+os.system("dropdb epanet_test_db")
+os.system("createdb epanet_test_db")
+os.system("psql epanet_test_db -c 'CREATE EXTENSION postgis'")
+os.system("psql epanet_test_db -f "+test_data_dir+"/epanet_test_db.sql")
+
+versioning_base.install_functions("dbname=epanet_test_db", "epanet")
+
+tables = ['epanet_trunk_rev_head.junctions', 'epanet_trunk_rev_head.pipes']
+versioning_base.checkout("dbname=epanet_test_db", tables, wc)
+versioning_base.pg_checkout("dbname=epanet_test_db", tables, "epanet_wc")
+
+trace = versioning_base.trace
+trace.enable()
+
+# spatialite working copy, modified pipe and inserted junction
+scur = versioning_base.Db( dbapi2.connect( wc ) )
+scur.execute("UPDATE pipes_view SET length = 2")
+scur.execute("INSERT INTO junctions_view(id, elevation, GEOMETRY) "
+    "VALUES ('2', 2, GeomFromText('POINT(2 2)',2154))")
+scur.commit()
+scur.close()
+assert( versioning_base.commit(wc, 'sp commit', "dbname=epanet_test_db") == 2 )
+
+# a single statement per table merges the diff
+applied = [rec for rec in trace.records if rec['backend'] == 'pg'
+        and rec['operation'] == 'commit' and rec['phase'] == 'apply'
+        and 'versioning_apply_diff' in rec['sql']]
+assert( len(applied) == 2 )
+
+pcur = versioning_base.Db( psycopg2.connect("dbname=epanet_test_db") )
+pcur.execute("SELECT rev, commit_msg FROM epanet.revisions ORDER BY rev")
+assert( pcur.fetchall() == [(1, 'initial commit'), (2, 'sp commit')] )
+pcur.execute("SELECT pid, length, trunk_rev_begin, trunk_rev_end, "
+    "trunk_parent, trunk_child FROM epanet.pipes ORDER BY pid")
+assert( pcur.fetchall() == [(1, 1, 1, 1, None, 2), (2, 2, 2, None, 1, None)] )
+pcur.execute("SELECT COUNT(*) FROM epanet.junctions "
+    "WHERE trunk_rev_begin = 2 AND trunk_rev_end IS NULL")
+assert( pcur.fetchone()[0] == 1 )
+
+# postgres working copy
+versioning_base.pg_update("dbname=epanet_test_db", "epanet_wc")
+pcur.execute("DELETE FROM epanet_wc.junctions_view WHERE id = '2'")
+pcur.commit()
+assert( versioning_base.pg_commit("dbname=epanet_test_db", "epanet_wc",
+    'pg commit') == 1 )
+pcur.execute("SELECT trunk_rev_end FROM epanet.junctions WHERE id = '2'")
+assert( pcur.fetchall() == [(2,)] )
+pcur.execute("SELECT COUNT(*) FROM epanet_wc.junctions_diff")
+assert( pcur.fetchone()[0] == 0 )
+pcur.execute("SELECT MAX(rev) FROM epanet.revisions")
+assert( pcur.fetchone()[0] == 3 )
+pcur.close()
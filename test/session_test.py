@@ -0,0 +1,65 @@
+#!/usr/bin/python
+import versioning_base
+from pyspatialite import dbapi2
+import psycopg2
+import os
+
+tmp_dir = "/tmp"
+test_data_dir = os.path.dirname(os.path.realpath(__file__))
+
+wc = [tmp_dir+"/session_test_wc0.sqlite", tmp_dir+"/session_test_wc1.sqlite"]
+for f in wc:
+    if os.path.isfile(f): os.remove(f)
+
+# create the test database
+
+os.system("dropdb epanet_test_db")
+os.system("createdb epanet_test_db")
+os.system("psql epanet_test_db -c 'CREATE EXTENSION postgis'")
+os.system("psql epanet_test_db -f "+test_data_dir+"/epanet_test_db.sql")
+
+def nb_of_connections():
+    pcon = psycopg2.connect("dbname=postgres")
+    pcur = pcon.cursor()
+    pcur.execute("SELECT COUNT(*) FROM pg_stat_activity "
+        "WHERE datname = 'epanet_test_db'")
+    [nb] = pcur.fetchone()
+    pcon.close()
+    return nb
+
+session = versioning_base.Session("dbname=epanet_test_db", 2)
+assert( nb_of_connections() == 1 )
+
+tables = ['epanet_trunk_rev_head.junctions', 'epanet_trunk_rev_head.pipes']
+for f in wc:
+    versioning_base.checkout(session, tables, f)
+
+scur = versioning_base.Db( dbapi2.connect( wc[0] ) )
+scur.execute("UPDATE pipes_view SET length = 1")
+scur.execute("INSERT INTO junctions_view(id, elevation, GEOMETRY) "
+    "VALUES ('2', 2, GeomFromText('POINT(2 2)',2154))")
+scur.commit()
+scur.close()
+
+assert( versioning_base.late(wc[0], session) == 0 )
+assert( versioning_base.commit(wc[0], 'commit wc0', session) == 2 )
+assert( versioning_base.late(wc[1], session) == 1 )
+versioning_base.update(wc[1], session)
+assert( versioning_base.late(wc[1], session) == 0 )
+assert( versioning_base.revisions(session, 'epanet') == [1, 2] )
+
+# a full update/commit cycle must not open more than the pool size
+assert( nb_of_connections() <= 2 )
+
+# failed operations give their connection back to the pool
+for i in range(3):
+    failed = False
+    try:
+        versioning_base.add_branch(session, 'epanet', 'trunk', 'exists')
+    except RuntimeError:
+        failed = True
+    assert( failed )
+assert( versioning_base.revisions(session, 'epanet') == [1, 2] )
+
+session.close()
+assert( nb_of_connections() == 0 )
@@ -0,0 +1,73 @@
+#!/usr/bin/python
+import versioning_base
+from pyspatialite import dbapi2
+import psycopg2
+import os
+
+tmp_dir = "/tmp"
+test_data_dir = os.path.dirname(os.path.realpath(__file__))
+
+wc = tmp_dir+"/staging_test_wc.sqlite"
+if os.path.isfile(wc): os.remove(wc)
+
+# create the test database
+
+os.system("dropdb epanet_test_db")
+os.system("createdb epanet_test_db")
+os.system("psql epanet_test_db -c 'CREATE EXTENSION postgis'")
+os.system("psql epanet_test_db -f "+test_data_dir+"/epanet_test_db.sql")
+
+tables = ['epanet_trunk_rev_head.junctions', 'epanet_trunk_rev_head.pipes']
+versioning_base.checkout("dbname=epanet_test_db", tables, wc)
+versioning_base.pg_checkout("dbname=epanet_test_db", tables, "epanet_wc")
+
+pcur = versioning_base.Db( psycopg2.connect("dbname=epanet_test_db") )
+def diff_schemas():
+    pcur.execute("SELECT nspname FROM pg_namespace "
+        "WHERE nspname LIKE 'epanet%_diff' ORDER BY nspname")
+    res = [schema for [schema] in pcur.fetchall()]
+    pcur.commit()
+    return res
+
+def edit(length):
+    scur = versioning_base.Db( dbapi2.connect( wc ) )
+    scur.execute("UPDATE pipes_view SET length = "+str(length))
+    scur.commit()
+    scur.close()
+
+trace = versioning_base.trace
+trace.enable()
+
+# the diff is staged in a temporary table by default
+edit(2)
+assert( versioning_base.commit(wc, 'temp', "dbname=epanet_test_db") == 1 )
+assert( not [rec for rec in trace.records
+    if rec['sql'].startswith('CREATE SCHEMA')] )
+assert( diff_schemas() == [] )
+
+# or in an unlogged table of a diff schema
+os.environ['VERSIONING_STAGING'] = 'unlogged'
+edit(3)
+assert( versioning_base.commit(wc, 'unlogged', "dbname=epanet_test_db") == 1 )
+assert( [rec for rec in trace.records if rec['sql'].startswith(
+    'CREATE UNLOGGED TABLE epanet_trunk_2_to_3_diff.pipes_diff')] )
+assert( diff_schemas() == [] )
+del os.environ['VERSIONING_STAGING']
+pcur.execute("SELECT length FROM epanet_trunk_rev_head.pipes")
+assert( pcur.fetchall() == [(3,)] )
+
+# the update diff of postgres working copies is unlogged
+versioning_base.pg_update("dbname=epanet_test_db", "epanet_wc")
+pcur.execute("SELECT relpersistence FROM pg_class "
+    "WHERE oid = 'epanet_wc.pipes_update_diff'::regclass")
+assert( pcur.fetchone()[0] == 'u' )
+
+# the janitor removes the diff schemas left by a crash
+pcur.execute("CREATE SCHEMA epanet_trunk_3_to_4_diff")
+pcur.execute("CREATE TABLE epanet_trunk_3_to_4_diff.pipes_diff (pid integer)")
+pcur.commit()
+assert( diff_schemas() == ['epanet_trunk_3_to_4_diff'] )
+assert( versioning_base.drop_orphan_diffs("dbname=epanet_test_db", "epanet")
+    == ['epanet_trunk_3_to_4_diff'] )
+assert( diff_schemas() == [] )
+pcur.close()
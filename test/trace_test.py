@@ -0,0 +1,66 @@
+#!/usr/bin/python
+import versioning_base
+from pyspatialite import dbapi2
+import json
+import os
+
+tmp_dir = "/tmp"
+test_data_dir = os.path.dirname(os.path.realpath(__file__))
+
+wc = tmp_dir+"/trace_test_wc.sqlite"
+if os.path.isfile(wc): os.remove(wc)
+trace_file = tmp_dir+"/trace_test.jsonl"
+if os.path.isfile(trace_file): os.remove(trace_file)
+
+# create the test database
+
+os.system("dropdb epanet_test_db")
+os.system("createdb epanet_test_db")
+os.system("psql epanet_test_db -c 'CREATE EXTENSION postgis'")
+os.system("psql epanet_test_db -f "+test_data_dir+"/epanet_test_db.sql")
+
+trace = versioning_base.trace
+trace.enable( slow=0, filename=trace_file )
+
+tables = ['epanet_trunk_rev_head.junctions', 'epanet_trunk_rev_head.pipes']
+versioning_base.checkout("dbname=epanet_test_db", tables, wc)
+
+scur = versioning_base.Db( dbapi2.connect( wc ) )
+scur.execute("UPDATE pipes_view SET length = 2")
+scur.commit()
+scur.close()
+versioning_base.commit(wc, 'edit pipe', "dbname=epanet_test_db")
+trace.disable()
+
+# every statement is attributed to a backend and a phase
+phases = set([(rec['operation'], rec['phase']) for rec in trace.records])
+assert( ('checkout', 'copy') in phases )
+assert( ('commit', 'apply') in phases )
+assert( set([rec['backend'] for rec in trace.records]) == set(['sp', 'pg']) )
+for rec in trace.records:
+    if rec['sql'].startswith('INSERT INTO epanet.pipes'):
+        assert( rec['rows'] == 1 )
+
+# all statements are above a null threshold, the totals add up
+assert( len(trace.slow_statements()) == len(trace.records) )
+assert( sum([total[2] for total in trace.summary()]) == len(trace.records) )
+
+# records are streamed to the file as JSON lines
+records = [json.loads(line) for line in open(trace_file)]
+assert( len(records) == len(trace.records) )
+trace.dump(trace_file)
+assert( [json.loads(line) for line in open(trace_file)] == records )
+
+# the copy threads of a parallel checkout trace in the phase of the caller
+trace.clear()
+trace.enable( slow=10 )
+wc_parallel = tmp_dir+"/trace_test_wc_parallel.sqlite"
+if os.path.isfile(wc_parallel): os.remove(wc_parallel)
+versioning_base.checkout("dbname=epanet_test_db", tables, wc_parallel,
+        jobs = 2)
+trace.disable()
+copies = [rec for rec in trace.records if rec['sql'].startswith('COPY')]
+assert( len(copies) == 2 )
+for rec in copies:
+    assert( (rec['operation'], rec['phase']) == ('checkout', 'copy') )
+assert( trace.current() == ('checkout', 'views') )
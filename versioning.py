@@ -28,6 +28,7 @@ from qgis.core import QgsCredentials, QgsDataSourceURI, QgsMapLayerRegistry
 import re
 import os
 import os.path
+import multiprocessing
 import psycopg2
 import commit_msg_ui
 import versioning_base
@@ -390,21 +391,21 @@ class Versioning:
         button_box.accepted.connect(dlg.accept)
         button_box.rejected.connect(dlg.reject)
 
-        pcur = versioning_base.Db( psycopg2.connect(self.pg_conn_info()) )
-        pcur.execute("SELECT rev, commit_msg, branch, date, author "
-            "FROM "+schema+".revisions")
-        revs = pcur.fetchall()
-        pcur.close()
         tblw = QTableWidget( dlg )
-        tblw.setRowCount(len(revs))
         tblw.setColumnCount(5)
-        tblw.setSortingEnabled(True)
         tblw.setHorizontalHeaderLabels(['Revision', 'Commit Message',
                                       'Branch', 'Date', 'Author'])
         tblw.verticalHeader().setVisible(False)
-        for i, rev in enumerate(revs):
+        # rows are streamed from the server into the table
+        pcur = versioning_base.Db( psycopg2.connect(self.pg_conn_info()) )
+        for i, rev in enumerate(pcur.iterate(
+                "SELECT rev, commit_msg, branch, date, author "
+                "FROM "+schema+".revisions")):
+            tblw.insertRow(i)
             for j, item in enumerate(rev):
                 tblw.setItem(i, j, QTableWidgetItem( str(item) ))
+        pcur.close()
+        tblw.setSortingEnabled(True)
         layout.addWidget( tblw )
         layout.addWidget( button_box )
         dlg.resize( 600, 300 )
@@ -415,8 +416,8 @@ class Versioning:
         for i in tblw.selectedIndexes():
             rows.add(i.row())
         for row in rows:
-            branch = revs[row][2]
-            rev = revs[row][0]
+            branch = tblw.item(row, 2).text()
+            rev = int(tblw.item(row, 0).text())
             versioning_base.add_revision_view(uri.connectionInfo(),
                     schema, branch, rev )
             grp_name = branch+' revision '+str(rev)
@@ -491,13 +492,16 @@ class Versioning:
                 self.current_layers[0] )
         uri = QgsDataSourceURI(layer.source())
 
-        if layer.providerType() == "spatialite":
-            versioning_base.update( uri.database(), self.pg_conn_info() )
-            rev = versioning_base.revision( uri.database() )
-        else: # postgres
-            versioning_base.pg_update( uri.connectionInfo(), uri.schema() )
-            rev = versioning_base.pg_revision(
-                    uri.connectionInfo(), uri.schema() )
+        session = versioning_base.Session( self.pg_conn_info() )
+        try:
+            if layer.providerType() == "spatialite":
+                versioning_base.update( uri.database(), session )
+                rev = versioning_base.revision( uri.database() )
+            else: # postgres
+                versioning_base.pg_update( session, uri.schema() )
+                rev = versioning_base.pg_revision( session, uri.schema() )
+        finally:
+            session.close()
 
         if not self.unresolved_conflicts():
             QMessageBox.information( self.iface.mainWindow(), "Notice",
@@ -575,7 +579,8 @@ class Versioning:
 
         print "checkin out ", tables_for_conninfo, " from ",uri.connectionInfo()
         versioning_base.checkout( self.pg_conn_info(),
-                tables_for_conninfo, filename )
+                tables_for_conninfo, filename,
+                min(len(tables_for_conninfo), multiprocessing.cpu_count()) )
 
         # add layers from offline version
         grp_name = 'working copy'
@@ -664,43 +669,45 @@ class Versioning:
                 self.current_layers[0] )
         uri = QgsDataSourceURI(layer.source())
 
-        late_by = 0
-        if layer.providerType() == "spatialite":
-            late_by = versioning_base.late(
-                    uri.database(), self.pg_conn_info() )
-        else:#postgres
-            late_by = versioning_base.pg_late(
-                    self.pg_conn_info(), uri.schema() )
-
-        if late_by:
-            QMessageBox.warning(self.iface.mainWindow(), "Warning",
-                    "This working copy is not up to date (late by "
-                    +str(late_by)+" commit(s)).\n\n"
-                    "Please update before commiting your modifications")
-            print "aborted"
-            return
+        session = versioning_base.Session( self.pg_conn_info() )
+        try:
+            late_by = 0
+            if layer.providerType() == "spatialite":
+                late_by = versioning_base.late( uri.database(), session )
+            else:#postgres
+                late_by = versioning_base.pg_late( session, uri.schema() )
+
+            if late_by:
+                QMessageBox.warning(self.iface.mainWindow(), "Warning",
+                        "This working copy is not up to date (late by "
+                        +str(late_by)+" commit(s)).\n\n"
+                        "Please update before commiting your modifications")
+                print "aborted"
+                return
 
-        # time to get the commit message
-        if not self.q_commit_msg_dlg.exec_():
-            return
-        commit_msg = self.commit_msg_dlg.commitMessage.document().toPlainText()
-        if not commit_msg:
-            QMessageBox.warning(self.iface.mainWindow(), "Warning",
-                    "No commit message, aborting commit")
-            print "aborted"
-            return
+            # time to get the commit message
+            if not self.q_commit_msg_dlg.exec_():
+                return
+            commit_msg = \
+                self.commit_msg_dlg.commitMessage.document().toPlainText()
+            if not commit_msg:
+                QMessageBox.warning(self.iface.mainWindow(), "Warning",
+                        "No commit message, aborting commit")
+                print "aborted"
+                return
 
-        nb_of_updated_layer = 0
-        rev = 0
-        if layer.providerType() == "spatialite":
-            nb_of_updated_layer = versioning_base.commit( uri.database(),
-                    commit_msg, self.pg_conn_info() )
-            rev = versioning_base.revision(uri.database())
-        else: # postgres
-            nb_of_updated_layer = versioning_base.pg_commit(
-                    uri.connectionInfo(), uri.schema(), commit_msg )
-            rev = versioning_base.pg_revision(
-                    uri.connectionInfo(), uri.schema())
+            nb_of_updated_layer = 0
+            rev = 0
+            if layer.providerType() == "spatialite":
+                nb_of_updated_layer = versioning_base.commit( uri.database(),
+                        commit_msg, session )
+                rev = versioning_base.revision(uri.database())
+            else: # postgres
+                nb_of_updated_layer = versioning_base.pg_commit(
+                        session, uri.schema(), commit_msg )
+                rev = versioning_base.pg_revision( session, uri.schema() )
+        finally:
+            session.close()
 
         if nb_of_updated_layer:
             QMessageBox.information(self.iface.mainWindow(), "Info",
@@ -4,9 +4,19 @@ with this DB. User can checkout a working copy, update and commit.
 """
 import re
 import os
+import time
+import struct
+import json
 import getpass
+import threading
+import Queue
+import csv
+import gzip
+import hashlib
+import uuid
 from pyspatialite import dbapi2
 import psycopg2
+import psycopg2.pool
 import codecs
 
 def escape_quote(msg):
@@ -20,11 +30,162 @@ def quote_ident(ident):
     else:
         return ident
 
+class Trace:
+    """Record of the SQL statements executed through Db
+
+    Each record is a dict with the 'sql', its start 'time' and duration in
+    'seconds', the number of 'rows' affected or returned (-1 if unknown),
+    the 'backend' ('sp' or 'pg') and the versioning 'operation' and 'phase'
+    the statement belongs to (see phase()), which are set per thread.
+
+    Recording starts with enable(), or at import if the VERSIONING_TRACE
+    environment variable is set to the name of a file where records are
+    appended as JSON lines. Statements lasting more than slow seconds
+    (VERSIONING_TRACE_SLOW, 1 by default) are printed as they end."""
+    def __init__(self):
+        self.records = []
+        self.enabled = False
+        self.slow = float(os.environ.get('VERSIONING_TRACE_SLOW', 1))
+        self.filename = None
+        # operation and phase of each thread
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        if os.environ.get('VERSIONING_TRACE'):
+            self.enable( filename=os.environ['VERSIONING_TRACE'] )
+
+    def enable(self, slow = None, filename = None):
+        """Start recording, records are also appended to filename if
+        specified"""
+        self.enabled = True
+        if slow is not None:
+            self.slow = slow
+        self.filename = filename
+
+    def disable(self):
+        """Stop recording, records are kept"""
+        self.enabled = False
+
+    def clear(self):
+        """Remove all records"""
+        self.records = []
+
+    def phase(self, operation, phase = None):
+        """Set the operation and phase the next statements of the calling
+        thread belong to"""
+        self.local.operation = operation
+        self.local.phase = phase
+
+    def current(self):
+        """Returns the (operation, phase) of the calling thread"""
+        return (getattr(self.local, 'operation', None),
+                getattr(self.local, 'phase', None))
+
+    def record(self, backend, sql, start, rows):
+        """Add the record of a statement started at start"""
+        seconds = time.time() - start
+        [operation, phase] = self.current()
+        rec = {'time': start, 'seconds': seconds, 'rows': rows,
+            'backend': backend, 'operation': operation,
+            'phase': phase, 'sql': sql}
+        with self.lock:
+            self.records.append(rec)
+            if self.filename:
+                with open(self.filename, 'a') as trace_file:
+                    trace_file.write(json.dumps(rec)+'\n')
+        if seconds > self.slow:
+            print "slow statement (%.2fs) in"%seconds, operation,
+            print phase, ":", sql
+
+    def slow_statements(self):
+        """Returns the records of statements slower than the threshold, the
+        slowest first"""
+        return sorted([rec for rec in self.records
+                if rec['seconds'] > self.slow],
+            key=lambda rec: -rec['seconds'])
+
+    def summary(self):
+        """Returns a list of (operation, phase, statements, seconds, rows)
+        totals, the most time consuming first"""
+        totals = {}
+        for rec in self.records:
+            key = (rec['operation'], rec['phase'])
+            [nb, seconds, rows] = totals.get(key, [0, 0, 0])
+            totals[key] = [nb + 1, seconds + rec['seconds'],
+                rows + max(rec['rows'], 0)]
+        return sorted([key + tuple(total) for key, total in totals.items()],
+            key=lambda total: -total[3])
+
+    def dump(self, filename):
+        """Write all records in filename as JSON lines"""
+        with open(filename, 'w') as trace_file:
+            for rec in self.records:
+                trace_file.write(json.dumps(rec)+'\n')
+
+# statements of all Db are recorded here when enabled
+trace = Trace()
+
+class ChangesetReader:
+    """Reads a changeset file: gzip compressed JSON lines, a header object,
+    then for each layer an object describing it followed by its rows as
+    arrays. The rows of the current layer are read with fetchmany (e.g. by
+    a CopyWriter), only the columns at indexes are kept if specified"""
+    def __init__(self, filename, kind):
+        self.file = gzip.open(filename, 'rb')
+        self.header = self._read()
+        if not isinstance(self.header, dict) or \
+                self.header.get('format') != 'qgis-versioning-changeset':
+            raise RuntimeError(filename+" is not a changeset file")
+        if self.header['version'] > 1:
+            raise RuntimeError("Unsupported changeset version "
+                    +str(self.header['version'])+" in "+filename)
+        if self.header['kind'] != kind:
+            raise RuntimeError(filename+" is a changeset for "
+                    +self.header['kind']+", not for "+kind)
+        self.pending = self._read()
+        self.indexes = None
+
+    def _read(self):
+        """Returns the next line decoded, None at the end of the file"""
+        line = self.file.readline()
+        return json.loads(line) if line else None
+
+    def layers(self):
+        """Yield the description of each layer, the rows of the layer that
+        have not been fetched are skipped"""
+        while isinstance(self.pending, dict):
+            layer = self.pending
+            self.pending = self._read()
+            self.indexes = None
+            yield layer
+            while isinstance(self.pending, list):
+                self.pending = self._read()
+
+    def has_rows(self):
+        """Test if rows of the current layer remain to be fetched"""
+        return isinstance(self.pending, list)
+
+    def fetchmany(self, size):
+        """Returns at most size rows of the current layer"""
+        rows = []
+        while isinstance(self.pending, list) and len(rows) < size:
+            rows.append(self.pending if self.indexes is None
+                    else [self.pending[i] for i in self.indexes])
+            self.pending = self._read()
+        return rows
+
+    def close(self):
+        """Close the file"""
+        self.file.close()
+
 class Db:
-    """Basic wrapper arround DB cursor that allows for logging SQL commands"""
-    def __init__(self, con, filename = ''):
-        """The passed connection must be closed with close()"""
+    """Basic wrapper arround DB cursor that allows for logging SQL commands,
+    used in a with statement it is closed at the end of the block"""
+    def __init__(self, con, filename = '', session = None):
+        """The passed connection must be closed with close(), if a session
+        is specified, the connection is given back to its pool instead"""
         self.con = con
+        self.session = session
+        self.closed = False
         if isinstance(con, dbapi2.Connection):
             self.db_type = 'sp : '
         else :
@@ -37,6 +198,19 @@ class Db:
             self.log = None
         self.begun = False
         self._verbose = False
+        self.metadata = {} # see pg_metadata
+        self.itersize = 2000 # see iterate
+        self.nb_cursors = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def rowcount(self):
+        """Returns the number of rows of the previous execute"""
+        return self.cur.rowcount
 
     def hasrow(self):
         """Test if previous execute returned rows"""
@@ -48,8 +222,8 @@ class Db:
         """Set verbose level"""
         self._verbose = verbose
 
-    def execute(self, sql):
-        """Execute SQL command"""
+    def _log(self, sql):
+        """Print and log SQL command, begining the transaction if needed"""
         if not self.begun:
             self.begun = True
             if self._verbose:
@@ -60,7 +234,56 @@ class Db:
             print self.db_type, sql, ';'
         if self.log :
             self.log.write(sql+';\n')
-        self.cur.execute( sql )
+
+    def _traced(self, method, sql, *args):
+        """Call method of the cursor and record it in the trace"""
+        if not trace.enabled:
+            return method( sql, *args )
+        start = time.time()
+        method( sql, *args )
+        trace.record( self.db_type[:2], sql, start, self.cur.rowcount )
+
+    def execute(self, sql):
+        """Execute SQL command"""
+        self._log(sql)
+        self._traced( self.cur.execute, sql )
+
+    def executemany(self, sql, rows):
+        """Execute parametrized SQL command once per row of parameters"""
+        self._log(sql)
+        self._traced( self.cur.executemany, sql, rows )
+
+    def copy_expert(self, sql, file_obj):
+        """Execute a COPY command reading from or writing to file_obj"""
+        self._log(sql)
+        self._traced( self.cur.copy_expert, sql, file_obj )
+
+    def iterate(self, sql, itersize = None):
+        """Execute the SELECT sql and yield its rows as tuples, postgres rows
+        are fetched by batches of itersize (self.itersize by default) from a
+        server side cursor so that memory does not grow with the result.
+        Other commands can be executed while iterating."""
+        self._log(sql)
+        itersize = itersize if itersize else self.itersize
+        self.nb_cursors += 1
+        if self.db_type == 'pg : ':
+            cur = self.con.cursor('versioning_cursor_'+str(self.nb_cursors))
+            cur.itersize = itersize
+        else:
+            cur = self.con.cursor()
+        try:
+            start = time.time()
+            cur.execute( sql )
+            if trace.enabled:
+                trace.record( self.db_type[:2], sql, start, -1 )
+            while True:
+                rows = cur.fetchmany(itersize)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            cur.close()
 
     def fetchall(self):
         """Returns the result of the previous execute as a list of tuples"""
@@ -70,6 +293,10 @@ class Db:
         """Returns on row of result of the previous execute as a tuple"""
         return self.cur.fetchone()
 
+    def fetchmany(self, size):
+        """Returns at most size rows of result of the previous execute"""
+        return self.cur.fetchmany(size)
+
     def commit(self):
         """Commit previous SQL command to DB, not necessary for SELECT"""
         if self._verbose:
@@ -80,7 +307,10 @@ class Db:
         self.con.commit()
 
     def close(self):
-        """Close DB connection"""
+        """Close DB connection, nothing is done if it is already closed"""
+        if self.closed:
+            return
+        self.closed = True
         if self.begun :
             if self._verbose:
                 print self.db_type, 'END;'
@@ -88,54 +318,243 @@ class Db:
                 self.log.write('END;\n')
         if self.log :
             self.log.write('-- closing connection\n')
-        self.con.close()
+        if self.session:
+            self.session.release(self.con)
+        else:
+            self.con.close()
+
+class Session:
+    """Pool of postgres connections shared by versioning operations
+
+    A session can be passed instead of the pg_conn_info string to all
+    functions of this module. Connections are then taken from the pool and
+    given back when the operation is done, so that successive operations
+    reuse the same physical connections. The pool holds at most maxconn
+    connections and must be released with close()"""
+    def __init__(self, pg_conn_info, maxconn = 2):
+        self.pg_conn_info = pg_conn_info
+        self.maxconn = maxconn
+        self.pool = psycopg2.pool.ThreadedConnectionPool(
+                1, maxconn, pg_conn_info)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def connect(self):
+        """Take a connection from the pool"""
+        return self.pool.getconn()
+
+    def release(self, con):
+        """Give a connection back to the pool, uncommited work is lost"""
+        if not con.closed:
+            con.rollback()
+        self.pool.putconn(con)
+
+    def close(self):
+        """Close all connections of the pool"""
+        self.pool.closeall()
+
+def pg_connect(pg_conn_info):
+    """Returns a Db on a postgres connection, pg_conn_info is either a
+    connection string or a Session to take the connection from"""
+    if isinstance(pg_conn_info, Session):
+        return Db(pg_conn_info.connect(), session=pg_conn_info)
+    return Db(psycopg2.connect(pg_conn_info))
+
+def pg_max_jobs(pg_conn_info, jobs):
+    """Returns jobs, capped for a Session so that the connections of the
+    workers and the one of the caller fit in its pool"""
+    if isinstance(pg_conn_info, Session):
+        return max(1, min(jobs, pg_conn_info.maxconn - 1))
+    return jobs
 
 def get_username():
     """Returns user name"""
     return getpass.getuser()
 
+# catalog metadata of versioned schemas, keyed by (dsn, schema) and
+# holding (token, metadata), see pg_metadata()
+_pg_metadata_cache = {}
+
+def pg_metadata( cur, schema ):
+    """Returns the catalog metadata of the relations of schema
+
+    The result is a dict with the list of branches under 'branches' and
+    a dict of relations under 'tables', each relation being described by
+    its kind ('r' for tables, 'v' for views, 'p' for partitioned tables),
+    its primary key 'pkey' (None if the relation has no primary key, the
+    first column if it has several), its 'columns' as a list
+    of (column_name, data_type, element_type) and its 'geoms' as a list
+    of (column_name, srid, type).
+
+    Metadata are fetched from pg_catalog with one query for the whole
+    schema and cached, the cache is invalidated when tables of the
+    schema or its branches change."""
+    if schema in cur.metadata:
+        return cur.metadata[schema]
+
+    # the xmin of catalog rows change with any DDL on the schema relations
+    cur.execute("SELECT COUNT(*), "
+            "SUM(c.xmin::text::bigint) + SUM(a.xmin::text::bigint) "
+        "FROM pg_class AS c "
+        "JOIN pg_namespace AS n ON n.oid = c.relnamespace "
+        "JOIN pg_attribute AS a ON a.attrelid = c.oid "
+        "WHERE n.nspname = '"+schema+"'")
+    token = cur.fetchone()
+    key = (cur.con.dsn, schema)
+    cached = _pg_metadata_cache.get(key)
+    if cached and cached[0] == token:
+        tables = cached[1]
+    else:
+        tables = pg_fetch_metadata( cur, schema )
+
+    branches = []
+    if 'revisions' in tables:
+        cur.execute("SELECT DISTINCT branch FROM "+schema+".revisions")
+        branches = [ res for [res] in cur.fetchall() ]
+
+    if not cached or cached[0] != token:
+        _pg_metadata_cache[key] = (token, tables)
+    cur.metadata[schema] = {'tables': tables, 'branches': branches}
+    return cur.metadata[schema]
+
+def pg_fetch_metadata( cur, schema ):
+    """Fetch the relations description of pg_metadata() from pg_catalog"""
+    cur.execute("SELECT c.relname, c.relkind, a.attname, "
+            "CASE WHEN t.typelem <> 0 AND t.typlen = -1 THEN 'ARRAY' "
+                "WHEN tn.nspname = 'pg_catalog' "
+                "THEN format_type(a.atttypid, NULL) "
+                "ELSE 'USER-DEFINED' END, "
+            "CASE WHEN t.typelem <> 0 AND t.typlen = -1 "
+                "THEN format_type(t.typelem, NULL) END, "
+            "COALESCE(a.attnum = ANY(pk.conkey), False), "
+            "g.srid, g.type, g.coord_dimension "
+        "FROM pg_class AS c "
+        "JOIN pg_namespace AS n ON n.oid = c.relnamespace "
+        "JOIN pg_attribute AS a "
+            "ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped "
+        "JOIN pg_type AS t ON t.oid = a.atttypid "
+        "JOIN pg_namespace AS tn ON tn.oid = t.typnamespace "
+        "LEFT JOIN pg_constraint AS pk "
+            "ON pk.conrelid = c.oid AND pk.contype = 'p' "
+        "LEFT JOIN geometry_columns AS g "
+            "ON g.f_table_schema = n.nspname "
+            "AND g.f_table_name = c.relname "
+            "AND g.f_geometry_column = a.attname "
+        "WHERE n.nspname = '"+schema+"' "
+        "AND c.relkind IN ('r', 'v', 'p') "
+        "ORDER BY c.relname, a.attnum")
+    tables = {}
+    for [table, kind, col, data_type, elem_type, is_pk, srid, geom_type,
+            coord_dimension] in cur.fetchall():
+        if table not in tables:
+            tables[table] = {'kind': kind, 'pkey': None,
+                    'columns': [], 'geoms': []}
+        tables[table]['columns'].append((col, data_type, elem_type))
+        if is_pk and not tables[table]['pkey']:
+            # the partitioning column comes second, see partition_history
+            tables[table]['pkey'] = col
+        if geom_type:
+            tables[table]['geoms'].append(
+                    (col, srid, geom_type, coord_dimension))
+    return tables
+
+def pg_invalidate_metadata( cur, schema ):
+    """Forget cached metadata of schema, to be called after DDL"""
+    cur.metadata.pop(schema, None)
+    _pg_metadata_cache.pop((cur.con.dsn, schema), None)
+
+def pg_table_metadata( cur, schema_name, table_name ):
+    """Returns the pg_metadata() description of the specified relation"""
+    tables = pg_metadata( cur, schema_name )['tables']
+    if table_name not in tables:
+        raise RuntimeError("table "+schema_name+"."+table_name+
+                " does not exist")
+    return tables[table_name]
+
+# tables of versioned schemas used by the versioning itself
+_bookkeeping_tables = ['revisions', 'revision_snapshots', 'diff_cache',
+        'changesets', 'working_copy_edits']
+
+def pg_versioned_tables( cur, schema ):
+    """Returns the sorted list of base tables of schema that are versioned,
+    i.e. all of them except the bookkeeping tables (revisions...)"""
+    tables = pg_metadata( cur, schema )['tables']
+    return sorted([ table for table in tables
+        if tables[table]['kind'] in ['r', 'p']
+        and table not in _bookkeeping_tables ])
+
+def pg_is_partitioned( cur, schema, table ):
+    """Returns True if the live and historical rows of schema.table are
+    stored in separate partitions, see partition_history"""
+    return pg_table_metadata( cur, schema, table )['kind'] == 'p'
+
+
+def pg_columns( cur, schema_name, table_name ):
+    """Fetch the list of (column_name, data_type) of the specified table"""
+    return [ (col, data_type) for [col, data_type, elem_type]
+            in pg_table_metadata( cur, schema_name, table_name )['columns'] ]
+
 def pg_pk( cur, schema_name, table_name ):
     """Fetch the primary key of the specified postgis table"""
-    cur.execute("SELECT c.column_name "
-        "FROM information_schema.table_constraints tc "
-        "JOIN information_schema.constraint_column_usage AS ccu "
-        "USING (constraint_schema, constraint_name) "
-        "JOIN information_schema.columns AS c "
-        "ON c.table_schema = tc.constraint_schema "
-        "AND tc.table_name = c.table_name "
-        "AND ccu.column_name = c.column_name "
-        "WHERE constraint_type = 'PRIMARY KEY' "
-        "AND tc.table_schema = '"+schema_name+"' "
-        "AND tc.table_name = '"+table_name+"'")
-    if not cur.hasrow():
+    tables = pg_metadata( cur, schema_name )['tables']
+    if table_name not in tables or not tables[table_name]['pkey']:
         raise RuntimeError("table "+schema_name+"."+table_name+
                 " does not have a primary key")
-    [pkey] = cur.fetchone()
-    return pkey
+    return tables[table_name]['pkey']
 
 def pg_array_elem_type( cur, schema, table, column ):
     """Fetch type of elements of a column of type ARRAY"""
-    cur.execute("SELECT e.data_type FROM information_schema.columns c "
-        "LEFT JOIN information_schema.element_types e "
-        "ON ((c.table_catalog, c.table_schema, c.table_name, "
-            "'TABLE', c.dtd_identifier) "
-        "= (e.object_catalog, e.object_schema, e.object_name, "
-            "e.object_type, e.collection_type_identifier)) "
-        "WHERE c.table_schema = '"+schema+"' "
-        "AND c.table_name = '"+table+"' "
-        "AND c.column_name = '"+column+"'")
-    if not cur.hasrow():
-        raise RuntimeError('column '+column+' of '
-                +schema+'.'+table+' is not an ARRAY')
-    [res] = cur.fetchone()
-    return res
+    for [col, data_type, elem_type] in \
+            pg_table_metadata( cur, schema, table )['columns']:
+        if col == column and data_type == 'ARRAY':
+            return elem_type
+    raise RuntimeError('column '+column+' of '
+            +schema+'.'+table+' is not an ARRAY')
 
 def pg_geoms( cur, schema_name, table_name ):
     """Fetch the list of geometry column of the specified postgis table, empty if none"""
-    cur.execute("SELECT f_geometry_column FROM geometry_columns "
-        "WHERE f_table_schema = '"+schema_name+"' "
-        "AND f_table_name = '"+table_name+"'")
-    return [ geo[0] for geo in cur.fetchall() ]
+    return [ geo for [geo, srid, geom_type, coord_dimension]
+            in pg_table_metadata( cur, schema_name, table_name )['geoms'] ]
+
+def pg_geom_type( cur, schema_name, table_name, geom ):
+    """Fetch the srid and type of a geometry column, [None, None] if the
+    table has no such geometry column"""
+    for [geo, srid, geom_type, coord_dimension] in \
+            pg_table_metadata( cur, schema_name, table_name )['geoms']:
+        if geo == geom:
+            return [srid, geom_type]
+    return [None, None]
+
+def pg_coord_dimension( cur, schema_name, table_name, geom ):
+    """Fetch the coordinate dimension of a geometry column as 'XY', 'XYZ',
+    'XYM' or 'XYZM', None if the table has no such geometry column"""
+    for [geo, srid, geom_type, coord_dimension] in \
+            pg_table_metadata( cur, schema_name, table_name )['geoms']:
+        if geo == geom:
+            # postgis reports measured types as e.g. LINESTRINGM
+            if coord_dimension == 3 and geom_type.endswith('M'):
+                return 'XYM'
+            return {2: 'XY', 3: 'XYZ', 4: 'XYZM'}.get(coord_dimension, 'XY')
+    return None
+
+def pg_typmod( geom_type, coord_dimension ):
+    """Returns the postgis typmod of a geometry type, e.g. LINESTRINGZ"""
+    if coord_dimension == 'XYZ':
+        return geom_type+'Z'
+    elif coord_dimension == 'XYZM':
+        return geom_type+'ZM'
+    return geom_type
+
+def sp_geom_type( geom_type, coord_dimension ):
+    """Returns the spatialite name of a postgis geometry type, the
+    dimension is given apart, e.g. LINESTRING for LINESTRINGM"""
+    if coord_dimension == 'XYM':
+        return geom_type[:-1]
+    return geom_type
 
 def pg_geom( cur, schema_name, table_name ):
     """Fetch the first geometry column of the specified postgis table, empty string if none"""
@@ -160,6 +579,766 @@ def pg_geom( cur, schema_name, table_name ):
             ' but the environment variable VERSIONING_GEOMETRY_COLUMN '
             'is not defined and the geometry column name is not geometry')
 
+def sp_type( data_type ):
+    """Returns the spatialite column type for a postgres data_type"""
+    if data_type in ['integer', 'smallint', 'bigint', 'boolean']:
+        return 'INTEGER'
+    elif data_type in ['real', 'double precision', 'numeric']:
+        return 'FLOAT'
+    elif data_type == 'date':
+        return 'DATE'
+    elif data_type.startswith('timestamp'):
+        return 'DATETIME'
+    else:
+        return 'VARCHAR'
+
+def sp_pg_mapping( sp_cols, pkey, pgeom, pg_cols ):
+    """Returns the list of (spatialite column, postgres column, kind) for
+    the spatialite columns sp_cols that exist in pg_cols, a list of (name,
+    data_type) as returned by pg_columns. OGC_FID is mapped to pkey and
+    GEOMETRY to pgeom, kind is 'pkey', 'geometry' or the postgres data_type"""
+    pg_types = dict(pg_cols)
+    mapping = []
+    for col in sp_cols:
+        if col.upper() == 'OGC_FID':
+            mapping.append( (col, pkey, 'pkey') )
+        elif col.upper() == 'GEOMETRY':
+            if pgeom:
+                mapping.append( (col, pgeom, 'geometry') )
+        elif col in pg_types:
+            mapping.append( (col, col, pg_types[col]) )
+    return mapping
+
+def sp_pg_columns( scur, sp_table, pkey, pgeom, pg_cols ):
+    """Returns the mapping of the columns of sp_table to pg_cols, see
+    sp_pg_mapping"""
+    scur.execute("PRAGMA table_info("+sp_table+")")
+    return sp_pg_mapping( [res[1] for res in scur.fetchall()],
+            pkey, pgeom, pg_cols )
+
+def sp_create_like( scur, table, new_table ):
+    """Create an empty spatialite table new_table with the same columns and
+    geometry as table, returns True if the table has a geometry.
+    Creating the table with CREATE TABLE... AS SELECT won't work, types
+    get fubared in the process, therefore we copy the creation statement
+    from spatialite master and change the table name, we add the geometry
+    column to geometry_columns manually"""
+    scur.execute("DROP TABLE IF EXISTS "+new_table)
+    scur.execute("DROP TABLE IF EXISTS idx_"+new_table+"_GEOMETRY")
+    scur.execute("DELETE FROM geometry_columns "
+        "WHERE f_table_name = '"+new_table+"'")
+    scur.execute("SELECT sql FROM sqlite_master "
+        "WHERE tbl_name = '"+table+"' AND type = 'table'")
+    [sql] = scur.fetchone()
+    sql = unicode.replace(sql, table, new_table, 1)
+    scur.execute(sql)
+    geom = (sql.find('GEOMETRY') != -1)
+    if geom:
+        scur.execute("INSERT INTO geometry_columns "
+            "SELECT '"+new_table+"', 'geometry', geometry_type, "
+            "coord_dimension, srid, spatial_index_enabled "
+            "FROM geometry_columns WHERE f_table_name = '"+table+"'")
+    return geom
+
+def wkb_to_ewkb( wkb, srid ):
+    """Returns the hex encoded EWKB of a WKB geometry, i.e. the WKB with the
+    srid flag and value, postgis accepts it as geometry text input"""
+    wkb = str(wkb)
+    endian = '<' if wkb[0] == '\x01' else '>'
+    [geom_type] = struct.unpack(endian+'I', wkb[1:5])
+    return (wkb[0] + struct.pack(endian+'I', geom_type | 0x20000000)
+            + struct.pack(endian+'i', srid) + wkb[5:]).encode('hex')
+
+def print_throughput( what, count, start ):
+    """Print the number of rows per second since start"""
+    elapsed = time.time() - start
+    print what, count, "rows in %.2fs"%elapsed,
+    print "(%d rows/s)"%(count/elapsed if elapsed else count)
+
+class CopyReader:
+    """File like object parsing the binary output of a postgres COPY TO,
+    values are converted with the converters (one per column) and rows are
+    passed by batches to the callback function"""
+    def __init__(self, converters, callback, batch_size = 10000):
+        self.converters = converters
+        self.callback = callback
+        self.batch_size = batch_size
+        self.buf = ''
+        self.header = True
+        self.rows = []
+        self.count = 0
+
+    def write(self, data):
+        """Parse a chunk of data, incomplete rows are kept for the next one"""
+        buf = self.buf + data
+        end = len(buf)
+        pos = 0
+        if self.header:
+            # signature, flags and header extension length
+            if end < 19:
+                self.buf = buf
+                return
+            [ext_len] = struct.unpack_from('!i', buf, 15)
+            if end < 19 + ext_len:
+                self.buf = buf
+                return
+            pos = 19 + ext_len
+            self.header = False
+        while pos + 2 <= end:
+            [nb_fields] = struct.unpack_from('!h', buf, pos)
+            if nb_fields == -1: # trailer
+                pos += 2
+                break
+            row = []
+            cur = pos + 2
+            for convert in self.converters:
+                if cur + 4 > end:
+                    break
+                [length] = struct.unpack_from('!i', buf, cur)
+                cur += 4
+                if length == -1:
+                    row.append(None)
+                    continue
+                if cur + length > end:
+                    break
+                row.append(convert(buf[cur:cur+length]))
+                cur += length
+            if len(row) != len(self.converters):
+                break
+            pos = cur
+            self.rows.append(row)
+            if len(self.rows) >= self.batch_size:
+                self.flush()
+        self.buf = buf[pos:]
+
+    def flush(self):
+        """Pass the pending rows to the callback"""
+        if self.rows:
+            self.callback(self.rows)
+            self.count += len(self.rows)
+            self.rows = []
+
+class CopyWriter:
+    """File like object producing the text input of a postgres COPY FROM
+    from the rows of the previous execute on a spatialite Db, values are
+    converted with the converters (one per column) and rows are fetched
+    by batches"""
+    def __init__(self, scur, converters, batch_size = 10000):
+        self.scur = scur
+        self.converters = converters
+        self.batch_size = batch_size
+        self.buf = ''
+        self.done = False
+        self.count = 0
+
+    def read(self, size = -1):
+        """Returns at most size bytes of COPY data, all if size < 0"""
+        while not self.done and (size < 0 or len(self.buf) < size):
+            rows = self.scur.fetchmany(self.batch_size)
+            if not rows:
+                self.done = True
+                break
+            lines = []
+            for row in rows:
+                lines.append('\t'.join([ '\\N' if value is None
+                    else convert(value)
+                    for convert, value in zip(self.converters, row) ]))
+            self.buf += '\n'.join(lines)+'\n'
+            self.count += len(rows)
+        if size < 0:
+            size = len(self.buf)
+        data = self.buf[:size]
+        self.buf = self.buf[size:]
+        return data
+
+def pg_to_sp_statements( pcur, pg_table, where, sp_table, mapping, srid ):
+    """Returns the COPY statement, the value converters and the INSERT
+    statement to copy rows of postgres pg_table (schema.table) satisfying
+    where (all if None) into spatialite sp_table, mapping is given by
+    sp_pg_columns. Rows are streamed with a binary COPY, the geometry as WKB"""
+    encoding = psycopg2.extensions.encodings[pcur.con.encoding]
+    def to_unicode(value):
+        return value.decode(encoding)
+    exprs = []
+    converters = []
+    placeholders = []
+    for [sp_col, pg_col, kind] in mapping:
+        col = quote_ident(pg_col)
+        placeholders.append('?')
+        if kind == 'geometry':
+            exprs.append("ST_AsBinary("+col+")")
+            converters.append(dbapi2.Binary)
+            placeholders[-1] = "GeomFromWKB(?, "+str(srid)+")"
+        elif kind == 'pkey':
+            exprs.append(col+"::text")
+            converters.append(int)
+        elif kind == 'ARRAY':
+            # list format used by ogr in spatialite (count:values)
+            exprs.append("'('||array_length("+col+", 1)||':'"
+                "||array_to_string("+col+", ',')||')'")
+            converters.append(to_unicode)
+        elif kind == 'boolean':
+            exprs.append(col+"::int::text")
+            converters.append(to_unicode)
+        else:
+            # spatialite type affinity takes care of numbers
+            exprs.append(col+"::text")
+            converters.append(to_unicode)
+
+    copy = ("COPY (SELECT "+', '.join(exprs)+" FROM "+pg_table+
+        (" WHERE "+where if where else "")+") TO STDOUT WITH BINARY")
+    insert = ("INSERT INTO "+sp_table+" ("
+        +', '.join([quote_ident(m[0]) for m in mapping])+") "
+        "VALUES ("+', '.join(placeholders)+")")
+    return [copy, converters, insert]
+
+def pg_to_sp( pcur, pg_table, where, scur, sp_table, mapping, srid ):
+    """Copy rows of postgres pg_table (schema.table) satisfying where (all
+    if None) into spatialite sp_table, mapping is given by sp_pg_columns.
+    Rows are inserted by batches, returns the number of rows copied"""
+    [copy, converters, insert] = pg_to_sp_statements( pcur, pg_table, where,
+            sp_table, mapping, srid )
+    reader = CopyReader(converters,
+            lambda rows: scur.executemany(insert, rows))
+    start = time.time()
+    pcur.copy_expert(copy, reader)
+    reader.flush()
+    print_throughput("copied "+pg_table+" to "+sp_table+":",
+            reader.count, start)
+    return reader.count
+
+def pg_begin_snapshot( pcur, snapshot = None ):
+    """Begin a repeatable read transaction, if snapshot is specified (see
+    pg_export_snapshot) the transaction sees the same data as the one that
+    exported it. Must be called before any other command of the transaction"""
+    pcur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+    if snapshot:
+        pcur.execute("SET TRANSACTION SNAPSHOT '"+snapshot+"'")
+
+def pg_export_snapshot( pcur ):
+    """Returns the identifier of the snapshot of the current transaction,
+    it can be imported by other transactions until this one ends"""
+    pcur.execute("SELECT pg_export_snapshot()")
+    [snapshot] = pcur.fetchone()
+    return snapshot
+
+def pg_to_sp_worker( pg_conn_info, snapshot, tasks, results, phase ):
+    """Thread of pg_to_sp_parallel, copy tables until the tasks queue is
+    empty and put batches of rows in the results queue, ends by putting
+    (None, None), or (None, error) if something went wrong. Statements are
+    traced in phase, the (operation, phase) of the calling thread"""
+    trace.phase( *phase )
+    try:
+        pcur = pg_connect(pg_conn_info)
+        try:
+            pg_begin_snapshot( pcur, snapshot )
+            while True:
+                try:
+                    [pg_table, [copy, converters, insert]] = tasks.get_nowait()
+                except Queue.Empty:
+                    break
+                reader = CopyReader(converters,
+                        lambda rows, insert=insert: results.put(
+                            (insert, rows)))
+                start = time.time()
+                pcur.copy_expert(copy, reader)
+                reader.flush()
+                print_throughput("copied "+pg_table+":", reader.count, start)
+        finally:
+            pcur.close()
+    except Exception as error:
+        results.put( (None, error) )
+        return
+    results.put( (None, None) )
+
+def pg_to_sp_parallel( pg_conn_info, snapshot, copies, scur, jobs ):
+    """Run the copies, a list of (pg_table, statements) where statements are
+    returned by pg_to_sp_statements, with jobs threads, each with its own
+    postgres connection importing snapshot (see pg_begin_snapshot).
+    The rows are inserted in spatialite by the calling thread which is the
+    only writer, returns the number of rows copied"""
+    tasks = Queue.Queue()
+    for copy in copies:
+        tasks.put(copy)
+    # bounded to keep the memory in check if spatialite is the bottleneck
+    results = Queue.Queue(4*jobs)
+    threads = [ threading.Thread(target=pg_to_sp_worker,
+                    args=(pg_conn_info, snapshot, tasks, results,
+                        trace.current()))
+                for i in range(min(jobs, len(copies))) ]
+    for thread in threads:
+        thread.start()
+
+    def cancel():
+        """stop the other workers once their current table is done"""
+        while not tasks.empty():
+            try:
+                tasks.get_nowait()
+            except Queue.Empty:
+                pass
+
+    start = time.time()
+    count = 0
+    error = None
+    finished = 0
+    try:
+        while finished < len(threads):
+            [insert, rows] = results.get()
+            if insert is None:
+                finished += 1
+                if rows is not None and not error:
+                    error = rows
+                    cancel()
+            elif not error:
+                scur.executemany(insert, rows)
+                count += len(rows)
+    finally:
+        # on a spatialite error, the workers blocked on the full results
+        # queue must be drained until they end
+        if finished < len(threads):
+            cancel()
+            while finished < len(threads):
+                if results.get()[0] is None:
+                    finished += 1
+        for thread in threads:
+            thread.join()
+    if error:
+        raise error
+    print_throughput("copied "+str(len(copies))+" tables with "
+            +str(len(threads))+" jobs:", count, start)
+    return count
+
+def pg_parallel_worker( pg_conn_info, tasks, results, phase ):
+    """Thread of pg_parallel, run tasks until the tasks queue is empty, each
+    in its own transaction, and put (name, seconds, None) in the results
+    queue for each, (name, None, error) on failure. Ends by putting
+    (None, None, None), or (None, None, error) if it cannot connect.
+    Statements are traced in phase, as for pg_to_sp_worker"""
+    trace.phase( *phase )
+    try:
+        pcur = pg_connect(pg_conn_info)
+    except Exception as error:
+        results.put( (None, None, error) )
+        return
+    try:
+        while True:
+            try:
+                [name, task] = tasks.get_nowait()
+            except Queue.Empty:
+                break
+            start = time.time()
+            try:
+                task( pcur )
+                pcur.commit()
+            except Exception as error:
+                pcur.con.rollback()
+                results.put( (name, None, error) )
+                break
+            results.put( (name, time.time() - start, None) )
+    finally:
+        pcur.close()
+    results.put( (None, None, None) )
+
+def pg_parallel( pg_conn_info, tasks, jobs ):
+    """Run tasks, a list of (name, function of a Db), with jobs threads each
+    with its own postgres connection, every task is committed on its own.
+    No task is started after the first error. Returns the list of
+    (name, seconds) of the tasks done and the first error, None if all
+    tasks succeeded"""
+    queue = Queue.Queue()
+    for task in tasks:
+        queue.put(task)
+    results = Queue.Queue()
+    threads = [ threading.Thread(target=pg_parallel_worker,
+                    args=(pg_conn_info, queue, results, trace.current()))
+                for i in range(min(jobs, len(tasks))) ]
+    for thread in threads:
+        thread.start()
+
+    start = time.time()
+    done = []
+    error = None
+    finished = 0
+    while finished < len(threads):
+        [name, seconds, failure] = results.get()
+        if name is None:
+            finished += 1
+        elif not failure:
+            print name, "in %.2fs"%seconds
+            done.append( (name, seconds) )
+        if failure and not error:
+            error = failure
+            while not queue.empty():
+                try:
+                    queue.get_nowait()
+                except Queue.Empty:
+                    pass
+    for thread in threads:
+        thread.join()
+    print len(done), "tasks with", len(threads), "jobs",
+    print "in %.2fs"%(time.time() - start)
+    return [done, error]
+
+def sp_to_pg( scur, sp_table, where, pcur, pg_table, mapping, srid ):
+    """Copy rows of spatialite sp_table satisfying where (all if None) into
+    postgres pg_table (schema.table), mapping is given by sp_pg_columns.
+    Rows are fetched by batches and streamed with a text COPY, the geometry
+    as EWKB, returns the number of rows copied"""
+    exprs = []
+    for [sp_col, pg_col, kind] in mapping:
+        exprs.append(quote_ident(sp_col))
+        if kind == 'geometry':
+            exprs[-1] = "AsBinary("+quote_ident(sp_col)+")"
+
+    scur.execute("SELECT "+', '.join(exprs)+" FROM "+sp_table+
+            (" WHERE "+where if where else ""))
+    writer = CopyWriter(scur, sp_to_pg_converters( pcur, mapping, srid ))
+    start = time.time()
+    pcur.copy_expert("COPY "+pg_table+" ("
+        +', '.join([quote_ident(m[1]) for m in mapping])+") FROM STDIN",
+        writer)
+    print_throughput("copied "+sp_table+" to "+pg_table+":",
+            writer.count, start)
+    return writer.count
+
+def sp_to_pg_converters( pcur, mapping, srid ):
+    """Returns the functions converting spatialite values to the text input
+    of a postgres COPY, one per column of mapping, geometries are given as
+    WKB"""
+    encoding = psycopg2.extensions.encodings[pcur.con.encoding]
+    def to_text(value):
+        if isinstance(value, float):
+            return repr(value)
+        if isinstance(value, unicode):
+            value = value.encode(encoding)
+        else:
+            value = str(value)
+        return value.replace('\\', '\\\\').replace('\n', '\\n')\
+                .replace('\r', '\\r').replace('\t', '\\t')
+    def to_array(value):
+        # ogr list format (count:values) to postgres array
+        return to_text(re.sub(r'\)$', '}', re.sub(r'^\([0-9]*:', '{',
+            unicode(value))))
+    converters = []
+    for [sp_col, pg_col, kind] in mapping:
+        if kind == 'geometry':
+            converters.append(lambda value: wkb_to_ewkb(value, srid))
+        elif kind == 'ARRAY':
+            converters.append(to_array)
+        else:
+            converters.append(to_text)
+    return converters
+
+def pg_staging():
+    """Returns how diffs are staged in postgres, as set by the
+    VERSIONING_STAGING environment variable: 'temp' (the default) for
+    temporary tables dropped at the end of the transaction, 'unlogged' for
+    unlogged tables in a schema dropped at the end of the operation"""
+    staging = os.environ.get('VERSIONING_STAGING', 'temp')
+    if staging not in ['temp', 'unlogged']:
+        raise RuntimeError("VERSIONING_STAGING must be 'temp' or 'unlogged', "
+                "not '"+staging+"'")
+    return staging
+
+def pg_create_staging( pcur, schema, name, select ):
+    """Create the staging table name as the result of select and returns
+    its qualified name. The table is created in schema (created if
+    needed) if the staging mode is 'unlogged', in pg_temp otherwise,
+    see pg_staging"""
+    if pg_staging() == 'unlogged':
+        pcur.execute("SELECT schema_name FROM information_schema.schemata "
+            "WHERE schema_name = '"+schema+"'")
+        if not pcur.fetchone():
+            pcur.execute("CREATE SCHEMA "+schema)
+        pcur.execute("DROP TABLE IF EXISTS "+schema+"."+name)
+        pcur.execute("CREATE UNLOGGED TABLE "+schema+"."+name+" AS "+select)
+        return schema+"."+name
+    pcur.execute("DROP TABLE IF EXISTS pg_temp."+name)
+    pcur.execute("CREATE TEMP TABLE "+name+" ON COMMIT DROP AS "+select)
+    return "pg_temp."+name
+
+def pg_selection( pcur, schema, table, extent, sql_filter ):
+    """Returns the SQL predicate selecting the rows of schema.table for a
+    partial checkout, None if all rows are selected.
+    extent is a (xmin, ymin, xmax, ymax) tuple or a WKT polygon in the srid
+    of the table, it is ignored if the table has no geometry.
+    sql_filter is an SQL expression on the columns of the table"""
+    predicates = []
+    pgeom = pg_geom( pcur, schema, table ) if extent else None
+    if pgeom:
+        srid = str(pg_geom_type( pcur, schema, table, pgeom )[0])
+        if isinstance(extent, (tuple, list)):
+            [xmin, ymin, xmax, ymax] = [repr(float(x)) for x in extent]
+            geom = ("ST_MakeEnvelope("+xmin+", "+ymin+", "
+                    +xmax+", "+ymax+", "+srid+")")
+        else:
+            geom = "ST_GeomFromText('"+escape_quote(extent)+"', "+srid+")"
+        predicates.append("ST_Intersects("+quote_ident(pgeom)+", "+geom+")")
+    if sql_filter:
+        predicates.append("("+sql_filter+")")
+    return ' AND '.join(predicates) if predicates else None
+
+def pg_diff_selection( table_schema, table, pkey, branch, rev,
+        selection, local_pks ):
+    """Returns the condition on the rows of table_schema.table changed since
+    rev. For a partial working copy (i.e. selection is not None) only rows
+    matching the selection or whose pkey is returned by the local_pks query
+    are kept, along with their children"""
+    diff = (branch+"_rev_end = "+str(rev)+" "
+            "OR "+branch+"_rev_begin > "+str(rev))
+    if not selection:
+        return diff
+    return ("("+diff+") AND "+pkey+" IN ("
+        "WITH RECURSIVE sel(pk, child) AS ("
+            "SELECT "+pkey+", "+branch+"_child "
+            "FROM "+table_schema+"."+table+" "
+            "WHERE ("+diff+") "
+            "AND (("+selection+") OR "+pkey+" IN ("+local_pks+")) "
+            "UNION "
+            "SELECT t."+pkey+", t."+branch+"_child "
+            "FROM "+table_schema+"."+table+" AS t, sel "
+            "WHERE t."+pkey+" = sel.child) "
+        "SELECT pk FROM sel)")
+
+def pg_diff_source( pcur, table_schema, table, branch, rev, max_rev,
+        selection ):
+    """Returns the table and condition of the rows of the diff of branch
+    from rev to max_rev of table_schema.table, for a partial working copy
+    the pkeys of its local features must be in the temporary table
+    versioning_local_pks"""
+    pkey = pg_pk( pcur, table_schema, table )
+    where = pg_diff_selection( table_schema, table, pkey, branch, rev,
+            selection, "SELECT pk FROM versioning_local_pks" )
+    # the diff of a full working copy is shared by all working copies
+    # updated over the same range
+    if not selection:
+        cached = pg_diff_cache( pcur, table_schema, table, branch,
+                rev, max_rev, where )
+        if cached:
+            return [cached, None]
+    return [table_schema+"."+table, where]
+
+def sp_upgrade_initial_revision( scur ):
+    """Add the selection column to initial_revision of working copies
+    created before partial checkout"""
+    scur.execute("PRAGMA table_info(initial_revision)")
+    if 'selection' not in [res[1] for res in scur.fetchall()]:
+        scur.execute("ALTER TABLE initial_revision ADD COLUMN selection TEXT")
+        scur.commit()
+
+def pg_upgrade_initial_revision( pcur, wcs ):
+    """Add the selection column to initial_revision of postgres working
+    copies created before partial checkout"""
+    pcur.execute("SELECT column_name FROM information_schema.columns "
+        "WHERE table_schema = '"+wcs+"' AND table_name = 'initial_revision' "
+        "AND column_name = 'selection'")
+    if not pcur.fetchone():
+        pcur.execute("ALTER TABLE "+wcs+".initial_revision "
+            "ADD COLUMN selection text")
+        pcur.commit()
+
+def sp_update_fid_counter( scur, table, max_pk ):
+    """Set the last feature id allocated by the triggers of table to the
+    max of max_pk and the ids in table, nothing is done for working copies
+    created before the counter or allocating from a reserved block (see
+    sp_fid_block)"""
+    scur.execute("SELECT name FROM sqlite_master "
+        "WHERE type = 'table' AND name = 'fid_counter'")
+    if scur.fetchone() and sp_fid_block( scur, table ) is None:
+        scur.execute("UPDATE fid_counter "
+            "SET last_fid = MAX("+str(max_pk)+", "
+                "IFNULL((SELECT MAX(OGC_FID) FROM "+table+"), 0)) "
+            "WHERE table_name = '"+table+"'")
+
+def pg_fid_block():
+    """Returns the number of feature ids reserved at once for the inserts
+    in a table of a spatialite working copy, set by the VERSIONING_FID_BLOCK
+    environment variable, 10000 by default"""
+    return int(os.environ.get('VERSIONING_FID_BLOCK', 10000))
+
+def pg_pk_sequence( pcur, schema, table, sync = False ):
+    """Returns the sequence of the primary key of schema.table, None if it
+    has none. With sync, the table is locked (see pg_reserve_pks) and the
+    sequence is moved past the pkeys of the table that did not come from
+    it (committed by working copies created before the reservation of
+    pkeys), to be done once at checkout"""
+    pkey = pg_pk( pcur, schema, table )
+    pcur.execute("SELECT pg_get_serial_sequence("
+        "'"+schema+"."+table+"', '"+pkey+"')")
+    [seq] = pcur.fetchone()
+    if seq and sync:
+        pcur.execute("LOCK TABLE "+schema+"."+table+" "
+            "IN SHARE ROW EXCLUSIVE MODE")
+        pcur.execute("SELECT setval('"+seq+"', m) "
+            "FROM (SELECT MAX("+pkey+") AS m "
+                "FROM "+schema+"."+table+") AS src, "+seq+" AS s "
+            "WHERE m > s.last_value "
+            "OR (m = s.last_value AND NOT s.is_called)")
+    return seq
+
+def pg_reserve_pks( pcur, schema, table, size, sync = False ):
+    """Reserve size consecutive pkeys of schema.table from the sequence of
+    its primary key, the sequence will not allocate them anymore, sync as
+    in pg_pk_sequence. Returns [first, last], None if the pkey has no
+    sequence. The table is locked in SHARE ROW EXCLUSIVE mode so that
+    neither inserts using the sequence default nor other reservations
+    (see also pg_install_wc_functions) take ids in between, the lock is
+    held until the end of the transaction which should be committed soon"""
+    seq = pg_pk_sequence( pcur, schema, table, sync )
+    if not seq:
+        return None
+    pcur.execute("LOCK TABLE "+schema+"."+table+" "
+        "IN SHARE ROW EXCLUSIVE MODE")
+    pcur.execute("SELECT nextval('"+seq+"')")
+    [first] = pcur.fetchone()
+    if size > 1:
+        pcur.execute("SELECT setval('"+seq+"', "+str(first+size-1)+")")
+    return [first, first+size-1]
+
+def sp_fid_block( scur, table ):
+    """Returns the last feature id of the block reserved on the server for
+    the inserts in table (see pg_reserve_pks), None for working copies
+    created before the reservation or tables whose pkey has no sequence"""
+    scur.execute("PRAGMA table_info(fid_counter)")
+    if 'max_fid' not in [col[1] for col in scur.fetchall()]:
+        return None
+    scur.execute("SELECT max_fid FROM fid_counter "
+        "WHERE table_name = '"+table+"'")
+    res = scur.fetchone()
+    return res[0] if res else None
+
+def sp_use_fid_block( scur, table, branch, rev_begin, first, last ):
+    """Make first..last the block of feature ids reserved for the inserts
+    in table. The features inserted in revision rev_begin with ids above
+    the previous block, allocated once it was exhausted, are renumbered
+    from first in the order of their ids, the other features keep their
+    ids"""
+    max_fid = sp_fid_block( scur, table )
+    scur.execute("DROP TABLE IF EXISTS fid_map")
+    scur.execute("CREATE TEMP TABLE fid_map "
+        "(new_fid INTEGER PRIMARY KEY, old_fid INTEGER UNIQUE)")
+    scur.execute("INSERT INTO fid_map (old_fid) "
+        "SELECT OGC_FID FROM "+table+" "
+        "WHERE OGC_FID > "+str(max_fid)+" "
+        "AND "+branch+"_rev_begin = "+str(rev_begin)+" "
+        "ORDER BY OGC_FID")
+    scur.execute("SELECT COUNT(*) FROM fid_map")
+    [nb] = scur.fetchone()
+    if first + nb - 1 > last:
+        scur.execute("DROP TABLE fid_map")
+        raise RuntimeError("Not enough feature ids reserved for the "
+                +str(nb)+" features inserted in "+table)
+    if nb:
+        new = ("(SELECT new_fid + "+str(first-1)+" "
+            "FROM fid_map WHERE old_fid = ")
+        # negative ids first, see sp_merge_diff
+        scur.execute("UPDATE "+table+" SET OGC_FID = -OGC_FID "
+            "WHERE OGC_FID IN (SELECT old_fid FROM fid_map)")
+        scur.execute("UPDATE "+table+" SET OGC_FID = "+new+"-OGC_FID) "
+            "WHERE OGC_FID < 0")
+        for col in [branch+"_parent", branch+"_child"]:
+            scur.execute("UPDATE "+table+" SET "+col+" = "+new+col+") "
+                "WHERE "+col+" IN (SELECT old_fid FROM fid_map)")
+        if sp_has_journal( scur, table ):
+            scur.execute("UPDATE "+table+"_dirty SET OGC_FID = -OGC_FID "
+                "WHERE OGC_FID IN (SELECT old_fid FROM fid_map)")
+            scur.execute("UPDATE "+table+"_dirty "
+                "SET OGC_FID = "+new+"-OGC_FID) WHERE OGC_FID < 0")
+    scur.execute("DROP TABLE fid_map")
+    scur.execute("UPDATE fid_counter "
+        "SET last_fid = "+str(first+nb-1)+", max_fid = "+str(last)+" "
+        "WHERE table_name = '"+table+"'")
+
+def sp_refill_fid_block( scur, pcur, schema, table, branch, rev ):
+    """Reserve a new block of feature ids for the inserts in table if the
+    current one is half used, or exhausted and features were inserted
+    above it since rev (they are renumbered in the new block, see
+    sp_use_fid_block). The transaction of pcur is committed to release
+    the lock of the reservation. Nothing is done for working copies
+    without reserved block"""
+    max_fid = sp_fid_block( scur, table )
+    if max_fid is None:
+        return
+    scur.execute("SELECT last_fid FROM fid_counter "
+        "WHERE table_name = '"+table+"'")
+    [last_fid] = scur.fetchone()
+    scur.execute("SELECT COUNT(*) FROM "+table+" "
+        "WHERE OGC_FID > "+str(max_fid)+" "
+        "AND "+branch+"_rev_begin = "+str(rev+1))
+    [nb] = scur.fetchone()
+    if not nb and 2*(max_fid - last_fid) >= pg_fid_block():
+        return
+    block = pg_reserve_pks( pcur, schema, table, nb + pg_fid_block() )
+    pcur.commit()
+    sp_use_fid_block( scur, table, branch, rev+1, block[0], block[1] )
+
+def conflicts_query( mine, theirs, conflicts, conflict_pk, pkey, branch,
+        columns ):
+    """Returns the query listing the conflicts between the tables mine and
+    theirs for the pkeys in column conflict_pk of the view conflicts, valid
+    for postgres and spatialite. The conflict_id is the conflicting pkey,
+    'theirs' modifications are followed to their last descendant with a
+    recursive query, whatever the number of editions"""
+    def qualified( alias ):
+        return ', '.join([alias+"."+quote_ident(col) for col in columns])
+    return (
+        "WITH RECURSIVE chain(conflict_id, pk) AS ("
+            "SELECT cflt."+conflict_pk+", t."+branch+"_child "
+            "FROM "+theirs+" AS t, "+conflicts+" AS cflt "
+            "WHERE t."+pkey+" = cflt."+conflict_pk+" "
+            "AND t."+branch+"_child IS NOT NULL "
+            "UNION ALL "
+            "SELECT chain.conflict_id, t."+branch+"_child "
+            "FROM "+theirs+" AS t, chain "
+            "WHERE t."+pkey+" = chain.pk "
+            "AND t."+branch+"_child IS NOT NULL) "
+        # modified features from mine
+        "SELECT cflt."+conflict_pk+" AS conflict_id, 'mine' AS origin, "
+            "'modified' AS action, "+qualified('m')+" "
+        "FROM "+mine+" AS m, "+mine+" AS p, "+conflicts+" AS cflt "
+        "WHERE p."+pkey+" = cflt."+conflict_pk+" "
+        "AND m."+pkey+" = p."+branch+"_child "
+        # last descendant of modified features from theirs
+        "UNION ALL "
+        "SELECT chain.conflict_id, 'theirs', "
+            "CASE WHEN t."+branch+"_rev_end IS NULL "
+            "THEN 'modified' ELSE 'deleted' END, "+qualified('t')+" "
+        "FROM "+theirs+" AS t, chain "
+        "WHERE t."+pkey+" = chain.pk "
+        "AND t."+branch+"_child IS NULL "
+        # deleted features from mine
+        "UNION ALL "
+        "SELECT cflt."+conflict_pk+", 'mine', 'deleted', "+qualified('m')+" "
+        "FROM "+mine+" AS m, "+conflicts+" AS cflt "
+        "WHERE m."+pkey+" = cflt."+conflict_pk+" "
+        "AND m."+branch+"_child IS NULL "
+        # deleted features from theirs
+        "UNION ALL "
+        "SELECT cflt."+conflict_pk+", 'theirs', 'deleted', "+qualified('t')+" "
+        "FROM "+theirs+" AS t, "+conflicts+" AS cflt "
+        "WHERE t."+pkey+" = cflt."+conflict_pk+" "
+        "AND t."+branch+"_child IS NULL")
+
+def sp_has_journal( scur, table ):
+    """Returns True if the triggers record the edited features of table in
+    <table>_dirty, working copies created before the journal don't"""
+    scur.execute("SELECT name FROM sqlite_master "
+        "WHERE type = 'table' AND name = '"+table+"_dirty'")
+    return scur.fetchone() is not None
+
+def sp_diff_where( scur, table, branch, rev ):
+    """Returns the condition on the rows of the working copy table to
+    commit since rev and whether the table has a journal"""
+    diff_where = (branch+"_rev_end = "+str(rev)+" "
+            "OR "+branch+"_rev_begin > "+str(rev))
+    # with a journal, only the features touched since the last commit
+    # are looked at, by primary key
+    journal = sp_has_journal( scur, table )
+    if journal:
+        diff_where = ("OGC_FID IN (SELECT OGC_FID FROM "+table+"_dirty) "
+                "AND ("+diff_where+")")
+    return [diff_where, journal]
+
 def unresolved_conflicts(sqlite_filename):
     """return a list of tables with unresolved conflicts"""
     found = []
@@ -175,13 +1354,20 @@ def unresolved_conflicts(sqlite_filename):
     scur.close()
     return found
 
-def checkout(pg_conn_info, pg_table_names, sqlite_filename):
+def checkout(pg_conn_info, pg_table_names, sqlite_filename, jobs = 1,
+        extent = None, filters = None):
     """create working copy from versioned database tables
     pg_table_names must be complete schema.table names
     the schema name must end with _branch_rev_head
     the file sqlite_filename must not exists
     the views and trigger for local edition will be created
-    along with the tables and triggers for conflict resolution"""
+    along with the tables and triggers for conflict resolution
+    all tables are read from the same snapshot, with jobs > 1 they are
+    loaded concurrently using jobs more connections (at most the size of
+    the pool minus one for a Session)
+    for a partial checkout, only features intersecting extent (see
+    pg_selection) and matching filters[pg_table_name], an SQL expression,
+    are copied"""
 
     if os.path.isfile(sqlite_filename):
         raise RuntimeError("File "+sqlite_filename+" already exists")
@@ -191,433 +1377,439 @@ def checkout(pg_conn_info, pg_table_names, sqlite_filename):
             raise RuntimeError("Schema names must end with "
                 "suffix _branch_rev_head")
 
-    pcur = Db(psycopg2.connect(pg_conn_info))
+    jobs = pg_max_jobs( pg_conn_info, jobs )
+    with pg_connect(pg_conn_info) as pcur:
+        # local inserts get ids no other working copy can allocate, reserved in
+        # their own transaction so that the tables are not locked by the copy,
+        # tables without pkey sequence fall back to ids after max_pg_pk
+        blocks = {}
+        for pg_table_name in pg_table_names:
+            [schema, table] = pg_table_name.split('.')
+            blocks[pg_table_name] = pg_reserve_pks( pcur,
+                    schema[:-9].rpartition('_')[0], table, pg_fid_block(), True )
+        pcur.commit()
+        pg_begin_snapshot( pcur )
+        snapshot = pg_export_snapshot( pcur ) if jobs > 1 else None
+        scur = Db(dbapi2.connect(sqlite_filename))
+        scur.execute("SELECT InitSpatialMetadata(1)")
+        # last feature id allocated by the triggers for each table and end of
+        # the block of ids reserved on the server for them
+        scur.execute("CREATE TABLE fid_counter "
+            "(table_name TEXT PRIMARY KEY, last_fid INTEGER, max_fid INTEGER)")
+
+        trace.phase('checkout', 'create')
+        # create the tables and save target revisions
+        layers = []
+        copies = []
+        first_table = True
+        for pg_table_name in pg_table_names:
+            [schema, table] = pg_table_name.split('.')
+            [schema, sep, branch] = schema[:-9].rpartition('_')
+            del sep
+
+            # fetch the current rev
+            pcur.execute("SELECT MAX(rev) FROM "+schema+".revisions")
+            current_rev = int(pcur.fetchone()[0])
+
+            # max pkey for this table
+            pkey = pg_pk( pcur, schema, table )
+            pcur.execute("SELECT MAX("+pkey+") FROM "+schema+"."+table)
+            [max_pg_pk] = pcur.fetchone()
+            if not max_pg_pk :
+                max_pg_pk = 0
+
+            # create the table in spatialite db with the same columns, the
+            # primary key becomes OGC_FID and the geometry GEOMETRY
+            pgeom = pg_geom( pcur, schema, table )
+            geoms = pg_geoms( pcur, schema, table )
+            pg_cols = pg_columns( pcur, schema, table )
+            sp_cols = "OGC_FID INTEGER PRIMARY KEY"
+            # the partitioning column is set by the server, see partition_history
+            for [col, data_type] in pg_cols:
+                if col not in [pkey, 'versioning_live'] and col not in geoms:
+                    sp_cols += ", "+quote_ident(col)+" "+sp_type(data_type)
+            scur.execute("CREATE TABLE "+table+" ("+sp_cols+")")
+            [srid, geom_type] = pg_geom_type( pcur, schema, table, pgeom )
+            if pgeom:
+                dims = pg_coord_dimension( pcur, schema, table, pgeom )
+                scur.execute("SELECT AddGeometryColumn('"+table+"', 'GEOMETRY', "
+                    +str(srid)+", '"+sp_geom_type( geom_type, dims )+"', "
+                    "'"+dims+"')")
+            mapping = sp_pg_columns( scur, table, pkey, pgeom, pg_cols )
+            selection = pg_selection( pcur, schema, table, extent,
+                    filters.get(pg_table_name) if filters else None )
+            copies.append( (schema+"."+table, selection, mapping, srid) )
+            layers.append( (schema, branch, table, pgeom) )
+            block = blocks[pg_table_name]
+            scur.execute("INSERT INTO fid_counter "
+                "(table_name, last_fid, max_fid) VALUES ('"+table+"', "
+                +(str(block[0]-1)+", "+str(block[1]) if block
+                    else str(max_pg_pk)+", NULL")+")")
+            selection = "'"+escape_quote(selection)+"'" if selection else "NULL"
+
+            if first_table:
+                first_table = False
+                scur.execute("CREATE TABLE initial_revision AS SELECT "+
+                        str(current_rev)+" AS rev, '"+
+                        branch+"' AS branch, '"+
+                        schema+"' AS table_schema, '"+
+                        table+"' AS table_name, "+
+                        str(max_pg_pk)+" AS max_pk, "+
+                        "CAST("+selection+" AS TEXT) AS selection")
+            else:
+                scur.execute("INSERT INTO initial_revision"
+                        "(rev, branch, table_schema, table_name, max_pk, "
+                        "selection) "
+                        "VALUES ("+str(current_rev)+", '"+branch+"', '"+
+                        schema+"', '"+table+"', "+str(max_pg_pk)+", "
+                        +selection+")" )
+
+        trace.phase('checkout', 'copy')
+        # copy the rows
+        if jobs > 1:
+            pg_to_sp_parallel( pg_conn_info, snapshot,
+                    [ (pg_table, pg_to_sp_statements( pcur, pg_table, selection,
+                        pg_table.split('.')[1], mapping, srid ))
+                        for [pg_table, selection, mapping, srid] in copies ],
+                    scur, jobs )
+        else:
+            for [pg_table, selection, mapping, srid] in copies:
+                pg_to_sp( pcur, pg_table, selection,
+                        scur, pg_table.split('.')[1], mapping, srid )
+        scur.commit()
 
-    first_table = True
-    for pg_table_name in pg_table_names:
-        [schema, table] = pg_table_name.split('.')
-        [schema, sep, branch] = schema[:-9].rpartition('_')
-        del sep
+        trace.phase('checkout', 'views')
+        # index the rows once loaded, create views and triggers
+        for [schema, branch, table, pgeom] in layers:
+            if pgeom:
+                scur.execute("SELECT CreateSpatialIndex('"+table+"', 'GEOMETRY')")
 
-        # fetch the current rev
-        pcur.execute("SELECT MAX(rev) FROM "+schema+".revisions")
-        current_rev = int(pcur.fetchone()[0])
-
-        # max pkey for this table
-        pkey = pg_pk( pcur, schema, table )
-        pcur.execute("SELECT MAX("+pkey+") FROM "+schema+"."+table)
-        [max_pg_pk] = pcur.fetchone()
-        if not max_pg_pk :
-            max_pg_pk = 0
-
-        # use ogr2ogr to create spatialite db
-        if first_table:
-            first_table = False
-            cmd = ['ogr2ogr',
-                '-preserve_fid',
-                '-f', 'SQLite',
-                '-dsco', 'SPATIALITE=yes',
-                sqlite_filename,
-                'PG:"'+pg_conn_info+'"', schema+'.'+table,
-                '-nln', table]
-            #print ' '.join(cmd)
-            os.system(' '.join(cmd))
-
-            # save target revision in a table
-            scur = Db(dbapi2.connect(sqlite_filename))
-            scur.execute("CREATE TABLE initial_revision AS SELECT "+
-                    str(current_rev)+" AS rev, '"+
-                    branch+"' AS branch, '"+
-                    schema+"' AS table_schema, '"+
-                    table+"' AS table_name, "+
-                    str(max_pg_pk)+" AS max_pk")
-            scur.commit()
-            scur.close()
+            # create views and triggers in spatilite db
+            scur.execute("PRAGMA table_info("+table+")")
+            cols = ""
+            newcols = ""
+            hcols = ['OGC_FID'] + branch_columns( pg_branches( pcur, schema ) )
+            for res in scur.fetchall():
+                if res[1] not in hcols :
+                    cols += quote_ident(res[1]) + ", "
+                    newcols += "new."+quote_ident(res[1])+", "
+            cols = cols[:-2]
+            newcols = newcols[:-2] # remove last coma
+
+            scur.execute( "CREATE VIEW "+table+"_view "+"AS "
+                "SELECT ROWID AS ROWID, OGC_FID, "+cols+" "
+                "FROM "+table+" WHERE "+branch+"_rev_end IS NULL "
+                "AND "+branch+"_rev_begin IS NOT NULL")
+
+            # new feature ids are allocated from fid_counter, so that triggers
+            # do not scan the table for each edited row. Once the reserved
+            # block is exhausted they go above the features merged by update,
+            # until the next refill renumbers them (see sp_refill_fid_block)
+            next_fid = ("UPDATE fid_counter SET last_fid = CASE "
+                    "WHEN max_fid IS NULL OR last_fid < max_fid "
+                    "THEN last_fid + 1 "
+                    "ELSE MAX(last_fid, (SELECT MAX(OGC_FID) FROM "+table+")) + 1 "
+                "END WHERE table_name = '"+table+"';\n")
+            last_fid_sub = ("(SELECT last_fid FROM fid_counter "
+                "WHERE table_name = '"+table+"')")
+            current_rev_sub = ("(SELECT rev FROM initial_revision "
+                "WHERE table_name = '"+table+"')")
+
+            # journal of the features touched by the triggers, so that update
+            # and commit do not need to scan the table for local changes
+            scur.execute("CREATE TABLE "+table+"_dirty "
+                "(OGC_FID INTEGER PRIMARY KEY)")
+            dirty = "INSERT OR IGNORE INTO "+table+"_dirty (OGC_FID) VALUES "
+
+            scur.execute("DELETE FROM views_geometry_columns "
+                "WHERE view_name = '"+table+"_view'")
+            if 'GEOMETRY' in cols:
+                scur.execute("INSERT INTO views_geometry_columns "
+                        "(view_name, view_geometry, view_rowid, "
+                            "f_table_name, f_geometry_column, read_only) "
+                        "VALUES"+"('"+table+"_view', 'geometry', 'rowid', '"
+                        +table+"', 'geometry', 0)")
+
+            # when we edit something old, we insert and update parent
+            scur.execute(
+            "CREATE TRIGGER update_old_"+table+" "
+                "INSTEAD OF UPDATE ON "+table+"_view "
+                "WHEN EXISTS (SELECT 1 FROM "+table+" "
+                "WHERE OGC_FID = new.OGC_FID "
+                "AND ("+branch+"_rev_begin <= "+current_rev_sub+" ) ) \n"
+                "BEGIN\n"
+                +next_fid+
+                "INSERT INTO "+table+" "
+                "(OGC_FID, "+cols+", "+branch+"_rev_begin, "
+                 +branch+"_parent) "
+                "VALUES "
+                "("+last_fid_sub+", "+newcols+", "+current_rev_sub+"+1, "
+                  "old.OGC_FID);\n"
+                "UPDATE "+table+" SET "+branch+"_rev_end = "+current_rev_sub+", "
+                +branch+"_child = "+last_fid_sub+" WHERE OGC_FID = old.OGC_FID;\n"
+                +dirty+"(old.OGC_FID);\n"
+                +dirty+"("+last_fid_sub+");\n"
+                "END")
+            # when we edit something new, we just update
+            scur.execute("CREATE TRIGGER update_new_"+table+" "
+            "INSTEAD OF UPDATE ON "+table+"_view "
+                  "WHEN EXISTS (SELECT 1 FROM "+table+" "
+                  "WHERE OGC_FID = new.OGC_FID AND ("+branch+"_rev_begin > "
+                  +current_rev_sub+" ) ) \n"
+                  "BEGIN\n"
+                    "REPLACE INTO "+table+" "
+                    "(OGC_FID, "+cols+", "+branch+"_rev_begin, "+branch+"_parent) "
+                    "VALUES "
+                    "(new.OGC_FID, "+newcols+", "+current_rev_sub+"+1, (SELECT "
+                    +branch+"_parent FROM "+table+
+                    " WHERE OGC_FID = new.OGC_FID));\n"
+                    +dirty+"(new.OGC_FID);\n"
+                  "END")
+
+            scur.execute("CREATE TRIGGER insert_"+table+" "
+            "INSTEAD OF INSERT ON "+table+"_view\n"
+                "BEGIN\n"
+                    +next_fid+
+                    "INSERT INTO "+table+" "+
+                    "(OGC_FID, "+cols+", "+branch+"_rev_begin) "
+                    "VALUES "
+                    "("+last_fid_sub+", "+newcols+", "+current_rev_sub+"+1);\n"
+                    +dirty+"("+last_fid_sub+");\n"
+                "END")
+
+            scur.execute("CREATE TRIGGER delete_"+table+" "
+            "INSTEAD OF DELETE ON "+table+"_view\n"
+                "BEGIN\n"
+                  # update it if its old
+                    "UPDATE "+table+" "
+                        "SET "+branch+"_rev_end = "+current_rev_sub+" "
+                        "WHERE OGC_FID = old.OGC_FID "
+                        "AND "+branch+"_rev_begin < "+current_rev_sub+"+1;\n"
+                  # delete it if its new and remove it from child
+                    "UPDATE "+table+" "
+                        "SET "+branch+"_child = NULL "
+                        "WHERE OGC_FID IN (SELECT OGC_FID FROM "+table+"_dirty) "
+                        "AND "+branch+"_child = old.OGC_FID "
+                        "AND "+branch+"_rev_begin = "+current_rev_sub+"+1;\n"
+                    +dirty+"(old.OGC_FID);\n"
+                    "DELETE FROM "+table+" "
+                        "WHERE OGC_FID = old.OGC_FID "
+                        "AND "+branch+"_rev_begin = "+current_rev_sub+"+1;\n"
+                "END")
 
-        else:
-            cmd = ['ogr2ogr',
-                    '-preserve_fid',
-                    '-f', 'SQLite',
-                    '-update',
-                    sqlite_filename,
-                    'PG:"'+pg_conn_info+'"', schema+'.'+table,
-                    '-nln', table]
-            #print ' '.join(cmd)
-            os.system(' '.join(cmd))
-
-            # save target revision in a table if not in there
-            scur = Db(dbapi2.connect(sqlite_filename))
-            scur.execute("INSERT INTO initial_revision"
-                    "(rev, branch, table_schema, table_name, max_pk) "
-                    "VALUES ("+str(current_rev)+", '"+branch+"', '"+
-                    schema+"', '"+table+"', "+str(max_pg_pk)+")" )
             scur.commit()
-            scur.close()
+        scur.close()
 
-        scur = Db(dbapi2.connect(sqlite_filename))
+def sp_merge_diff( scur, table, branch, rev, max_rev, current_max_pk,
+        max_pg_pk ):
+    """Merge table_diff, the changes of branch from rev to max_rev, into the
+    working copy table. Local features are renumbered above max_pg_pk, the
+    max pkey at max_rev, current_max_pk is the one at rev, unless they
+    are equal. Conflicting changes are put in table_conflicts"""
+    scur.execute("PRAGMA table_info("+table+")")
+    columns = [col[1] for col in scur.fetchall()]
+    cols = ', '.join([quote_ident(col) for col in columns])
+    geom = 'GEOMETRY' in [col.upper() for col in columns]
+
+    # update the initial revision
+    scur.execute("UPDATE initial_revision "
+        "SET rev = "+str(max_rev)+", max_pk = "+str(max_pg_pk)+" "
+        "WHERE table_name = '"+table+"'")
+
+    trace.phase('update', 'bump')
+    # local changes are found through the journal if any
+    journal = sp_has_journal( scur, table )
+    dirty = ("OGC_FID IN (SELECT OGC_FID FROM "+table+"_dirty) AND "
+            if journal else "")
+
+    scur.execute("UPDATE "+table+" "
+            "SET "+branch+"_rev_end = "+str(max_rev)+" "
+            "WHERE "+dirty+branch+"_rev_end = "+str(rev))
+    scur.execute("UPDATE "+table+" "
+            "SET "+branch+"_rev_begin = "+str(max_rev+1)+" "
+            "WHERE "+dirty+branch+"_rev_begin = "+str(rev+1))
+
+    # we cannot add constrain to the spatialite db in order to have
+    # spatialite update parent and child when we bump inserted pkey
+    # above the max pkey in the diff we must do this manually
+    bump = max_pg_pk - current_max_pk
+    assert( bump >= 0)
+    # nothing to do for ids allocated from a reserved block
+    if bump:
+        # now bump the pks of inserted rows in working copy
+        # note that to do that, we need to set a negative value because
+        # the UPDATE is not implemented correctly according to:
+        # http://stackoverflow.com/questions/19381350/simulate-order-by-in-sqlite-update-to-handle-uniqueness-constraint
+        scur.execute("UPDATE "+table+" "
+                "SET OGC_FID = -OGC_FID  "
+                "WHERE "+dirty+branch+"_rev_begin = "+str(max_rev+1))
+        scur.execute("UPDATE "+table+" "
+            "SET OGC_FID = "+str(bump)+"-OGC_FID WHERE OGC_FID < 0")
+        # and bump the pkey in the child field
+        # not that we don't care for nulls since adding something
+        # to null is null
+        scur.execute("UPDATE "+table+" "
+                "SET "+branch+"_child = "+branch+"_child  + "+str(bump)+" "
+                "WHERE "+dirty+branch+"_rev_end = "+str(max_rev))
+        # and in the journal, local features are above the previous max pkey
+        if journal:
+            scur.execute("UPDATE "+table+"_dirty "
+                    "SET OGC_FID = -OGC_FID  "
+                    "WHERE OGC_FID > "+str(current_max_pk))
+            scur.execute("UPDATE "+table+"_dirty "
+                "SET OGC_FID = "+str(bump)+"-OGC_FID WHERE OGC_FID < 0")
+
+    trace.phase('update', 'conflicts')
+    # detect conflicts: conflict occur if two lines with the same pkey have
+    # been modified (i.e. have a non null child) or one has been removed
+    # and the other modified
+    scur.execute("DROP VIEW  IF EXISTS "+table+"_conflicts_ogc_fid")
+    scur.execute("CREATE VIEW "+table+"_conflicts_ogc_fid AS "
+        "SELECT DISTINCT sl.OGC_FID as conflict_deleted_fid "
+        "FROM "+table+" AS sl, "+table+"_diff AS pg "
+        "WHERE "+("sl.OGC_FID IN (SELECT OGC_FID FROM "+table+"_dirty) "
+            "AND " if journal else "")+
+            "sl.OGC_FID = pg.OGC_FID "
+            "AND sl."+branch+"_child != pg."+branch+"_child")
+    scur.execute("SELECT conflict_deleted_fid "
+        "FROM  "+table+"_conflicts_ogc_fid" )
+    if scur.fetchone():
+        print "there are conflicts"
+        # add layer for conflicts
+        scur.execute("DROP TABLE IF EXISTS "+table+"_conflicts ")
+        scur.execute("CREATE TABLE "+table+"_conflicts AS "
+            +conflicts_query( table, table+"_diff",
+                table+"_conflicts_ogc_fid", "conflict_deleted_fid",
+                "OGC_FID", branch, columns ))
 
-        # create views and triggers in spatilite db
-        scur.execute("PRAGMA table_info("+table+")")
-        cols = ""
-        newcols = ""
-        hcols = ['OGC_FID'] + sum([[brch+'_rev_begin', brch+'_rev_end',
-                brch+'_parent', brch+'_child'] for brch in pg_branches( pcur, schema ) ],[])
-        for res in scur.fetchall():
-            if res[1] not in hcols :
-                cols += quote_ident(res[1]) + ", "
-                newcols += "new."+quote_ident(res[1])+", "
-        cols = cols[:-2]
-        newcols = newcols[:-2] # remove last coma
-
-        scur.execute( "CREATE VIEW "+table+"_view "+"AS "
-            "SELECT ROWID AS ROWID, OGC_FID, "+cols+" "
-            "FROM "+table+" WHERE "+branch+"_rev_end IS NULL "
-            "AND "+branch+"_rev_begin IS NOT NULL")
-
-        max_fid_sub = ("( SELECT MAX(max_fid) FROM ( SELECT MAX(OGC_FID) AS "
-            "max_fid FROM "+table+" UNION SELECT max_pk AS max_fid "
-            "FROM initial_revision WHERE table_name = '"+table+"') )")
-        current_rev_sub = ("(SELECT rev FROM initial_revision "
-            "WHERE table_name = '"+table+"')")
-
-        scur.execute("DELETE FROM views_geometry_columns "
-            "WHERE view_name = '"+table+"_view'")
-        if 'GEOMETRY' in cols:
-            scur.execute("INSERT INTO views_geometry_columns "
-                    "(view_name, view_geometry, view_rowid, "
-                        "f_table_name, f_geometry_column, read_only) "
-                    "VALUES"+"('"+table+"_view', 'geometry', 'rowid', '"
-                    +table+"', 'geometry', 0)")
-
-        # when we edit something old, we insert and update parent
-        scur.execute(
-        "CREATE TRIGGER update_old_"+table+" "
-            "INSTEAD OF UPDATE ON "+table+"_view "
-            "WHEN (SELECT COUNT(*) FROM "+table+" "
-            "WHERE OGC_FID = new.OGC_FID "
-            "AND ("+branch+"_rev_begin <= "+current_rev_sub+" ) ) \n"
-            "BEGIN\n"
-            "INSERT INTO "+table+" "
-            "(OGC_FID, "+cols+", "+branch+"_rev_begin, "
-             +branch+"_parent) "
-            "VALUES "
-            "("+max_fid_sub+"+1, "+newcols+", "+current_rev_sub+"+1, "
-              "old.OGC_FID);\n"
-            "UPDATE "+table+" SET "+branch+"_rev_end = "+current_rev_sub+", "
-            +branch+"_child = "+max_fid_sub+" WHERE OGC_FID = old.OGC_FID;\n"
-            "END")
-        # when we edit something new, we just update
-        scur.execute("CREATE TRIGGER update_new_"+table+" "
-        "INSTEAD OF UPDATE ON "+table+"_view "
-              "WHEN (SELECT COUNT(*) FROM "+table+" "
-              "WHERE OGC_FID = new.OGC_FID AND ("+branch+"_rev_begin > "
-              +current_rev_sub+" ) ) \n"
-              "BEGIN\n"
-                "REPLACE INTO "+table+" "
-                "(OGC_FID, "+cols+", "+branch+"_rev_begin, "+branch+"_parent) "
-                "VALUES "
-                "(new.OGC_FID, "+newcols+", "+current_rev_sub+"+1, (SELECT "
-                +branch+"_parent FROM "+table+
-                " WHERE OGC_FID = new.OGC_FID));\n"
-              "END")
+        scur.execute("DELETE FROM geometry_columns "
+            "WHERE f_table_name = '"+table+"_conflicts'")
+        if geom:
+            # same type and dimension as the table, see sp_create_like
+            scur.execute("INSERT INTO geometry_columns "
+                "SELECT '"+table+"_conflicts', 'geometry', geometry_type, "
+                "coord_dimension, srid, 0 "
+                "FROM geometry_columns WHERE f_table_name = '"+table+"'")
 
-        scur.execute("CREATE TRIGGER insert_"+table+" "
-        "INSTEAD OF INSERT ON "+table+"_view\n"
-            "BEGIN\n"
-                "INSERT INTO "+table+" "+
-                "(OGC_FID, "+cols+", "+branch+"_rev_begin) "
-                "VALUES "
-                "("+max_fid_sub+"+1, "+newcols+", "+current_rev_sub+"+1);\n"
-            "END")
+        scur.execute("CREATE UNIQUE INDEX IF NOT EXISTS "
+            +table+"_conflicts_idx ON "+table+"_conflicts(OGC_FID)")
+
+        # create trigers such that on delete the conflict is resolved
+        # if we delete 'theirs', we set their child to our fid and
+        # their rev_end if we delete 'mine'... well, we delete 'mine'
 
-        scur.execute("CREATE TRIGGER delete_"+table+" "
-        "INSTEAD OF DELETE ON "+table+"_view\n"
+        scur.execute("DROP TRIGGER IF EXISTS delete_"+table+"_conflicts")
+        scur.execute("CREATE TRIGGER delete_"+table+"_conflicts "
+        "AFTER DELETE ON "+table+"_conflicts\n"
             "BEGIN\n"
-              # update it if its old
+                "DELETE FROM "+table+" "
+                "WHERE OGC_FID = old.OGC_FID AND old.origin = 'mine';\n"
+
                 "UPDATE "+table+" "
-                    "SET "+branch+"_rev_end = "+current_rev_sub+" "
-                    "WHERE OGC_FID = old.OGC_FID "
-                    "AND "+branch+"_rev_begin < "+current_rev_sub+"+1;\n"
-              # delete it if its new and remove it from child
+                "SET "+branch+"_child = (SELECT OGC_FID "
+                "FROM "+table+"_conflicts "
+                "WHERE origin = 'mine' "
+                "AND conflict_id = old.conflict_id), "
+                +branch+"_rev_end = "+str(max_rev)+" "
+                "WHERE OGC_FID = old.OGC_FID AND old.origin = 'theirs';\n"
+
                 "UPDATE "+table+" "
-                    "SET "+branch+"_child = NULL "
-                    "WHERE "+branch+"_child = old.OGC_FID "
-                    "AND "+branch+"_rev_begin = "+current_rev_sub+"+1;\n"
-                "DELETE FROM "+table+" "
-                    "WHERE OGC_FID = old.OGC_FID "
-                    "AND "+branch+"_rev_begin = "+current_rev_sub+"+1;\n"
+                "SET "+branch+"_parent = old.OGC_FID "
+                "WHERE OGC_FID = (SELECT OGC_FID "
+                "FROM "+table+"_conflicts WHERE origin = 'mine' "
+                "AND conflict_id = old.conflict_id) "
+                "AND old.origin = 'theirs';\n"
+
+                "DELETE FROM "+table+"_conflicts "
+                "WHERE conflict_id = old.conflict_id;\n"
+                +("INSERT OR IGNORE INTO "+table+"_dirty (OGC_FID) "
+                "VALUES (old.OGC_FID);\n" if journal else "")+
             "END")
 
         scur.commit()
-        scur.close()
-    pcur.close()
+
+    scur.execute("CREATE UNIQUE INDEX IF NOT EXISTS "
+        +table+"_diff_idx ON "+table+"_diff(OGC_FID)")
+    trace.phase('update', 'merge')
+    # insert and replace all in diff
+    scur.execute("INSERT OR REPLACE INTO "+table+" ("+cols+") "
+        "SELECT "+cols+" FROM "+table+"_diff")
+    sp_update_fid_counter( scur, table, max_pg_pk )
 
 def update(sqlite_filename, pg_conn_info):
     """merge modifications since last update into working copy"""
     print "update"
+    trace.phase('update', 'check')
     if unresolved_conflicts(sqlite_filename):
         raise RuntimeError("There are unresolved conflicts in "
                 +sqlite_filename)
     # get the target revision from the spatialite db
-    # create the diff in postgres
-    # load the diff in spatialite
+    # load the diff from postgres in spatialite
     # detect conflicts and create conflict layers
     # merge changes and update target_revision
-    # delete diff
 
     scur = Db(dbapi2.connect(sqlite_filename))
-    scur.execute("SELECT rev, branch, table_schema, table_name, max_pk "
-        "FROM initial_revision")
+    sp_upgrade_initial_revision( scur )
+    scur.execute("SELECT rev, branch, table_schema, table_name, max_pk, "
+        "selection FROM initial_revision")
     versioned_layers = scur.fetchall()
 
-    for [rev, branch, table_schema, table, current_max_pk] in versioned_layers:
-        pcur = Db(psycopg2.connect(pg_conn_info))
-        pcur.execute("SELECT MAX(rev) FROM "+table_schema+".revisions "
-            "WHERE branch = '"+branch+"'")
-        [max_rev] = pcur.fetchone()
-        if max_rev == rev:
-            print ("Nothing new in branch "+branch+" in "+table_schema+"."
-                +table+" since last update")
-            pcur.close()
-            continue
-
-        # get the max pkey
-        pkey = pg_pk( pcur, table_schema, table )
-        pgeom = pg_geom( pcur, table_schema, table )
-        pcur.execute("SELECT MAX("+pkey+") FROM "+table_schema+"."+table)
-        [max_pg_pk] = pcur.fetchone()
-        if not max_pg_pk :
-            max_pg_pk = 0
-
-        # create the diff
-        diff_schema = (table_schema+"_"+branch+"_"+str(rev)+
-            "_to_"+str(max_rev)+"_diff")
-        pcur.execute("SELECT schema_name FROM information_schema.schemata "
-            "WHERE schema_name = '"+diff_schema+"'")
-        if not pcur.fetchone():
-            pcur.execute("CREATE SCHEMA "+diff_schema)
-
-        other_branches = pg_branches( pcur, table_schema ).remove(branch)
-        other_branches = other_branches if other_branches else []
-        other_branches_columns = sum([ 
-            [brch+'_rev_begin', brch+'_rev_end', 
-            brch+'_parent', brch+'_child'] 
-            for brch in other_branches], [])
-        pcur.execute("SELECT column_name "
-                "FROM information_schema.columns "
-                "WHERE table_schema = '"+table_schema+"' "
-                "AND table_name = '"+table+"'")
-        cols = ""
-        for col in pcur.fetchall():
-            if col[0] != pgeom and col[0] not in other_branches_columns:
-                cols += quote_ident(col[0])+", "
-        cols = cols[:-2] # remove last coma and space
-
-        pcur.execute("SELECT srid, type "
-            "FROM geometry_columns "
-            "WHERE f_table_schema = '"+table_schema+
-            "' AND f_table_name ='"+table+"' AND f_geometry_column = '"+pgeom+"'")
-        srid_type = pcur.fetchone()
-        [srid, geom_type] = srid_type if srid_type else [None, None]
-        pcur.execute( "DROP TABLE IF EXISTS "+diff_schema+"."+table+"_diff")
-        geom = (", "+pgeom+"::geometry('"+geom_type+"', "+str(srid)+") "
-            "AS "+pgeom) if pgeom else ''
-        pcur.execute( "CREATE TABLE "+diff_schema+"."+table+"_diff AS "
-                "SELECT "+cols+geom+" "
-                "FROM "+table_schema+"."+table+" "
-                "WHERE "+branch+"_rev_end = "+str(rev)+" "
-                "OR "+branch+"_rev_begin > "+str(rev))
-        pcur.execute( "ALTER TABLE "+diff_schema+"."+table+"_diff "
-                "ADD CONSTRAINT "+table+"_"+branch+"_pk_pk "
-                "PRIMARY KEY ("+pkey+")")
-        pcur.commit()
-
-        scur.execute("DROP TABLE IF EXISTS "+table+"_diff")
-        scur.execute("DROP TABLE IF EXISTS idx_"+table+"_diff_GEOMETRY")
-        scur.execute("DELETE FROM geometry_columns "
-            "WHERE f_table_name = '"+table+"_diff'")
-        scur.commit()
-
-        # import the diff to spatialite
-        cmd = ['ogr2ogr',
-                '-preserve_fid',
-                '-f', 'SQLite',
-                '-update',
-                sqlite_filename,
-                'PG:"'+pg_conn_info+'"',
-                diff_schema+'.'+table+"_diff",
-                '-nln', table+"_diff"]
-        print ' '.join(cmd)
-        os.system(' '.join(cmd))
-
-        # cleanup in postgis
-        pcur.execute("DROP SCHEMA "+diff_schema+" CASCADE")
-        pcur.commit()
-        pcur.close()
-
-        scur.execute("PRAGMA table_info("+table+")")
-        cols = ""
-        for col in scur.fetchall():
-            cols += quote_ident(col[1])+", "
-        cols = cols[:-2] # remove last coma and space
-
-        # update the initial revision
-        scur.execute("UPDATE initial_revision "
-            "SET rev = "+str(max_rev)+", max_pk = "+str(max_pg_pk)+" "
-            "WHERE table_name = '"+table+"'")
-
-        scur.execute("UPDATE "+table+" "
-                "SET "+branch+"_rev_end = "+str(max_rev)+" "
-                "WHERE "+branch+"_rev_end = "+str(rev))
-        scur.execute("UPDATE "+table+" "
-                "SET "+branch+"_rev_begin = "+str(max_rev+1)+" "
-                "WHERE "+branch+"_rev_begin = "+str(rev+1))
-
-        # we cannot add constrain to the spatialite db in order to have
-        # spatialite update parent and child when we bump inserted pkey
-        # above the max pkey in the diff we must do this manually
-        bump = max_pg_pk - current_max_pk
-        assert( bump >= 0)
-        # now bump the pks of inserted rows in working copy
-        # note that to do that, we need to set a negative value because
-        # the UPDATE is not implemented correctly according to:
-        # http://stackoverflow.com/questions/19381350/simulate-order-by-in-sqlite-update-to-handle-uniqueness-constraint
-        scur.execute("UPDATE "+table+" "
-                "SET OGC_FID = -OGC_FID  "
-                "WHERE "+branch+"_rev_begin = "+str(max_rev+1))
-        scur.execute("UPDATE "+table+" "
-            "SET OGC_FID = "+str(bump)+"-OGC_FID WHERE OGC_FID < 0")
-        # and bump the pkey in the child field
-        # not that we don't care for nulls since adding something
-        # to null is null
-        scur.execute("UPDATE "+table+" "
-                "SET "+branch+"_child = "+branch+"_child  + "+str(bump)+" "
-                "WHERE "+branch+"_rev_end = "+str(max_rev))
-
-        # detect conflicts: conflict occur if two lines with the same pkey have
-        # been modified (i.e. have a non null child) or one has been removed
-        # and the other modified
-        scur.execute("DROP VIEW  IF EXISTS "+table+"_conflicts_ogc_fid")
-        scur.execute("CREATE VIEW "+table+"_conflicts_ogc_fid AS "
-            "SELECT DISTINCT sl.OGC_FID as conflict_deleted_fid "
-            "FROM "+table+" AS sl, "+table+"_diff AS pg "
-            "WHERE sl.OGC_FID = pg.OGC_FID "
-                "AND sl."+branch+"_child != pg."+branch+"_child")
-        scur.execute("SELECT conflict_deleted_fid "
-            "FROM  "+table+"_conflicts_ogc_fid" )
-        if scur.fetchone():
-            print "there are conflicts"
-            # add layer for conflicts
-            scur.execute("DROP TABLE IF EXISTS "+table+"_conflicts ")
-            scur.execute("CREATE TABLE "+table+"_conflicts AS "
-                # insert new features from mine
-                "SELECT "+branch+"_parent AS conflict_id, 'mine' AS origin, "
-                "'modified' AS action, "+cols+" "
-                "FROM "+table+", "+table+"_conflicts_ogc_fid AS cflt "
-                "WHERE OGC_FID = (SELECT "+branch+"_child FROM "+table+" "
-                                     "WHERE OGC_FID = conflict_deleted_fid) "
-                "UNION ALL "
-                # insert new features from theirs
-                "SELECT "+branch+"_parent AS conflict_id, 'theirs' AS origin, "
-                "'modified' AS action, "+cols+" "
-                "FROM "+table+"_diff "+", "+table+"_conflicts_ogc_fid AS cflt "
-                "WHERE OGC_FID = (SELECT "+branch+"_child FROM "+table+"_diff "
-                                     "WHERE OGC_FID = conflict_deleted_fid) "
-                 # insert deleted features from mine
-                "UNION ALL "
-                "SELECT "+branch+"_parent AS conflict_id, 'mine' AS origin, "
-                "'deleted' AS action, "+cols+" "
-                "FROM "+table+", "+table+"_conflicts_ogc_fid AS cflt "
-                "WHERE OGC_FID = conflict_deleted_fid "
-                "AND "+branch+"_child IS NULL "
-                 # insert deleted features from theirs
-                "UNION ALL "
-                "SELECT "+branch+"_parent AS conflict_id, 'theirs' AS origin, "
-                "'deleted' AS action, "+cols+" "
-                "FROM "+table+"_diff, "+table+"_conflicts_ogc_fid AS cflt "
-                "WHERE OGC_FID = conflict_deleted_fid "
-                "AND "+branch+"_child IS NULL" )
-
-            # identify conflicts for deleted
-            scur.execute("UPDATE "+table+"_conflicts "
-                "SET conflict_id = OGC_FID "+ "WHERE action = 'deleted'")
-
-            # now follow child if any for 'theirs' 'modified' since several
-            # edition could be made we want the very last child
-            while True:
-                scur.execute("SELECT conflict_id, OGC_FID, "+branch+"_child "
-                    "FROM "+table+"_conflicts WHERE origin='theirs' "
-                    "AND action='modified' AND "+branch+"_child IS NOT NULL")
-                res = scur.fetchall()
-                if not res :
-                    break
-                # replaces each entries by it's child
-                for [cflt_id, fid, child] in res:
-                    scur.execute("DELETE FROM "+table+"_conflicts "
-                        "WHERE OGC_FID = "+str(fid))
-                    scur.execute("INSERT INTO "+table+"_conflicts "
-                        "SELECT "+str(cflt_id)+" AS conflict_id, "
-                        "'theirs' AS origin, 'modified' AS action, "+cols+" "
-                        "FROM "+table+"_diff "
-                        "WHERE OGC_FID = "+str(child)+" "
-                        "AND "+branch+"_rev_end IS NULL" )
-                    scur.execute("INSERT INTO "+table+"_conflicts "
-                        "SELECT "+str(cflt_id)+" AS conflict_id, "
-                        "'theirs' AS origin, 'deleted' AS action, "+cols+" "
-                        "FROM "+table+"_diff "
-                        "WHERE OGC_FID = "+str(child)+" "
-                        "AND "+branch+"_rev_end IS NOT NULL" )
-
-            scur.execute("DELETE FROM geometry_columns "
-                "WHERE f_table_name = '"+table+"_conflicts'")
-            if geom:
-                scur.execute("SELECT RecoverGeometryColumn("
-                "'"+table+"_conflicts', 'GEOMETRY', "
-                "(SELECT srid FROM geometry_columns "
-                "WHERE f_table_name='"+table+"'), "
-                "(SELECT GeometryType(geometry) FROM "+table+" LIMIT 1), "
-                "'XY')")
-
-            scur.execute("CREATE UNIQUE INDEX IF NOT EXISTS "
-                +table+"_conflicts_idx ON "+table+"_conflicts(OGC_FID)")
-
-            # create trigers such that on delete the conflict is resolved
-            # if we delete 'theirs', we set their child to our fid and
-            # their rev_end if we delete 'mine'... well, we delete 'mine'
-
-            scur.execute("DROP TRIGGER IF EXISTS delete_"+table+"_conflicts")
-            scur.execute("CREATE TRIGGER delete_"+table+"_conflicts "
-            "AFTER DELETE ON "+table+"_conflicts\n"
-                "BEGIN\n"
-                    "DELETE FROM "+table+" "
-                    "WHERE OGC_FID = old.OGC_FID AND old.origin = 'mine';\n"
-
-                    "UPDATE "+table+" "
-                    "SET "+branch+"_child = (SELECT OGC_FID "
-                    "FROM "+table+"_conflicts "
-                    "WHERE origin = 'mine' "
-                    "AND conflict_id = old.conflict_id), "
-                    +branch+"_rev_end = "+str(max_rev)+" "
-                    "WHERE OGC_FID = old.OGC_FID AND old.origin = 'theirs';\n"
-
-                    "UPDATE "+table+" "
-                    "SET "+branch+"_parent = old.OGC_FID "
-                    "WHERE OGC_FID = (SELECT OGC_FID "
-                    "FROM "+table+"_conflicts WHERE origin = 'mine' "
-                    "AND conflict_id = old.conflict_id) "
-                    "AND old.origin = 'theirs';\n"
-
-                    "DELETE FROM "+table+"_conflicts "
-                    "WHERE conflict_id = old.conflict_id;\n"
-                "END")
-
+    with pg_connect(pg_conn_info) as pcur:
+        for [rev, branch, table_schema, table, current_max_pk, selection] \
+                in versioned_layers:
+            sp_refill_fid_block( scur, pcur, table_schema, table, branch, rev )
+            pcur.execute("SELECT MAX(rev) FROM "+table_schema+".revisions "
+                "WHERE branch = '"+branch+"'")
+            [max_rev] = pcur.fetchone()
+            if max_rev == rev:
+                print ("Nothing new in branch "+branch+" in "+table_schema+"."
+                    +table+" since last update")
+                continue
+
+            trace.phase('update', 'diff')
+            # get the max pkey
+            pkey = pg_pk( pcur, table_schema, table )
+            pgeom = pg_geom( pcur, table_schema, table )
+            pcur.execute("SELECT MAX("+pkey+") FROM "+table_schema+"."+table)
+            [max_pg_pk] = pcur.fetchone()
+            if not max_pg_pk :
+                max_pg_pk = 0
+
+            other_branches = pg_branches( pcur, table_schema ).remove(branch)
+            other_branches = other_branches if other_branches else []
+            other_branches_columns = branch_columns( other_branches )
+            pg_cols = [ col for col in pg_columns( pcur, table_schema, table )
+                    if col[0] not in other_branches_columns ]
+
+            # for a partial working copy, the local features that came from
+            # postgis may not match the selection anymore (children of features
+            # that left it), their pkeys are sent along
+            if selection:
+                pcur.execute("DROP TABLE IF EXISTS versioning_local_pks")
+                pcur.execute("CREATE TEMP TABLE versioning_local_pks "
+                    "(pk integer PRIMARY KEY)")
+                sp_to_pg( scur, table, "OGC_FID <= "+str(current_max_pk)+" "
+                        "AND ("+branch+"_rev_end IS NULL "
+                        "OR "+branch+"_rev_end >= "+str(rev)+")",
+                        pcur, "versioning_local_pks",
+                        [('OGC_FID', 'pk', 'pkey')], None )
+
+            # stream the diff from postgis into spatialite
+            sp_create_like( scur, table, table+"_diff" )
+            mapping = sp_pg_columns( scur, table+"_diff", pkey, pgeom, pg_cols )
+            srid = pg_geom_type( pcur, table_schema, table, pgeom )[0]
+            [source, where] = pg_diff_source( pcur, table_schema, table, branch,
+                    rev, max_rev, selection )
+            pg_to_sp( pcur, source, where, scur, table+"_diff", mapping, srid )
             scur.commit()
+            if selection:
+                pcur.execute("DROP TABLE versioning_local_pks")
 
-        scur.execute("CREATE UNIQUE INDEX IF NOT EXISTS "
-            +table+"_diff_idx ON "+table+"_diff(OGC_FID)")
-        # insert and replace all in diff
-        scur.execute("INSERT OR REPLACE INTO "+table+" ("+cols+") "
-            "SELECT "+cols+" FROM "+table+"_diff")
+            # local features keep the ids of their reserved block
+            if sp_fid_block( scur, table ) is not None:
+                current_max_pk = max_pg_pk
+            sp_merge_diff( scur, table, branch, rev, max_rev, current_max_pk,
+                    max_pg_pk )
 
     scur.commit()
     scur.close()
@@ -633,12 +1825,13 @@ def late(sqlite_filename, pg_conn_info):
 
     late_by = 0
 
-    for [rev, branch, table_schema] in versioned_layers:
-        pcur = Db(psycopg2.connect(pg_conn_info))
-        pcur.execute("SELECT MAX(rev) FROM "+table_schema+".revisions "
-            "WHERE branch = '"+branch+"'")
-        [max_rev] = pcur.fetchone()
-        late_by = max(max_rev - rev, late_by)
+    with pg_connect(pg_conn_info) as pcur:
+        for [rev, branch, table_schema] in versioned_layers:
+            pcur.execute("SELECT MAX(rev) FROM "+table_schema+".revisions "
+                "WHERE branch = '"+branch+"'")
+            [max_rev] = pcur.fetchone()
+            late_by = max(max_rev - rev, late_by)
+    scur.close()
 
     return late_by
 
@@ -655,16 +1848,100 @@ def revision( sqlite_filename ):
     scur.close()
     return rev+ 1
 
+def pg_create_diff( pcur, table_schema, table, diff_schema, diff_columns ):
+    """Create the staging table receiving the changes of table_schema.table
+    with the columns diff_columns, returns its name. Only one geometry
+    column is kept in spatialite, the others are added and taken from the
+    parent by pg_apply_diff"""
+    pkey = pg_pk( pcur, table_schema, table )
+    geoms = pg_geoms( pcur, table_schema, table )
+    diff_table = pg_create_staging( pcur, diff_schema, table+"_diff",
+        "SELECT "+', '.join([quote_ident(col) for col in diff_columns]
+            +[geo for geo in geoms if geo not in diff_columns])+" "
+        "FROM "+table_schema+"."+table+" WHERE False")
+    pcur.execute("ALTER TABLE "+diff_table+" "
+        "ADD PRIMARY KEY ("+pkey+")")
+    return diff_table
+
+def pg_apply_diff( pcur, table_schema, table, branch, rev, diff_table,
+        diff_columns, commit_msg, author, functions ):
+    """Merge the rows of diff_table, the changes of branch since rev with
+    the columns diff_columns, into table_schema.table as revision rev+1.
+    functions caches by schema whether versioning_apply_diff is installed"""
+    pkey = pg_pk( pcur, table_schema, table )
+    pgeom = pg_geom( pcur, table_schema, table )
+    geoms = pg_geoms( pcur, table_schema, table )
+    if len(geoms) > 1:
+        dest_geom = ''
+        src_geom = ''
+        for geo in geoms:
+            if geo != pgeom:
+                dest_geom += geo+', '
+                src_geom += 'src.'+geo+', '
+        dest_geom = dest_geom[:-2]
+        src_geom = src_geom[:-2]
+        pcur.execute("UPDATE "+diff_table+" AS dest "
+            "SET ("+dest_geom+") =  ("+src_geom+") " 
+            "FROM "+table_schema+"."+table+" AS src "
+            "WHERE dest."+branch+"_rev_begin = "+str(rev+1)+" "
+            "AND src."+pkey+" = dest."+branch+"_parent")
+
+    if table_schema not in functions:
+        functions[table_schema] = pg_has_function( pcur, table_schema,
+                'versioning_apply_diff' )
+    if functions[table_schema]:
+        # one round trip to merge the diff
+        pcur.execute("SELECT "+table_schema+".versioning_apply_diff("
+            "'"+table+"', '"+diff_table+"', "
+            "'"+branch+"', "+str(rev)+", "
+            "'"+escape_quote(commit_msg)+"', '"+escape_quote(author)+"')")
+    else:
+        pcur.execute("SELECT rev FROM "+table_schema+".revisions "
+            "WHERE rev = "+str(rev+1))
+        if not pcur.fetchone():
+            print "inserting rev ", str(rev+1)
+            pcur.execute("INSERT INTO "+table_schema+".revisions "
+                "(rev, commit_msg, branch, author) "
+                "VALUES ("+str(rev+1)+", '"+escape_quote(commit_msg)+"', '"+branch+"',"
+                "'"+escape_quote(author)+"')")
+
+        other_branches = pg_branches( pcur, table_schema ).remove(branch)
+        other_branches = other_branches if other_branches else []
+        other_branches_columns = branch_columns( other_branches )
+        cols = ""
+        for col in pg_columns( pcur, table_schema, table ):
+            if col[0] not in other_branches_columns and (
+                    col[0] in diff_columns or col[0] in geoms):
+                cols += quote_ident(col[0])+", "
+        cols = cols[:-2] # remove last coma and space
+        # insert inserted and modified
+        pcur.execute("INSERT INTO "+table_schema+"."+table+" ("+cols+") "
+            "SELECT "+cols+" FROM "+diff_table+" "
+            "WHERE "+branch+"_rev_begin = "+str(rev+1))
+    
+        # apdate deleted and modified
+        pcur.execute("UPDATE "+table_schema+"."+table+" AS dest "
+                "SET ("+branch+"_rev_end, "+branch+"_child)"
+                "=(src."+branch+"_rev_end, src."+branch+"_child) "
+                "FROM "+diff_table+" AS src "
+                "WHERE dest."+pkey+" = src."+pkey+" "
+                "AND src."+branch+"_rev_end = "+str(rev))
+
+    if pg_is_partitioned( pcur, table_schema, table ):
+        pg_repartition( pcur, table_schema, table,
+                pg_branches( pcur, table_schema ), ended = "SELECT "+pkey+" "
+                    "FROM "+diff_table+" "
+                    "WHERE "+branch+"_rev_end = "+str(rev) )
+
 def commit(sqlite_filename, commit_msg, pg_conn_info):
     """merge modifications into database
     returns the number of updated layers"""
     # get the target revision from the spatialite db
-    # create the diff in postgres
-    # load the diff in spatialite
-    # detect conflicts
+    # load the diff from spatialite in postgres
     # merge changes and update target_revision
     # delete diff
 
+    trace.phase('commit', 'check')
     unresolved = unresolved_conflicts(sqlite_filename)
     if unresolved:
         raise RuntimeError("There are unresolved conflicts in "
@@ -685,630 +1962,2115 @@ def commit(sqlite_filename, commit_msg, pg_conn_info):
     if not versioned_layers:
         raise RuntimeError("Cannot find a versioned layer in "+sqlite_filename)
 
-    schema_list = {} # for final cleanup
-    nb_of_updated_layer = 0
-    next_rev = 0
-    for [rev, branch, table_schema, table] in versioned_layers:
-        diff_schema = (table_schema+"_"+branch+"_"+str(rev)+
-                "_to_"+str(rev+1)+"_diff")
+    with pg_connect(pg_conn_info) as pcur:
+        schema_list = [] # for final cleanup
+        functions = {} # versioning_apply_diff is installed, by schema
+        nb_of_updated_layer = 0
+        next_rev = 0
+        for [rev, branch, table_schema, table] in versioned_layers:
+            diff_schema = (table_schema+"_"+branch+"_"+str(rev)+
+                    "_to_"+str(rev+1)+"_diff")
 
-        if next_rev:
-            assert( next_rev == rev + 1 )
-        else:
-            next_rev = rev + 1
-
-        scur.execute( "DROP TABLE IF EXISTS "+table+"_diff")
-
-        # note, creating the diff table dirrectly with
-        # CREATE TABLE... AS SELECT won't work
-        # types get fubared in the process
-        # therefore we copy the creation statement from
-        # spatialite master and change the
-        # table name ta obtain a similar table, we add the geometry column
-        # to geometry_columns manually and we insert the diffs
-        scur.execute("SELECT sql FROM sqlite_master "
-            "WHERE tbl_name = '"+table+"' AND type = 'table'")
-        [sql] = scur.fetchone()
-        sql = unicode.replace(sql, table, table+"_diff", 1)
-        scur.execute(sql)
-        geom = (sql.find('GEOMETRY') != -1)
-        scur.execute("DELETE FROM geometry_columns "
-            "WHERE f_table_name = '"+table+"_diff'")
-        if geom:
-            scur.execute("INSERT INTO geometry_columns "
-                "SELECT '"+table+"_diff', 'geometry', geometry_type, "
-                "coord_dimension, srid, spatial_index_enabled "
-                "FROM geometry_columns WHERE f_table_name = '"+table+"'")
-        scur.execute( "INSERT INTO "+table+"_diff "
-                "SELECT * "
-                "FROM "+table+" "
-                "WHERE "+branch+"_rev_end = "+str(rev)+" "
-                "OR "+branch+"_rev_begin > "+str(rev))
-        scur.execute( "SELECT OGC_FID FROM "+table+"_diff")
-        there_is_something_to_commit = scur.fetchone()
-        print "there_is_something_to_commit ", there_is_something_to_commit
-        scur.commit()
+            if next_rev:
+                assert( next_rev == rev + 1 )
+            else:
+                next_rev = rev + 1
 
-        pcur = Db(psycopg2.connect(pg_conn_info))
-        pkey = pg_pk( pcur, table_schema, table )
-        pgeom = pg_geom( pcur, table_schema, table )
+            trace.phase('commit', 'diff')
+            # remove the diff left by the last update
+            scur.execute("DELETE FROM geometry_columns "
+                "WHERE f_table_name = '"+table+"_diff'")
+            scur.execute("DROP TABLE IF EXISTS "+table+"_diff")
+
+            # features inserted once the reserved block was exhausted get ids
+            # that cannot collide with the ones of other working copies
+            sp_refill_fid_block( scur, pcur, table_schema, table, branch, rev )
+            [diff_where, journal] = sp_diff_where( scur, table, branch, rev )
+            scur.execute( "SELECT OGC_FID FROM "+table+" "
+                    "WHERE "+diff_where+" LIMIT 1")
+            there_is_something_to_commit = scur.fetchone()
+            print "there_is_something_to_commit ", there_is_something_to_commit
+            if journal and not there_is_something_to_commit:
+                scur.execute("DELETE FROM "+table+"_dirty")
+            scur.commit()
 
-        # import layers in postgis schema
-        pcur.execute("SELECT schema_name FROM information_schema.schemata "
-            "WHERE schema_name = '"+diff_schema+"'")
-        if not pcur.fetchone():
-            schema_list[diff_schema] = pg_conn_info
-            pcur.execute("CREATE SCHEMA "+diff_schema)
-        pcur.execute( "DROP TABLE IF EXISTS "+diff_schema+"."+table+"_diff")
-        pcur.commit()
-        cmd = ['ogr2ogr',
-                '-preserve_fid',
-                '-f', 
-                'PostgreSQL',
-                'PG:"'+pg_conn_info+'"',
-                '-lco',
-                'FID='+pkey,
-                sqlite_filename, table+"_diff",
-                '-nln', diff_schema+'.'+table+"_diff"]
-        if pgeom:
-            cmd.insert(5, '-lco')
-            cmd.insert(6, 'GEOMETRY_NAME='+pgeom)
-
-        print ' '.join(cmd)
-        os.system(' '.join(cmd))
-
-        # remove dif table and geometry column
-        scur.execute("DELETE FROM geometry_columns "
-            "WHERE f_table_name = '"+table+"_diff'")
-        scur.execute("DROP TABLE "+table+"_diff")
+            if not there_is_something_to_commit:
+                print "nothing to commit for ", table
+                continue
 
+            nb_of_updated_layer += 1
 
-        if not there_is_something_to_commit:
-            print "nothing to commit for ", table
-            pcur.close()
-            continue
+            pkey = pg_pk( pcur, table_schema, table )
+            pgeom = pg_geom( pcur, table_schema, table )
 
-        nb_of_updated_layer += 1
+            # stream the diff from spatialite into a postgis table with the
+            # same column types as the versioned table
+            mapping = sp_pg_columns( scur, table, pkey, pgeom,
+                    pg_columns( pcur, table_schema, table ) )
+            diff_columns = [m[1] for m in mapping]
+            diff_table = pg_create_diff( pcur, table_schema, table, diff_schema,
+                    diff_columns )
+            if pg_staging() == 'unlogged' and diff_schema not in schema_list:
+                schema_list.append(diff_schema)
+            srid = pg_geom_type( pcur, table_schema, table, pgeom )[0]
+            sp_to_pg( scur, table, diff_where, pcur, diff_table, mapping, srid )
+
+            trace.phase('commit', 'apply')
+            pg_apply_diff( pcur, table_schema, table, branch, rev, diff_table,
+                    diff_columns, commit_msg, get_username(), functions )
+            pcur.commit()
 
-        pcur.execute("SELECT rev FROM "+table_schema+".revisions "
-            "WHERE rev = "+str(rev+1))
-        if not pcur.fetchone():
-            print "inserting rev ", str(rev+1)
-            pcur.execute("INSERT INTO "+table_schema+".revisions "
-                "(rev, commit_msg, branch, author) "
-                "VALUES ("+str(rev+1)+", '"+escape_quote(commit_msg)+"', '"+branch+"',"
-                "'"+get_username()+"')")
-
-        # TODO remove when ogr2ogr will be able to convert multiple geom column
-        # from postgis to spatialite
-        geoms = pg_geoms( pcur, table_schema, table )
-        if len(geoms) > 1:
-            dest_geom = ''
-            src_geom = ''
-            for geo in geoms:
-                if geo != pgeom:
-                    dest_geom += geo+', '
-                    src_geom += 'src.'+geo+', '
-            dest_geom = dest_geom[:-2]
-            src_geom = src_geom[:-2]
-            pgeom = pg_geom( pcur, table_schema, table )
-            pcur.execute("SELECT AddGeometryColumn('"+diff_schema+"', '"+table+"_diff', "
-                "'"+geo+"', srid, type, coord_dimension) FROM geometry_columns "
-                "WHERE f_table_name = '"+table+"' "
-                "AND f_table_schema = '"+table_schema+"' "
-                "AND f_geometry_column != '"+pgeom+"'")  
-            pcur.execute("UPDATE "+diff_schema+"."+table+"_diff AS dest "
-                "SET ("+dest_geom+") =  ("+src_geom+") " 
-                "FROM "+table_schema+"."+table+" AS src "
-                "WHERE dest."+branch+"_rev_begin = "+str(rev+1)+" "
-                "AND src."+pkey+" = dest."+branch+"_parent")
+            if journal:
+                scur.execute("DELETE FROM "+table+"_dirty")
+            scur.commit()
 
-        other_branches = pg_branches( pcur, table_schema ).remove(branch)
-        other_branches = other_branches if other_branches else []
-        other_branches_columns = sum([ 
-            [brch+'_rev_begin', brch+'_rev_end', 
-            brch+'_parent', brch+'_child'] 
-            for brch in other_branches], [])
-        pcur.execute("SELECT column_name, data_type "
-                "FROM information_schema.columns "
-                "WHERE table_schema = '"+table_schema+"' "
-                "AND table_name = '"+table+"'")
-        cols = ""
-        cols_cast = ""
-        for col in pcur.fetchall():
-            if col[0] not in other_branches_columns:
-                cols += quote_ident(col[0])+", "
-                if col[1] != 'ARRAY':
-                    cast = "::"+col[1] if col[1] != 'USER-DEFINED' else ""
-                    cols_cast += quote_ident(col[0])+cast+", "
-                else :
-                    cols_cast += ("regexp_replace(regexp_replace("
-                            +col[0]+",'^\(.*:','{'),'\)$','}')::"
-                            +pg_array_elem_type(pcur, 
-                                table_schema, table, col[0])+"[], ")
-        cols = cols[:-2] # remove last coma and space
-        cols_cast = cols_cast[:-2] # remove last coma and space
-        # insert inserted and modified
-        pcur.execute("INSERT INTO "+table_schema+"."+table+" ("+cols+") "
-            "SELECT "+cols_cast+" FROM "+diff_schema+"."+table+"_diff "
-            "WHERE "+branch+"_rev_begin = "+str(rev+1))
-        
-        # apdate deleted and modified
-        pcur.execute("UPDATE "+table_schema+"."+table+" AS dest "
-                "SET ("+branch+"_rev_end, "+branch+"_child)"
-                "=(src."+branch+"_rev_end, src."+branch+"_child) "
-                "FROM "+diff_schema+"."+table+"_diff AS src "
-                "WHERE dest."+pkey+" = src."+pkey+" "
-                "AND src."+branch+"_rev_end = "+str(rev))
+        if nb_of_updated_layer:
+            for [rev, branch, table_schema, table] in versioned_layers:
+                pkey = pg_pk( pcur, table_schema, table )
+                pcur.execute("SELECT MAX(rev) FROM "+table_schema+".revisions")
+                [rev] = pcur.fetchone()
+                pcur.execute("SELECT MAX("+pkey+") FROM "+table_schema+"."+table)
+                [max_pk] = pcur.fetchone()
+                if not max_pk :
+                    max_pk = 0
+                scur.execute("UPDATE initial_revision "
+                    "SET rev = "+str(rev)+", max_pk = "+str(max_pk)+" "
+                    "WHERE table_schema = '"+table_schema+"' "
+                    "AND table_name = '"+table+"' "
+                    "AND branch = '"+branch+"'")
+                sp_update_fid_counter( scur, table, max_pk )
+
+        scur.commit()
+        scur.close()
 
+        # cleanup diffs in postgis
+        for schema in schema_list:
+            pcur.execute("DROP SCHEMA "+schema+" CASCADE")
         pcur.commit()
-        pcur.close()
 
-        scur.commit()
+        return nb_of_updated_layer
+
+def changeset_header( kind, **fields ):
+    """Returns the first line of a changeset file of kind ('commit' or
+    'update') with the additional fields"""
+    header = {'format': 'qgis-versioning-changeset', 'version': 1,
+            'kind': kind, 'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+    header.update(fields)
+    return json.dumps(header)+'\n'
+
+def sp_changeset_rows( scur, table, branch, rev, columns ):
+    """Yield the rows of the working copy table to commit since rev as JSON
+    arrays of the columns, the geometry as hex encoded WKB"""
+    [diff_where, journal] = sp_diff_where( scur, table, branch, rev )
+    exprs = [ "AsBinary("+quote_ident(col)+")" if col.upper() == 'GEOMETRY'
+            else quote_ident(col) for col in columns ]
+    for row in scur.iterate("SELECT "+', '.join(exprs)+" FROM "+table+" "
+            "WHERE "+diff_where+" ORDER BY OGC_FID"):
+        yield json.dumps([ str(value).encode('hex')
+            if isinstance(value, buffer) else value for value in row ])
+
+def sp_changeset_digest( scur ):
+    """Returns the hash of the rows to commit of all the layers of a working
+    copy, to check that it did not change since a changeset was exported"""
+    digest = hashlib.sha1()
+    scur.execute("SELECT rev, branch, table_name FROM initial_revision")
+    for [rev, branch, table] in scur.fetchall():
+        scur.execute("PRAGMA table_info("+table+")")
+        columns = [col[1] for col in scur.fetchall()]
+        for line in sp_changeset_rows( scur, table, branch, rev, columns ):
+            digest.update(line)
+    return digest.hexdigest()
+
+def export_changeset(sqlite_filename, filename, commit_msg):
+    """Write the modifications that commit would send to postgres in the
+    changeset file filename, to be applied later with apply_changeset. The
+    working copy is left as is until the reply of apply_changeset is merged
+    with import_changeset. Without modifications, the changeset only asks
+    for an update. Returns the number of rows written"""
+    unresolved = unresolved_conflicts(sqlite_filename)
+    if unresolved:
+        raise RuntimeError("There are unresolved conflicts in "
+            +sqlite_filename+" for table(s) "+', '.join(unresolved) )
 
-    if nb_of_updated_layer:
-        for [rev, branch, table_schema, table] in versioned_layers:
-            pcur = Db(psycopg2.connect(pg_conn_info))
+    scur = Db(dbapi2.connect(sqlite_filename))
+    sp_upgrade_initial_revision( scur )
+    scur.execute("SELECT rev, branch, table_schema, table_name, max_pk, "
+        "selection FROM initial_revision")
+    versioned_layers = scur.fetchall()
+    if not versioned_layers:
+        raise RuntimeError("Cannot find a versioned layer in "+sqlite_filename)
+
+    changeset_id = uuid.uuid4().hex
+    digest = hashlib.sha1()
+    nb_rows = 0
+    out = gzip.open(filename, 'wb')
+    out.write(changeset_header('commit', id = changeset_id,
+        commit_msg = commit_msg, author = get_username()))
+    for [rev, branch, table_schema, table, max_pk, selection] \
+            in versioned_layers:
+        scur.execute("PRAGMA table_info("+table+")")
+        columns = [col[1] for col in scur.fetchall()]
+        layer = {'table_schema': table_schema, 'table': table,
+                'branch': branch, 'rev': rev, 'max_pk': max_pk,
+                'selection': selection, 'columns': columns,
+                'max_fid': sp_fid_block( scur, table )}
+        # apply_changeset reserves a new block of ids when needed
+        if layer['max_fid'] is not None:
+            scur.execute("SELECT last_fid FROM fid_counter "
+                "WHERE table_name = '"+table+"'")
+            [layer['last_fid']] = scur.fetchone()
+        # the update of a partial working copy needs the pkeys of its local
+        # features that came from postgis, see update
+        if selection:
+            scur.execute("SELECT OGC_FID FROM "+table+" "
+                "WHERE OGC_FID <= "+str(max_pk)+" "
+                "AND ("+branch+"_rev_end IS NULL "
+                "OR "+branch+"_rev_end >= "+str(rev)+")")
+            layer['local_pks'] = [pk for [pk] in scur.fetchall()]
+        out.write(json.dumps(layer)+'\n')
+        for line in sp_changeset_rows( scur, table, branch, rev, columns ):
+            digest.update(line)
+            out.write(line+'\n')
+            nb_rows += 1
+    out.close()
+
+    scur.execute("CREATE TABLE IF NOT EXISTS changesets ("
+        "id VARCHAR PRIMARY KEY, digest VARCHAR, "
+        "exported DATETIME DEFAULT CURRENT_TIMESTAMP)")
+    scur.execute("INSERT INTO changesets (id, digest) "
+        "VALUES ('"+changeset_id+"', '"+digest.hexdigest()+"')")
+    scur.commit()
+    scur.close()
+    return nb_rows
+
+def pg_create_changesets( pcur, schema ):
+    """Create the table recording the changesets applied to schema and the
+    revision, max pkey and block of pkeys reserved for the working copy of
+    each table they were committed as, if it doesn't exist"""
+    if pg_has_table( pcur, schema, 'changesets' ):
+        pcur.execute("SELECT column_name FROM information_schema.columns "
+            "WHERE table_schema = '"+schema+"' "
+            "AND table_name = 'changesets' AND column_name = 'first_fid'")
+        if not pcur.fetchone():
+            pcur.execute("ALTER TABLE "+schema+".changesets "
+                "ADD COLUMN first_fid integer, "
+                "ADD COLUMN last_fid integer")
+        return
+    pcur.execute("CREATE TABLE "+schema+".changesets ("
+        "id varchar, "
+        "table_name varchar, "
+        "rev integer, "
+        "max_pk integer, "
+        "first_fid integer, "
+        "last_fid integer, "
+        "applied timestamp DEFAULT current_timestamp, "
+        "PRIMARY KEY (id, table_name))")
+    pg_invalidate_metadata( pcur, schema )
+
+def pg_changeset_fid_block( pcur, layer, diff_table ):
+    """Reserve a new block of pkeys for the table of layer, as described by
+    a layer of export_changeset, when sp_refill_fid_block would have. The
+    features inserted above the previous block are renumbered in diff_table
+    as sp_use_fid_block will renumber them in the working copy. Returns the
+    block [first, last], None if the working copy keeps its block"""
+    if layer.get('max_fid') is None:
+        return None
+    table_schema = layer['table_schema']
+    table = layer['table']
+    branch = layer['branch']
+    pkey = pg_pk( pcur, table_schema, table )
+    overflow = (pkey+" > "+str(layer['max_fid'])+" "
+        "AND "+branch+"_rev_begin = "+str(layer['rev']+1))
+    pcur.execute("SELECT COUNT(*) FROM "+diff_table+" WHERE "+overflow)
+    [nb] = pcur.fetchone()
+    if not nb and 2*(layer['max_fid'] - layer['last_fid']) >= pg_fid_block():
+        return None
+    block = pg_reserve_pks( pcur, table_schema, table, nb + pg_fid_block() )
+    if nb:
+        # children first, the mapping is computed from the old pkeys
+        mapping = ("(SELECT "+pkey+" AS old_pk, "+str(block[0]-1)+" "
+                "+ row_number() OVER (ORDER BY "+pkey+") AS new_pk "
+            "FROM "+diff_table+" WHERE "+overflow+") AS m")
+        pcur.execute("UPDATE "+diff_table+" AS d "
+            "SET "+branch+"_child = m.new_pk FROM "+mapping+" "
+            "WHERE d."+branch+"_child = m.old_pk")
+        pcur.execute("UPDATE "+diff_table+" AS d "
+            "SET "+pkey+" = m.new_pk FROM "+mapping+" "
+            "WHERE d."+pkey+" = m.old_pk")
+    return block
+
+def pg_export_update( pcur, out, layer, rev ):
+    """Write to the changeset file out the rows of the diff since rev of the
+    table of layer, as described by a layer of export_changeset, with the
+    columns of the working copy. Returns the number of rows written"""
+    table_schema = layer['table_schema']
+    table = layer['table']
+    pkey = pg_pk( pcur, table_schema, table )
+    pgeom = pg_geom( pcur, table_schema, table )
+    srid = pg_geom_type( pcur, table_schema, table, pgeom )[0]
+    mapping = sp_pg_mapping( layer['columns'], pkey, pgeom,
+            pg_columns( pcur, table_schema, table ) )
+    if layer['selection']:
+        pcur.execute("DROP TABLE IF EXISTS versioning_local_pks")
+        pcur.execute("CREATE TEMP TABLE versioning_local_pks "
+            "(pk integer PRIMARY KEY)")
+        pcur.executemany("INSERT INTO versioning_local_pks VALUES (%s)",
+            [(pk,) for pk in layer['local_pks']])
+    pcur.execute("SELECT MAX(rev) FROM "+table_schema+".revisions "
+        "WHERE branch = '"+layer['branch']+"'")
+    [max_rev] = pcur.fetchone()
+    [source, where] = pg_diff_source( pcur, table_schema, table,
+            layer['branch'], rev, max_rev, layer['selection'] )
+    [copy, converters, insert] = pg_to_sp_statements( pcur, source, where,
+            table+"_diff", mapping, srid )
+    converters = [ (lambda value: value.encode('hex')) if kind == 'geometry'
+            else convert
+            for convert, [sp_col, pg_col, kind] in zip(converters, mapping) ]
+    reader = CopyReader(converters, lambda rows: out.write(
+        ''.join([json.dumps(row)+'\n' for row in rows])))
+    start = time.time()
+    pcur.copy_expert(copy, reader)
+    reader.flush()
+    print_throughput("exported "+source+":", reader.count, start)
+    if layer['selection']:
+        pcur.execute("DROP TABLE versioning_local_pks")
+    return reader.count
+
+def apply_changeset(filename, pg_conn_info, reply_filename):
+    """Commit the changeset file written by export_changeset, as commit
+    would, and write in reply_filename the changes the working copy misses,
+    to be merged with import_changeset. The changeset is not committed if
+    the working copy was late, the reply then holds the update to merge
+    before exporting the modifications again. A changeset applied twice is
+    committed once. Returns True if the changeset is committed"""
+    reader = ChangesetReader(filename, 'commit')
+    header = reader.header
+    layers = [layer for layer in reader.layers()]
+    reader.close()
+
+    with pg_connect(pg_conn_info) as pcur:
+        schemas = sorted(set([layer['table_schema'] for layer in layers]))
+        # revision and max pkey of each table by (schema, table), for a
+        # changeset already committed, and the blocks of pkeys reserved
+        committed = {}
+        blocks = {}
+        for schema in schemas:
+            pg_create_changesets( pcur, schema )
+            pcur.execute("SELECT table_name, rev, max_pk, first_fid, last_fid "
+                "FROM "+schema+".changesets "
+                "WHERE id = '"+escape_quote(header['id'])+"'")
+            for [table, rev, max_pk, first_fid, last_fid] in pcur.fetchall():
+                committed[(schema, table)] = [rev, max_pk]
+                if first_fid is not None:
+                    blocks[(schema, table)] = [first_fid, last_fid]
+        pcur.commit()
+
+        late_by = 0
+        for layer in layers:
+            pcur.execute("SELECT MAX(rev) FROM "+layer['table_schema']+".revisions "
+                "WHERE branch = '"+layer['branch']+"'")
+            [max_rev] = pcur.fetchone()
+            late_by = max(max_rev - layer['rev'], late_by)
+
+        if not committed and not late_by:
+            schema_list = [] # for final cleanup
+            functions = {} # versioning_apply_diff is installed, by schema
+            reader = ChangesetReader(filename, 'commit')
+            for layer in reader.layers():
+                if not reader.has_rows():
+                    continue
+                table_schema = layer['table_schema']
+                table = layer['table']
+                branch = layer['branch']
+                rev = layer['rev']
+                diff_schema = (table_schema+"_"+branch+"_"+str(rev)+
+                        "_to_"+str(rev+1)+"_diff")
+                pkey = pg_pk( pcur, table_schema, table )
+                pgeom = pg_geom( pcur, table_schema, table )
+                srid = pg_geom_type( pcur, table_schema, table, pgeom )[0]
+                mapping = sp_pg_mapping( layer['columns'], pkey, pgeom,
+                        pg_columns( pcur, table_schema, table ) )
+                diff_columns = [m[1] for m in mapping]
+                diff_table = pg_create_diff( pcur, table_schema, table,
+                        diff_schema, diff_columns )
+                if pg_staging() == 'unlogged' and diff_schema not in schema_list:
+                    schema_list.append(diff_schema)
+                converters = [ (lambda value: wkb_to_ewkb(value.decode('hex'),
+                    srid)) if kind == 'geometry' else convert
+                    for convert, [sp_col, pg_col, kind] in zip(
+                        sp_to_pg_converters( pcur, mapping, srid ), mapping) ]
+                reader.indexes = [layer['columns'].index(m[0]) for m in mapping]
+                writer = CopyWriter(reader, converters)
+                start = time.time()
+                pcur.copy_expert("COPY "+diff_table+" ("
+                    +', '.join([quote_ident(col) for col in diff_columns])+") "
+                    "FROM STDIN", writer)
+                print_throughput("applied "+filename+" to "+diff_table+":",
+                        writer.count, start)
+                block = pg_changeset_fid_block( pcur, layer, diff_table )
+                if block:
+                    blocks[(table_schema, table)] = block
+                pg_apply_diff( pcur, table_schema, table, branch, rev,
+                        diff_table, diff_columns, header['commit_msg'],
+                        header['author'], functions )
+                # all the layers move to the new revision, as with commit
+                for other in layers:
+                    committed[(other['table_schema'], other['table'])] = \
+                            [other['rev'] + 1, 0]
+            reader.close()
+
+            for [schema, table] in committed:
+                pkey = pg_pk( pcur, schema, table )
+                pcur.execute("SELECT MAX("+pkey+") FROM "+schema+"."+table)
+                [max_pk] = pcur.fetchone()
+                committed[(schema, table)][1] = max_pk if max_pk else 0
+                block = blocks.get((schema, table), ['NULL', 'NULL'])
+                pcur.execute("INSERT INTO "+schema+".changesets "
+                    "(id, table_name, rev, max_pk, first_fid, last_fid) "
+                    "VALUES ('"+escape_quote(header['id'])+"', '"+table+"', "
+                        +str(committed[(schema, table)][0])+", "
+                        +str(committed[(schema, table)][1])+", "
+                        +str(block[0])+", "+str(block[1])+")")
+            # the whole changeset is committed at once
+            pcur.commit()
+            for schema in schema_list:
+                pcur.execute("DROP SCHEMA "+schema+" CASCADE")
+            pcur.commit()
+
+        out = gzip.open(reply_filename, 'wb')
+        out.write(changeset_header('update', changeset = header['id'],
+            committed = bool(committed)))
+        for layer in layers:
+            table_schema = layer['table_schema']
+            table = layer['table']
+            key = (table_schema, table)
+            rev = committed[key][0] if committed else layer['rev']
             pkey = pg_pk( pcur, table_schema, table )
-            pcur.execute("SELECT MAX(rev) FROM "+table_schema+".revisions")
-            [rev] = pcur.fetchone()
+            pgeom = pg_geom( pcur, table_schema, table )
+            pcur.execute("SELECT MAX(rev) FROM "+table_schema+".revisions "
+                "WHERE branch = '"+layer['branch']+"'")
+            [max_rev] = pcur.fetchone()
             pcur.execute("SELECT MAX("+pkey+") FROM "+table_schema+"."+table)
-            [max_pk] = pcur.fetchone()
-            if not max_pk :
-                max_pk = 0
-            pcur.close()
+            [max_pg_pk] = pcur.fetchone()
+            reply = {'table_schema': table_schema, 'table': table,
+                    'branch': layer['branch'], 'rev': rev, 'to_rev': max_rev,
+                    'max_pk': max_pg_pk if max_pg_pk else 0,
+                    'srid': pg_geom_type( pcur, table_schema, table, pgeom )[0],
+                    'columns': [m[0] for m in sp_pg_mapping( layer['columns'],
+                        pkey, pgeom, pg_columns( pcur, table_schema, table ) )]}
+            if committed:
+                reply['commit_max_pk'] = committed[key][1]
+                reply['fid_block'] = blocks.get(key)
+            out.write(json.dumps(reply)+'\n')
+            if max_rev != rev:
+                pg_export_update( pcur, out, layer, rev )
+        out.close()
+        pcur.commit()
+        return bool(committed)
+
+def import_changeset(sqlite_filename, filename):
+    """Merge the reply of apply_changeset into the working copy. If the
+    changeset exported from the working copy was committed, the working
+    copy moves to the new revision as with commit, the changes of others
+    are then merged as with update. Returns True if the changeset was
+    committed"""
+    if unresolved_conflicts(sqlite_filename):
+        raise RuntimeError("There are unresolved conflicts in "
+                +sqlite_filename)
+    reader = ChangesetReader(filename, 'update')
+    header = reader.header
+
+    scur = Db(dbapi2.connect(sqlite_filename))
+    sp_upgrade_initial_revision( scur )
+    if header['committed']:
+        scur.execute("SELECT name FROM sqlite_master "
+            "WHERE type = 'table' AND name = 'changesets'")
+        digest = None
+        if scur.fetchone():
+            scur.execute("SELECT digest FROM changesets "
+                "WHERE id = '"+header['changeset']+"'")
+            res = scur.fetchone()
+            digest = res[0] if res else None
+        if not digest:
+            raise RuntimeError("Changeset "+header['changeset']+" was not "
+                    "exported from "+sqlite_filename)
+        if digest != sp_changeset_digest( scur ):
+            raise RuntimeError(sqlite_filename+" was modified since "
+                    "changeset "+header['changeset']+" was exported")
+
+    scur.execute("SELECT table_schema, table_name, rev, max_pk "
+        "FROM initial_revision")
+    versioned_layers = dict([ ((table_schema, table), [rev, max_pk])
+        for [table_schema, table, rev, max_pk] in scur.fetchall() ])
+
+    for layer in reader.layers():
+        table = layer['table']
+        branch = layer['branch']
+        key = (layer['table_schema'], table)
+        if key not in versioned_layers:
+            raise RuntimeError("Cannot find "+'.'.join(key)+" in "
+                    +sqlite_filename)
+        [rev, current_max_pk] = versioned_layers[key]
+        if header['committed']:
+            rev += 1
+        if rev != layer['rev']:
+            raise RuntimeError(filename+" starts at revision "
+                    +str(layer['rev'])+" of "+'.'.join(key)+", "
+                    +sqlite_filename+" is at revision "+str(rev))
+        if header['committed']:
+            # the local modifications are now those of the revision, with
+            # the ids they were committed with
+            if layer.get('fid_block'):
+                [first, last] = layer['fid_block']
+                sp_use_fid_block( scur, table, branch, rev, first, last )
+            current_max_pk = layer['commit_max_pk']
             scur.execute("UPDATE initial_revision "
-                "SET rev = "+str(rev)+", max_pk = "+str(max_pk)+" "
-                "WHERE table_schema = '"+table_schema+"' "
+                "SET rev = "+str(rev)+", max_pk = "+str(current_max_pk)+" "
+                "WHERE table_schema = '"+layer['table_schema']+"' "
                 "AND table_name = '"+table+"' "
                 "AND branch = '"+branch+"'")
+            sp_update_fid_counter( scur, table, current_max_pk )
+            if sp_has_journal( scur, table ):
+                scur.execute("DELETE FROM "+table+"_dirty")
+        if layer['to_rev'] == rev:
+            continue
 
+        sp_create_like( scur, table, table+"_diff" )
+        converters = [ (lambda value: dbapi2.Binary(value.decode('hex')))
+                if col.upper() == 'GEOMETRY' else (lambda value: value)
+                for col in layer['columns'] ]
+        insert = ("INSERT INTO "+table+"_diff ("
+            +', '.join([quote_ident(col) for col in layer['columns']])+") "
+            "VALUES ("+', '.join([ "GeomFromWKB(?, "+str(layer['srid'])+")"
+                if col.upper() == 'GEOMETRY' else '?'
+                for col in layer['columns'] ])+")")
+        while True:
+            rows = reader.fetchmany(10000)
+            if not rows:
+                break
+            scur.executemany(insert, [ [ None if value is None
+                else convert(value)
+                for convert, value in zip(converters, row) ]
+                for row in rows ])
+        scur.commit()
+        if sp_fid_block( scur, table ) is not None:
+            current_max_pk = layer['max_pk']
+        sp_merge_diff( scur, table, branch, rev, layer['to_rev'],
+                current_max_pk, layer['max_pk'] )
+    reader.close()
+
+    if header['committed']:
+        scur.execute("DELETE FROM changesets "
+            "WHERE id = '"+header['changeset']+"'")
     scur.commit()
     scur.close()
+    return header['committed']
 
-    # cleanup diffs in postgis
-    for schema, conn_info in schema_list.iteritems():
-        pcur = Db(psycopg2.connect(conn_info))
-        pcur.execute("DROP SCHEMA "+schema+" CASCADE")
-        pcur.commit()
-        pcur.close()
-
-    return nb_of_updated_layer
-
-def historize( pg_conn_info, schema ):
-    """Create historisation for the given schema"""
+def pg_create_index( pcur, schema, name, definition ):
+    """Create index schema.name with definition (ON table...) unless
+    an index with this name already exists"""
+    pcur.execute("SELECT indexname FROM pg_indexes "
+        "WHERE schemaname = '"+schema+"' AND indexname = '"+name+"'")
+    if not pcur.fetchone():
+        pcur.execute("CREATE INDEX "+name+" "+definition)
+
+def pg_add_history_indexes( pcur, schema, table, branch, pkey ):
+    """Create the indexes used to navigate the history of branch in
+    schema.table: btree on each history column for the diffs and the
+    parent/child joins, partial indexes on the pkey and geometries of live
+    rows for the head views"""
+    for col in ['rev_begin', 'rev_end', 'parent', 'child']:
+        pg_create_index( pcur, schema, table+"_"+branch+"_"+col+"_idx",
+            "ON "+schema+"."+table+" ("+branch+"_"+col+")" )
+    live = branch+"_rev_end IS NULL AND "+branch+"_rev_begin IS NOT NULL"
+    pg_create_index( pcur, schema, table+"_"+branch+"_live_idx",
+        "ON "+schema+"."+table+" ("+pkey+") WHERE "+live )
+    for geom in pg_geoms( pcur, schema, table ):
+        pg_create_index( pcur, schema,
+            table+"_"+branch+"_live_"+geom+"_idx",
+            "ON "+schema+"."+table+" USING gist ("+geom+") WHERE "+live )
+
+def pg_add_revisions_index( pcur, schema ):
+    """Create the indexes for the lookup of revisions by branch and by
+    date"""
+    pg_create_index( pcur, schema, "revisions_branch_rev_idx",
+        "ON "+schema+".revisions (branch, rev)" )
+    pg_create_index( pcur, schema, "revisions_branch_date_idx",
+        "ON "+schema+".revisions (branch, date)" )
+
+def pg_revision_range( branch ):
+    """Returns the SQL expression of the range of revisions a row of branch
+    is part of"""
+    return ("int4range("+branch+"_rev_begin, "+branch+"_rev_end, '[]')")
+
+def pg_add_range_indexes( pcur, schema, table, branch ):
+    """Create the GiST indexes on the range of revisions of the rows of
+    branch in schema.table, alone and combined with each geometry, for
+    the revision queries of pg_revision_selection"""
+    where = " WHERE "+branch+"_rev_begin IS NOT NULL"
+    pg_create_index( pcur, schema, table+"_"+branch+"_range_idx",
+        "ON "+schema+"."+table+" "
+        "USING gist ("+pg_revision_range( branch )+")"+where )
+    for geom in pg_geoms( pcur, schema, table ):
+        pg_create_index( pcur, schema,
+            table+"_"+branch+"_range_"+geom+"_idx",
+            "ON "+schema+"."+table+" "
+            "USING gist ("+pg_revision_range( branch )+", "+geom+")"+where )
+
+def pg_has_range_index( pcur, schema, table, branch ):
+    """Returns True if the range of revisions of branch is indexed in
+    schema.table, see pg_add_range_indexes"""
+    pcur.execute("SELECT indexname FROM pg_indexes "
+        "WHERE schemaname = '"+schema+"' "
+        "AND indexname = '"+table+"_"+branch+"_range_idx'")
+    return pcur.fetchone() is not None
+
+def pg_install_functions( pcur, schema ):
+    """Create the server side functions of schema
+
+    versioning_apply_diff(tbl, diff, brch, from_rev, msg, usr) merges
+    the staged diff table (a table with the columns of schema.tbl,
+    history columns included) as revision from_rev+1 of branch brch: the
+    revision is created if needed, inserted and modified rows are added
+    and the end of deleted and modified rows is recorded. Columns of the
+    diff that are not in schema.tbl, history columns of other branches and
+    the partitioning column are ignored. Returns the number of rows in the diff, nothing is done
+    if it's empty."""
+    pcur.execute("CREATE OR REPLACE FUNCTION "
+            +schema+".versioning_apply_diff("
+            "tbl text, diff regclass, brch text, from_rev integer, "
+            "msg text, usr text) "
+        "RETURNS integer AS $$\n"
+        "DECLARE\n"
+            "target regclass := '"+schema+".'||quote_ident(tbl);\n"
+            "nb integer;\n"
+            "pkey text;\n"
+            "cols text;\n"
+        "BEGIN\n"
+            "EXECUTE 'SELECT COUNT(*) FROM '||diff INTO nb;\n"
+            "IF nb = 0 THEN\n"
+                "RETURN 0;\n"
+            "END IF;\n"
+
+            "INSERT INTO "+schema+".revisions "
+                "(rev, commit_msg, branch, author) "
+            "SELECT from_rev + 1, msg, brch, usr "
+            "WHERE NOT EXISTS (SELECT 1 FROM "+schema+".revisions "
+                "WHERE rev = from_rev + 1);\n"
+
+            "SELECT a.attname INTO pkey "
+            "FROM pg_index AS i JOIN pg_attribute AS a "
+                "ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey) "
+            "WHERE i.indrelid = target AND i.indisprimary "
+            "AND a.attname != 'versioning_live';\n"
+
+            "SELECT string_agg(quote_ident(d.attname), ', ') INTO cols "
+            "FROM pg_attribute AS d JOIN pg_attribute AS t "
+                "ON t.attname = d.attname "
+            "WHERE d.attrelid = diff AND t.attrelid = target "
+            "AND d.attnum > 0 AND NOT d.attisdropped "
+            "AND t.attnum > 0 AND NOT t.attisdropped "
+            "AND d.attname != 'versioning_live' "
+            "AND d.attname NOT IN (SELECT b.branch||c.suffix "
+                "FROM (SELECT DISTINCT branch FROM "+schema+".revisions "
+                    "WHERE branch != brch) AS b, "
+                "(VALUES ('_rev_begin'), ('_rev_end'), "
+                    "('_parent'), ('_child')) AS c(suffix));\n"
+
+            "EXECUTE format('INSERT INTO %s (%s) SELECT %s FROM %s "
+                "WHERE %I = %s', "
+                "target, cols, cols, diff, brch||'_rev_begin', from_rev + 1);\n"
+
+            "EXECUTE format('UPDATE %s AS dest SET (%I, %I) = "
+                "(src.%I, src.%I) FROM %s AS src "
+                "WHERE dest.%I = src.%I AND src.%I = %s', "
+                "target, brch||'_rev_end', brch||'_child', "
+                "brch||'_rev_end', brch||'_child', diff, "
+                "pkey, pkey, brch||'_rev_end', from_rev);\n"
+            "RETURN nb;\n"
+        "END;\n"
+        "$$ LANGUAGE plpgsql")
+
+def pg_has_function( pcur, schema, name ):
+    """Returns True if the function schema.name exists"""
+    pcur.execute("SELECT p.proname FROM pg_proc AS p "
+        "JOIN pg_namespace AS n ON n.oid = p.pronamespace "
+        "WHERE n.nspname = '"+schema+"' AND p.proname = '"+name+"'")
+    return pcur.fetchone() is not None
+
+def pg_live_selection( branches ):
+    """Returns the SQL predicate selecting the rows of a versioned table
+    that are in the head of at least one of the branches"""
+    return ' OR '.join([ "("+pg_revision_selection( branch, 'head' )+")"
+            for branch in branches ])
+
+def pg_repartition( pcur, schema, table, branches, revive = False,
+        ended = None ):
+    """Move the rows of the partitioned schema.table that are not in the
+    head of any branch anymore to the partition of historical rows, with
+    revive the historical rows back in a head are moved to the partition
+    of live rows (e.g. when a branch is created from an old revision).
+    ended is a query of the pkeys of the only rows to check (e.g. the ones
+    a commit just ended), all live rows are checked if None"""
+    live = pg_live_selection( branches )
+    pkey = pg_pk( pcur, schema, table )
+    pcur.execute("UPDATE "+schema+"."+table+" SET versioning_live = False "
+        "WHERE versioning_live AND NOT ("+live+")"
+        +(" AND "+pkey+" IN ("+ended+")" if ended else ""))
+    if revive:
+        pcur.execute("UPDATE "+schema+"."+table+" "
+            "SET versioning_live = True "
+            "WHERE NOT versioning_live AND ("+live+")")
+
+def pg_partition_table( pcur, schema, table, branches ):
+    """Replace schema.table by a table partitioned in live and historical
+    rows (see partition_history). The owner, privileges, comments,
+    constraints, indexes and triggers are carried over (see
+    pg_table_objects) but for the foreign keys of the table to itself, the
+    primary key gets the partitioning column, the head views of branches
+    are recreated"""
+    pkey = pg_pk( pcur, schema, table )
+    parts = schema+"_partitions"
+    table_name = schema+"."+table
+    objects = pg_table_objects( pcur, schema, table )
+    pcur.execute("SELECT obj_description("
+        "'"+table_name+"'::regclass, 'pg_class')")
+    [comment] = pcur.fetchone()
+
+    pcur.execute("CREATE TABLE "+schema+"."+table+"_partitioned "
+        "(LIKE "+schema+"."+table+" INCLUDING DEFAULTS INCLUDING COMMENTS "
+        "INCLUDING STORAGE, "
+        "versioning_live boolean NOT NULL DEFAULT True) "
+        "PARTITION BY LIST (versioning_live)")
+    pcur.execute("CREATE TABLE "+parts+"."+table+"_live "
+        "PARTITION OF "+schema+"."+table+"_partitioned "
+        "FOR VALUES IN (True)")
+    pcur.execute("CREATE TABLE "+parts+"."+table+"_history "
+        "PARTITION OF "+schema+"."+table+"_partitioned "
+        "FOR VALUES IN (False)")
+    pcur.execute("INSERT INTO "+schema+"."+table+"_partitioned "
+        "SELECT *, "+pg_live_selection( branches )+" "
+        "FROM "+schema+"."+table)
+    # the partitioning column must be part of the primary key
+    pcur.execute("ALTER TABLE "+schema+"."+table+"_partitioned "
+        "ADD PRIMARY KEY ("+pkey+", versioning_live)")
+
+    # the pkey sequence must survive the old table
+    pcur.execute("SELECT pg_get_serial_sequence('"+schema+"."+table+"', "
+        "'"+pkey+"')")
+    [sequence] = pcur.fetchone()
+    if sequence:
+        pcur.execute("ALTER SEQUENCE "+sequence+" OWNED BY NONE")
+
+    for branch in branches:
+        pcur.execute("DROP VIEW IF EXISTS "
+            +schema+"_"+branch+"_rev_head."+table)
+    try:
+        pcur.execute("DROP TABLE "+schema+"."+table)
+    except psycopg2.Error as error:
+        raise RuntimeError("Cannot partition "+schema+"."+table+", "
+            "remove the revision views and postgres working copies "
+            "using it first:\n"+str(error))
+    pcur.execute("ALTER TABLE "+schema+"."+table+"_partitioned "
+        "RENAME TO "+table)
+    if sequence:
+        pcur.execute("ALTER SEQUENCE "+sequence+" "
+            "OWNED BY "+schema+"."+table+"."+pkey)
+
+    # the pkey alone is not unique anymore, the parent and child columns
+    # cannot reference it, unique constraints and triggers must be
+    # supported by partitioned tables
+    try:
+        pcur.execute("ALTER TABLE "+table_name+" "
+            "OWNER TO "+objects['owner'])
+        pg_grant( pcur, table_name, objects['grants'] )
+        if comment is not None:
+            pcur.execute("COMMENT ON TABLE "+table_name+" "
+                "IS '"+escape_quote(comment)+"'")
+        for [name, definition, self_reference] in objects['constraints']:
+            if not self_reference \
+                    and not definition.startswith('PRIMARY KEY'):
+                pcur.execute("ALTER TABLE "+table_name+" "
+                    "ADD CONSTRAINT "+name+" "+definition)
+        for definition in objects['indexes']+objects['triggers']:
+            pcur.execute(definition)
+    except psycopg2.Error as error:
+        raise RuntimeError("Cannot partition "+table_name+":\n"+str(error))
+
+    pg_invalidate_metadata( pcur, schema )
+    for branch in branches:
+        pg_add_history_indexes( pcur, schema, table, branch, pkey )
+        pg_create_head_view( pcur, schema, table, branch, branches,
+                partitioned = True )
+
+def pg_create_head_view( pcur, schema, table, branch, branches,
+        security = ' WITH (security_barrier)', partitioned = False ):
+    """Create the view of the head revision of branch of schema.table in
+    schema_branch_rev_head, without the history columns of branches"""
+    history_columns = branch_columns( branches )
+    cols = ""
+    for [col, data_type] in pg_columns( pcur, schema, table ):
+        if col not in history_columns:
+            cols = quote_ident(col)+", "+cols
+    cols = cols[:-2] # remove last coma and space
+    pcur.execute("CREATE VIEW "+schema+"_"+branch+"_rev_head."+table+" "
+        +security+" AS "
+        "SELECT "+cols+" FROM "+schema+"."+table+" "
+        "WHERE "+pg_revision_selection( branch, 'head',
+            partitioned = partitioned ))
+
+def pg_branch_selection( branch, base_branch, base_rev ):
+    """Returns the condition on the rows of a table that are in a new branch
+    created from base_rev ('head' or a revision) of base_branch, None for
+    trunk where all rows are"""
+    if branch == 'trunk': # initial versioning
+        return None
+    if base_rev == 'head':
+        return (base_branch+"_rev_end IS NULL "
+            "AND "+base_branch+"_rev_begin IS NOT NULL")
+    return ("("+base_branch+"_rev_end IS NULL "
+            "OR "+base_branch+"_rev_end > "+str(base_rev)+") "
+        "AND "+base_branch+"_rev_begin IS NOT NULL")
+
+def pg_table_objects( pcur, schema, table ):
+    """Returns what a copy of schema.table made with CREATE TABLE AS misses,
+    from the catalog, as a dict of:
+    'columns' the (name, default, not null) of the columns,
+    'sequences' the (sequence, column) of the serial columns,
+    'constraints' the (name, definition, self reference) of the constraints,
+    primary key, unique and exclusion ones first, self reference is True
+    for the foreign keys to the table itself,
+    'indexes' and 'triggers' the definitions of the indexes not backing a
+    constraint and of the triggers,
+    'incoming' the (table, name, definition) of foreign keys of other tables,
+    'owner' and 'grants' the (grantee, privilege) of the table"""
+    oid = "'"+schema+"."+table+"'::regclass"
+    objects = {}
+    pcur.execute("SELECT a.attname, pg_get_expr(d.adbin, d.adrelid), "
+            "a.attnotnull "
+        "FROM pg_attribute AS a LEFT JOIN pg_attrdef AS d "
+            "ON d.adrelid = a.attrelid AND d.adnum = a.attnum "
+        "WHERE a.attrelid = "+oid+" AND a.attnum > 0 "
+        "AND NOT a.attisdropped")
+    objects['columns'] = pcur.fetchall()
+    objects['sequences'] = []
+    for [col, default, not_null] in objects['columns']:
+        pcur.execute("SELECT pg_get_serial_sequence('"+schema+"."+table+"', "
+            "'"+col+"')")
+        [sequence] = pcur.fetchone()
+        if sequence:
+            objects['sequences'].append([sequence, col])
+    pcur.execute("SELECT quote_ident(conname), pg_get_constraintdef(oid), "
+            "contype = 'f' AND confrelid = conrelid "
+        "FROM pg_constraint "
+        "WHERE conrelid = "+oid+" AND contype IN ('p', 'u', 'x', 'c', 'f') "
+        "ORDER BY contype IN ('p', 'u', 'x') DESC, conname")
+    objects['constraints'] = pcur.fetchall()
+    pcur.execute("SELECT pg_get_indexdef(i.indexrelid) FROM pg_index AS i "
+        "WHERE i.indrelid = "+oid+" AND NOT EXISTS ("
+            "SELECT 1 FROM pg_constraint AS c "
+            "WHERE c.conrelid = i.indrelid AND c.conindid = i.indexrelid)")
+    objects['indexes'] = [definition for [definition] in pcur.fetchall()]
+    pcur.execute("SELECT pg_get_triggerdef(oid) FROM pg_trigger "
+        "WHERE tgrelid = "+oid+" AND NOT tgisinternal")
+    objects['triggers'] = [definition for [definition] in pcur.fetchall()]
+    pcur.execute("SELECT conrelid::regclass::text, quote_ident(conname), "
+            "pg_get_constraintdef(oid) "
+        "FROM pg_constraint "
+        "WHERE confrelid = "+oid+" AND conrelid != "+oid+" "
+        "AND contype = 'f'")
+    objects['incoming'] = pcur.fetchall()
+    pcur.execute("SELECT quote_ident(pg_get_userbyid(relowner)) "
+        "FROM pg_class WHERE oid = "+oid)
+    [objects['owner']] = pcur.fetchone()
+    pcur.execute("SELECT CASE WHEN a.grantee = 0 THEN 'PUBLIC' "
+            "ELSE quote_ident(pg_get_userbyid(a.grantee)) END, "
+            "a.privilege_type "
+        "FROM pg_class AS c, aclexplode(c.relacl) AS a "
+        "WHERE c.oid = "+oid+" AND a.grantee != c.relowner")
+    objects['grants'] = pcur.fetchall()
+    return objects
+
+def pg_grant( pcur, table_name, grants ):
+    """Grant the (grantee, privilege) of grants on table_name"""
+    for [grantee, privilege] in grants:
+        pcur.execute("GRANT "+privilege+" ON "+table_name+" TO "+grantee)
+
+def pg_rebuild_table( pcur, schema, table, branch, rev, selection,
+        branches, security, references = True ):
+    """Replace schema.table by a copy with the history columns of branch,
+    rows matching selection (all if None) beginning at revision rev, as
+    add_branch would do with ALTER TABLE and UPDATE. The copy is made with
+    CREATE TABLE AS and the defaults, constraints, indexes, triggers,
+    privileges, foreign keys of other tables and head views of the other
+    branches are added afterwards, foreign keys and checks are validated
+    once added. Without references, the foreign keys of the columns of
+    branch are not created. Writes are blocked during the rebuild, reads are
+    not. Comments, rules and storage parameters are not kept. Returns False
+    if the table cannot be rebuilt (partitioned or identity columns)"""
+    if pg_is_partitioned( pcur, schema, table ):
+        return False
+    pcur.execute("SELECT column_name FROM information_schema.columns "
+        "WHERE table_schema = '"+schema+"' AND table_name = '"+table+"' "
+        "AND is_identity = 'YES'")
+    if pcur.fetchone():
+        print schema+"."+table+" has identity columns, it is altered in place"
+        return False
+
+    start = time.time()
+    print "rebuilding "+schema+"."+table
+    pcur.execute("LOCK TABLE "+schema+"."+table+" IN SHARE MODE")
+    pcur.execute("CREATE TABLE "+schema+"."+table+"_versioning_rebuild AS "
+        "SELECT *, "
+        +(str(rev) if not selection else
+            "CASE WHEN "+selection+" THEN "+str(rev)+" END")+"::integer "
+            "AS "+branch+"_rev_begin, "
+        "NULL::integer AS "+branch+"_rev_end, "
+        "NULL::integer AS "+branch+"_parent, "
+        "NULL::integer AS "+branch+"_child "
+        "FROM "+schema+"."+table)
+    print_throughput("copied "+schema+"."+table+":", pcur.rowcount(), start)
+
+    # what the copy misses, from the catalog
+    objects = pg_table_objects( pcur, schema, table )
+    columns = objects['columns']
+    sequences = objects['sequences']
+    constraints = [ [name, definition] for [name, definition, self_reference]
+            in objects['constraints'] ]
+    incoming = objects['incoming']
+
+    # swap
+    for old_branch in branches:
+        pcur.execute("DROP VIEW IF EXISTS "
+            +schema+"_"+old_branch+"_rev_head."+table)
+    for [sequence, col] in sequences:
+        pcur.execute("ALTER SEQUENCE "+sequence+" OWNED BY NONE")
+    for [other, name, definition] in incoming:
+        pcur.execute("ALTER TABLE "+other+" DROP CONSTRAINT "+name)
+    try:
+        pcur.execute("DROP TABLE "+schema+"."+table)
+    except psycopg2.Error as error:
+        raise RuntimeError("Cannot rebuild "+schema+"."+table+", "
+            "remove the revision views and postgres working copies "
+            "using it first:\n"+str(error))
+    pcur.execute("ALTER TABLE "+schema+"."+table+"_versioning_rebuild "
+        "RENAME TO "+table)
+    pg_invalidate_metadata( pcur, schema )
+
+    start = time.time()
+    table_name = schema+"."+table
+    # a single scan checks all the not null columns
+    actions = ["OWNER TO "+objects['owner']]
+    for [col, default, not_null] in columns:
+        if default:
+            actions.append("ALTER COLUMN "+quote_ident(col)+" "
+                "SET DEFAULT "+default)
+        if not_null:
+            actions.append("ALTER COLUMN "+quote_ident(col)+" SET NOT NULL")
+    pcur.execute("ALTER TABLE "+table_name+" "+', '.join(actions))
+    pg_grant( pcur, table_name, objects['grants'] )
+    for [sequence, col] in sequences:
+        pcur.execute("ALTER SEQUENCE "+sequence+" "
+            "OWNED BY "+table_name+"."+quote_ident(col))
+    # checks and foreign keys are added without scanning the table and
+    # validated afterwards, the ones that were not valid are left so
+    new_constraints = [ [table_name, name, definition]
+            for [name, definition] in constraints ]
+    if references:
+        new_constraints += [ [table_name, name, definition]
+            for [name, definition] in pg_branch_references( pcur, schema,
+                table, branch ) ]
+    new_constraints += incoming
+    for [target, name, definition] in new_constraints:
+        if definition.startswith('FOREIGN KEY') \
+                or definition.startswith('CHECK'):
+            validate = not definition.endswith('NOT VALID')
+            pcur.execute("ALTER TABLE "+target+" ADD CONSTRAINT "+name+" "
+                +definition+(" NOT VALID" if validate else ""))
+            if validate:
+                pcur.execute("ALTER TABLE "+target+" "
+                    "VALIDATE CONSTRAINT "+name)
+        else:
+            pcur.execute("ALTER TABLE "+target+" ADD CONSTRAINT "+name+" "
+                +definition)
+    for definition in objects['indexes']+objects['triggers']:
+        pcur.execute(definition)
+    print ("constraints and indexes of "+table_name+
+        " in %.2fs"%(time.time() - start))
+
+    for old_branch in branches:
+        if old_branch != branch and old_branch+"_rev_begin" in [ col
+                for [col, data_type] in pg_columns( pcur, schema, table ) ]:
+            pg_create_head_view( pcur, schema, table, old_branch, branches,
+                    security )
+    return True
+
+def pg_branch_references( pcur, schema, table, branch ):
+    """Returns the (name, definition) of the foreign keys of the history
+    columns of branch of schema.table, named as postgres would"""
+    pkey = pg_pk( pcur, schema, table )
+    refs = [['rev_begin', schema+".revisions(rev)"],
+            ['rev_end', schema+".revisions(rev)"]]
+    # the pkey alone is not unique in partitioned tables
+    if not pg_is_partitioned( pcur, schema, table ):
+        refs += [['parent', schema+"."+table+"("+pkey+")"],
+            ['child', schema+"."+table+"("+pkey+")"]]
+    return [ [table+"_"+branch+"_"+col+"_fkey",
+        "FOREIGN KEY ("+branch+"_"+col+") REFERENCES "+ref]
+        for [col, ref] in refs ]
+
+def pg_add_branch_references( pcur, schema, table, branch ):
+    """Add the foreign keys of the history columns of branch of
+    schema.table without checking the existing rows, they are NOT VALID
+    until pg_validate_branch_references. Postgres doesn't support that for
+    partitioned tables, they are checked right away"""
+    partitioned = pg_is_partitioned( pcur, schema, table )
+    pcur.execute("ALTER TABLE "+schema+"."+table+" "+', '.join([
+        "ADD CONSTRAINT "+name+" "+definition
+            +("" if partitioned else " NOT VALID")
+        for [name, definition] in pg_branch_references( pcur, schema,
+            table, branch ) ]))
+
+def pg_validate_branch_references( pcur, schema, table, branch ):
+    """Check the existing rows against the foreign keys added by
+    pg_add_branch_references, this does not block reads or writes"""
+    if pg_is_partitioned( pcur, schema, table ):
+        return
+    for [name, definition] in pg_branch_references( pcur, schema, table,
+            branch ):
+        pcur.execute("ALTER TABLE "+schema+"."+table+" "
+            "VALIDATE CONSTRAINT "+name)
+
+def pg_add_branch_columns( pcur, schema, table, branch, rev, selection,
+        branches, range_index, rebuild, security, references = True ):
+    """Add the history columns of branch to schema.table, the rows matching
+    selection (all if None) begin at revision rev, see add_branch for the
+    other parameters. Without references, the foreign keys of the columns
+    are not created (see pg_add_branch_references)"""
+    pkey = pg_pk( pcur, schema, table )
+    partitioned = pg_is_partitioned( pcur, schema, table )
+    rebuilt = rebuild and pg_rebuild_table( pcur, schema, table, branch,
+            rev, selection, branches, security, references )
+    if not rebuilt:
+        # the pkey alone is not unique in partitioned tables
+        pkey_ref = ("" if partitioned or not references else
+                " REFERENCES "+schema+"."+table+"("+pkey+")")
+        rev_ref = (" REFERENCES "+schema+".revisions(rev)"
+                if references else "")
+        pcur.execute("ALTER TABLE "+schema+"."+table+" "
+            "ADD COLUMN "+branch+"_rev_begin integer"+rev_ref+", "
+            "ADD COLUMN "+branch+"_rev_end   integer"+rev_ref+", "
+            "ADD COLUMN "+branch+"_parent    integer"+pkey_ref+","
+            "ADD COLUMN "+branch+"_child     integer"+pkey_ref)
+    pg_add_history_indexes( pcur, schema, table, branch, pkey )
+    if range_index:
+        pg_add_range_indexes( pcur, schema, table, branch )
+    if not rebuilt:
+        pcur.execute("UPDATE "+schema+"."+table+" "
+            "SET "+branch+"_rev_begin = "+str(rev)
+            +(" WHERE "+selection if selection else ""))
+    if partitioned:
+        pg_repartition( pcur, schema, table, branches, True )
+
+def pg_drop_branch_columns( pcur, schema, table, branch, branches ):
+    """Remove the history columns of branch from schema.table, the rows of
+    a partitioned table are moved back according to the other branches"""
+    pcur.execute("ALTER TABLE "+schema+"."+table+" "+', '.join([
+        "DROP COLUMN IF EXISTS "+branch+"_"+col
+        for col in ['rev_begin', 'rev_end', 'parent', 'child'] ]))
+    if pg_is_partitioned( pcur, schema, table ):
+        pg_repartition( pcur, schema, table,
+                [ other for other in branches if other != branch ] )
+
+def pg_create_branch( pcur, schema, branch, rev, commit_msg ):
+    """Insert the first revision of branch and create its head schema"""
+    pcur.execute("INSERT INTO "+schema+".revisions(rev, branch, commit_msg ) "
+        "VALUES ("+str(rev)+", '"+branch+"', '"+escape_quote(commit_msg)+"')")
+    pcur.execute("CREATE SCHEMA "+schema+"_"+branch+"_rev_head")
+    pg_add_revisions_index( pcur, schema )
+
+def historize( pg_conn_info, schema, range_index = False,
+        partition = False, rebuild = False ):
+    """Create historisation for the given schema, with range_index the
+    ranges of revisions are indexed (see pg_add_range_indexes), with
+    partition live and historical rows are stored separately (see
+    partition_history), with rebuild tables are copied and swapped instead
+    of being altered (see add_branch)"""
     if not schema:
         raise RuntimeError("no schema specified")
-    pcur = Db(psycopg2.connect(pg_conn_info))
-
-    pcur.execute("CREATE TABLE "+schema+".revisions ("
-        "rev serial PRIMARY KEY, "
-        "commit_msg varchar, "
-        "branch varchar DEFAULT 'trunk', "
-        "date timestamp DEFAULT current_timestamp, "
-        "author varchar)")
-    pcur.commit()
-    pcur.close()
-    add_branch( pg_conn_info, schema, 'trunk', 'initial commit' )
+    with pg_connect(pg_conn_info) as pcur:
+        pcur.execute("CREATE TABLE "+schema+".revisions ("
+            "rev serial PRIMARY KEY, "
+            "commit_msg varchar, "
+            "branch varchar DEFAULT 'trunk', "
+            "date timestamp DEFAULT current_timestamp, "
+            "author varchar)")
+        pg_install_functions( pcur, schema )
+        pcur.commit()
+    add_branch( pg_conn_info, schema, 'trunk', 'initial commit',
+            range_index = range_index, rebuild = rebuild )
+    if partition:
+        partition_history( pg_conn_info, schema )
 
 def add_branch( pg_conn_info, schema, branch, commit_msg,
-        base_branch='trunk', base_rev='head' ):
-    """Create a new branch (add 4 columns to tables)"""
-    pcur = Db(psycopg2.connect(pg_conn_info))
-
-    # check that branch doesn't exist and that base_branch exists
-    # and that base_rev is ok
-    pcur.execute("SELECT * FROM "+schema+".revisions "
-        "WHERE branch = '"+branch+"'")
-    if pcur.fetchone():
-        pcur.close()
-        raise RuntimeError("Branch "+branch+" already exists")
-    pcur.execute("SELECT * FROM "+schema+".revisions "
-        "WHERE branch = '"+base_branch+"'")
-    if branch != 'trunk' and not pcur.fetchone():
-        pcur.close()
-        raise RuntimeError("Base branch "+base_branch+" doesn't exist")
-    pcur.execute("SELECT MAX(rev) FROM "+schema+".revisions")
-    [max_rev] = pcur.fetchone()
-    if not max_rev: 
-        max_rev = 0
-    if base_rev != 'head' and (int(base_rev) > max_rev or int(base_rev) <= 0):
-        pcur.close()
-        raise RuntimeError("Revision "+str(base_rev)+" doesn't exist")
-    print 'max rev = ', max_rev
-
-    pcur.execute("INSERT INTO "+schema+".revisions(rev, branch, commit_msg ) "
-        "VALUES ("+str(max_rev+1)+", '"+branch+"', '"+escape_quote(commit_msg)+"')")
-    pcur.execute("CREATE SCHEMA "+schema+"_"+branch+"_rev_head")
+        base_branch='trunk', base_rev='head', range_index = None,
+        rebuild = False, jobs = 1 ):
+    """Create a new branch (add 4 columns to tables), with range_index the
+    ranges of revisions of the branch are indexed, by default they are in
+    the tables where they are for the base branch. With rebuild, tables are copied with the
+    new columns and swapped instead of being altered in place, which is
+    faster for large tables (see pg_rebuild_table).
+
+    With jobs > 1, the columns are added by jobs connections in parallel,
+    each table in its own transaction. The branch is then published in a
+    single transaction (revision, head views and foreign keys) and the
+    foreign keys are validated in parallel. If a revision is committed in
+    between, the columns are removed and RuntimeError is raised. With a
+    Session, jobs is capped to its pool (see pg_max_jobs).
+
+    Returns the list of (table, seconds) spent adding the columns"""
+    jobs = pg_max_jobs( pg_conn_info, jobs )
+    with pg_connect(pg_conn_info) as pcur:
+        # check that branch doesn't exist and that base_branch exists
+        # and that base_rev is ok
+        pcur.execute("SELECT * FROM "+schema+".revisions "
+            "WHERE branch = '"+branch+"' LIMIT 1")
+        if pcur.fetchone():
+            raise RuntimeError("Branch "+branch+" already exists")
+        pcur.execute("SELECT * FROM "+schema+".revisions "
+            "WHERE branch = '"+base_branch+"' LIMIT 1")
+        if branch != 'trunk' and not pcur.fetchone():
+            raise RuntimeError("Base branch "+base_branch+" doesn't exist")
+        pcur.execute("SELECT MAX(rev) FROM "+schema+".revisions")
+        [max_rev] = pcur.fetchone()
+        if not max_rev: 
+            max_rev = 0
+        if base_rev != 'head' and (int(base_rev) > max_rev or int(base_rev) <= 0):
+            raise RuntimeError("Revision "+str(base_rev)+" doesn't exist")
+        print 'max rev = ', max_rev
+
+        branches = pg_branches( pcur, schema )
+        if branch not in branches:
+            branches.append(branch)
+
+        security = ' WITH (security_barrier)'
+        pcur.execute("SELECT version()")
+        [version] = pcur.fetchone()
+        mtch = re.match( r'^PostgreSQL (\d+)\.(\d+)\.(\d+) ', version )
+        if mtch and int(mtch.group(1)) <= 9 and int(mtch.group(2)) <= 2 :
+            security = ''
+
+        # note: do not version views
+        # note: metadata are fetched before the tables are altered, the
+        # columns added bellow are history columns and excluded anyway
+        tables = []
+        range_indexes = {}
+        for table in pg_versioned_tables( pcur, schema ):
+            try:
+                pkey = pg_pk( pcur, schema, table )
+            except:
+                if 'VERSIONING_NO_PK' in os.environ and os.environ['VERSIONING_NO_PK'] == 'skip':
+                    print schema+'.'+table+' has no primary key, skipping'
+                    continue
+                else:
+                    raise RuntimeError(schema+'.'+table+' has no primary key')
+            range_indexes[table] = range_index if range_index is not None else (
+                    branch != base_branch and pg_has_range_index(
+                        pcur, schema, table, base_branch ))
+            tables.append(table)
+
+        rev = max_rev + 1
+        selection = pg_branch_selection( branch, base_branch, base_rev )
+        if jobs <= 1:
+            pg_create_branch( pcur, schema, branch, rev, commit_msg )
+            timings = []
+            for table in tables:
+                start = time.time()
+                pg_add_branch_columns( pcur, schema, table, branch, rev,
+                        selection, branches, range_indexes[table], rebuild,
+                        security )
+                pg_create_head_view( pcur, schema, table, branch, branches,
+                        security, pg_is_partitioned( pcur, schema, table ) )
+                timings.append( (table, time.time() - start) )
+            pg_invalidate_metadata( pcur, schema )
+            pcur.commit()
+            return timings
 
-    history_columns = sum([
-        [brch+'_rev_end', brch+'_rev_begin',
-        brch+'_child', brch+'_parent' ] for brch in pg_branches( pcur, schema )],[])
+        # the tables are altered without the revision of the branch, their
+        # foreign keys are added when it is published
+        pcur.commit()
+        [timings, error] = pg_parallel( pg_conn_info, [ (schema+"."+table,
+            lambda tcur, table=table: pg_add_branch_columns( tcur, schema,
+                table, branch, rev, selection, branches, range_indexes[table],
+                rebuild, security, False ))
+            for table in tables ], jobs )
+        if not error:
+            pg_invalidate_metadata( pcur, schema )
+            try:
+                # a revision committed meanwhile has the number of the branch
+                pg_create_branch( pcur, schema, branch, rev, commit_msg )
+            except psycopg2.IntegrityError:
+                pcur.con.rollback()
+                error = RuntimeError("Revision "+str(rev)+" was committed "
+                    "while creating branch "+branch+", try again")
+        if error:
+            for [name, seconds] in timings:
+                pg_drop_branch_columns( pcur, schema, name.split('.')[1],
+                        branch, branches )
+            pg_invalidate_metadata( pcur, schema )
+            pcur.commit()
+            raise error
+        for table in tables:
+            pg_add_branch_references( pcur, schema, table, branch )
+            pg_create_head_view( pcur, schema, table, branch, branches,
+                    security, pg_is_partitioned( pcur, schema, table ) )
+        pg_invalidate_metadata( pcur, schema )
+        pcur.commit()
 
-    security = ' WITH (security_barrier)'
-    pcur.execute("SELECT version()")
-    [version] = pcur.fetchone()
-    mtch = re.match( r'^PostgreSQL (\d+)\.(\d+)\.(\d+) ', version )
-    if mtch and int(mtch.group(1)) <= 9 and int(mtch.group(2)) <= 2 :
-        security = ''
+    [validated, error] = pg_parallel( pg_conn_info, [ (schema+"."+table,
+        lambda tcur, table=table: pg_validate_branch_references( tcur,
+            schema, table, branch ))
+        for table in tables ], jobs )
+    if error:
+        raise RuntimeError("Branch "+branch+" is created but the foreign "
+            "keys of its columns could not be validated: "+str(error))
+    return [ (name.split('.')[1], seconds) for [name, seconds] in timings ]
+
+def add_history_indexes( pg_conn_info, schema ):
+    """Create the missing indexes on the history columns of all branches
+    of a versioned schema, see pg_add_history_indexes"""
+    with pg_connect(pg_conn_info) as pcur:
+        branches = pg_branches( pcur, schema )
+        pg_add_revisions_index( pcur, schema )
+        for table in pg_versioned_tables( pcur, schema ):
+            try:
+                pkey = pg_pk( pcur, schema, table )
+            except:
+                print schema+'.'+table+' has no primary key, skipping'
+                continue
+            for branch in branches:
+                if branch+"_rev_begin" in [ col for [col, data_type]
+                        in pg_columns( pcur, schema, table ) ]:
+                    pg_add_history_indexes( pcur, schema, table, branch, pkey )
+        pcur.commit()
 
-    # note: do not version views
-    pcur.execute("SELECT table_name FROM information_schema.tables "
-        "WHERE table_schema = '"+schema+"' "
-        "AND table_type = 'BASE TABLE'")
-    for [table] in pcur.fetchall():
-        if table == 'revisions':
-            continue
+def partition_history( pg_conn_info, schema ):
+    """Store the live rows (in the head of a branch) and the historical rows
+    of the versioned tables of schema in separate partitions of the tables,
+    so that head views only read live rows. The partitions are in the
+    <schema>_partitions schema and a versioning_live column is added to the
+    tables and their primary key, the parent and child columns do not
+    reference the primary key anymore. Commits move the rows they supersede
+    to the historical partition. Requires PostgreSQL 11"""
+    with pg_connect(pg_conn_info) as pcur:
+        pcur.execute("SHOW server_version_num")
+        if int(pcur.fetchone()[0]) < 110000:
+            raise RuntimeError("Partitioning of versioned tables requires "
+                "PostgreSQL 11 or later")
+        pcur.execute("SELECT schema_name FROM information_schema.schemata "
+            "WHERE schema_name = '"+schema+"_partitions'")
+        if not pcur.fetchone():
+            pcur.execute("CREATE SCHEMA "+schema+"_partitions")
+        if pg_has_function( pcur, schema, 'versioning_apply_diff' ):
+            pg_install_functions( pcur, schema )
+        branches = pg_branches( pcur, schema )
+        for table in pg_versioned_tables( pcur, schema ):
+            if not pg_is_partitioned( pcur, schema, table ):
+                print "partitioning", schema+"."+table
+                pg_partition_table( pcur, schema, table, branches )
+        pg_invalidate_metadata( pcur, schema )
+        pcur.commit()
 
-        try:
-            pkey = pg_pk( pcur, schema, table )
-        except:
-            if 'VERSIONING_NO_PK' in os.environ and os.environ['VERSIONING_NO_PK'] == 'skip':
-                print schema+'.'+table+' has no primary key, skipping'
-            else:
-                raise RuntimeError(schema+'.'+table+' has no primary key')
+def add_range_indexes( pg_conn_info, schema ):
+    """Index the ranges of revisions of all branches of a versioned
+    schema, see pg_add_range_indexes"""
+    with pg_connect(pg_conn_info) as pcur:
+        branches = pg_branches( pcur, schema )
+        for table in pg_versioned_tables( pcur, schema ):
+            for branch in branches:
+                if branch+"_rev_begin" in [ col for [col, data_type]
+                        in pg_columns( pcur, schema, table ) ]:
+                    pg_add_range_indexes( pcur, schema, table, branch )
+        pcur.commit()
 
-        pcur.execute("ALTER TABLE "+schema+"."+table+" "
-            "ADD COLUMN "+branch+"_rev_begin integer "
-            "REFERENCES "+schema+".revisions(rev), "
-            "ADD COLUMN "+branch+"_rev_end   integer "
-            "REFERENCES "+schema+".revisions(rev), "
-            "ADD COLUMN "+branch+"_parent    integer "
-            "REFERENCES "+schema+"."+table+"("+pkey+"),"
-            "ADD COLUMN "+branch+"_child     integer "
-            "REFERENCES "+schema+"."+table+"("+pkey+")")
-        if branch == 'trunk': # initial versioning
-            pcur.execute("UPDATE "+schema+"."+table+" "
-                "SET "+branch+"_rev_begin = (SELECT MAX(rev) "
-                                            "FROM "+schema+".revisions)")
-        elif base_rev == "head":
-            pcur.execute("UPDATE "+schema+"."+table+" "
-                    "SET "+branch+"_rev_begin = (SELECT MAX(rev) "
-                                                "FROM "+schema+".revisions "
-                    "WHERE "+base_branch+"_rev_end IS NULL "
-                    "AND "+base_branch+"_rev_begin IS NOT NULL)")
-        else:
-            pcur.execute("UPDATE "+schema+"."+table+" "
-                    "SET "+branch+"_rev_begin = (SELECT MAX(rev) "
-                                                "FROM "+schema+".revisions)"
-                    "WHERE ("+base_branch+"_rev_end IS NULL "
-                            "OR "+base_branch+"_rev_end > "+base_rev+") "
-                    "AND "+base_branch+"_rev_begin IS NOT NULL")
-
-        pcur.execute("SELECT column_name "
-                "FROM information_schema.columns "
-                "WHERE table_schema = '"+schema+"' "
-                "AND table_name = '"+table+"'")
-        cols = ""
-        for [col] in pcur.fetchall():
-            if col not in history_columns:
-                cols = quote_ident(col)+", "+cols
-        cols = cols[:-2] # remove last coma and space
-        pcur.execute("CREATE VIEW "+schema+"_"+branch+"_rev_head."+table+" "
-            +security+" AS "
-            "SELECT "+cols+" FROM "+schema+"."+table+" "
-            "WHERE "+branch+"_rev_end IS NULL "
-            "AND "+branch+"_rev_begin IS NOT NULL")
-    pcur.commit()
-    pcur.close()
+def drop_orphan_diffs( pg_conn_info, schema ):
+    """Drop the diff schemas of schema (named
+    <schema>_<branch>_<rev>_to_<rev+1>_diff) left behind by interrupted
+    commits and updates. Schemas with a table locked by another session
+    belong to a running commit and are kept. Returns the list of dropped
+    schemas"""
+    with pg_connect(pg_conn_info) as pcur:
+        pcur.execute("SELECT n.nspname FROM pg_namespace AS n "
+            "WHERE n.nspname ~ '^"+schema+"_.+_[0-9]+_to_[0-9]+_diff$' "
+            "AND NOT EXISTS (SELECT 1 FROM pg_locks AS l "
+                "JOIN pg_class AS c ON c.oid = l.relation "
+                "WHERE c.relnamespace = n.oid AND l.pid != pg_backend_pid()) "
+            "ORDER BY n.nspname")
+        orphans = [orphan for [orphan] in pcur.fetchall()]
+        for orphan in orphans:
+            print "dropping orphan diff schema", orphan
+            pcur.execute("DROP SCHEMA "+orphan+" CASCADE")
+        pcur.commit()
+        return orphans
 
-def add_revision_view(pg_conn_info, schema, branch, rev):
-    """Create schema with views of the specified revision"""
-    pcur = Db(psycopg2.connect(pg_conn_info))
+def install_functions( pg_conn_info, schema ):
+    """Create or replace the server side functions used by commit in a
+    versioned schema, see pg_install_functions"""
+    with pg_connect(pg_conn_info) as pcur:
+        pg_install_functions( pcur, schema )
+        pcur.commit()
 
+def pg_revision_selection( branch, rev, ranges = False,
+        partitioned = False ):
+    """Returns the SQL predicate selecting the rows of a versioned table
+    that are part of revision rev of branch, rev can be 'head'. With
+    ranges, the predicate is on the range of revisions of the rows so that
+    the indexes of pg_add_range_indexes are used. With partitioned, the
+    head is only looked for in the partition of live rows"""
+    if rev == 'head':
+        return (branch+"_rev_end IS NULL "
+                "AND "+branch+"_rev_begin IS NOT NULL"
+                +(" AND versioning_live" if partitioned else ""))
+    if ranges:
+        return (branch+"_rev_begin IS NOT NULL "
+                "AND "+pg_revision_range( branch )+" @> "+str(int(rev)))
+    return ("("+branch+"_rev_end IS NULL "
+                "OR "+branch+"_rev_end >= "+str(rev)+") "
+            "AND "+branch+"_rev_begin <= "+str(rev))
+
+def revision_at( pg_conn_info, schema, date, branch = 'trunk' ):
+    """Returns the revision of branch that was the head at date (a datetime
+    or an SQL timestamp literal), None if the branch didn't exist yet"""
+    with pg_connect(pg_conn_info) as pcur:
+        pcur.execute("SELECT MAX(rev) FROM "+schema+".revisions "
+            "WHERE branch = '"+branch+"' "
+            "AND date <= '"+escape_quote(date)+"'::timestamp")
+        [rev] = pcur.fetchone()
+        return rev
+
+def pg_check_revision( pcur, schema, branch, rev ):
+    """Raise a RuntimeError if branch or revision rev (a number or 'head')
+    doesn't exist in schema"""
     pcur.execute("SELECT * FROM "+schema+".revisions "
-        "WHERE branch = '"+branch+"'")
+        "WHERE branch = '"+branch+"' LIMIT 1")
     if not pcur.fetchone():
-        pcur.close()
         raise RuntimeError("Branch "+branch+" doesn't exist")
+    if rev == 'head':
+        return
     pcur.execute("SELECT MAX(rev) FROM "+schema+".revisions")
     [max_rev] = pcur.fetchone()
     if int(rev) > max_rev or int(rev) <= 0:
-        pcur.close()
         raise RuntimeError("Revision "+str(rev)+" doesn't exist")
 
-    history_columns = sum([
-        [brch+'_rev_end', brch+'_rev_begin',
-        brch+'_child', brch+'_parent' ] for brch in pg_branches( pcur, schema )],[])
+def pg_snapshot_budget():
+    """Returns the size budget in bytes of the materialized revisions of a
+    schema, set in MB by the VERSIONING_SNAPSHOT_BUDGET environment
+    variable, 1024 by default"""
+    return int(float(os.environ.get('VERSIONING_SNAPSHOT_BUDGET', 1024))
+            *1024*1024)
 
-    rev_schema = schema+"_"+branch+"_rev_"+str(rev)
+def pg_has_table( pcur, schema, table ):
+    """Returns True if the table schema.table exists"""
+    pcur.execute("SELECT table_name FROM information_schema.tables "
+        "WHERE table_schema = '"+schema+"' AND table_name = '"+table+"'")
+    return pcur.fetchone() is not None
 
-    pcur.execute("SELECT schema_name FROM information_schema.schemata "
-        "WHERE schema_name = '"+rev_schema+"'")
-    if pcur.fetchone():
-        print rev_schema, ' already exists'
+def pg_create_revision_snapshots( pcur, schema ):
+    """Create the table recording the materialized revisions of schema,
+    their size and use, if it doesn't exist"""
+    if pg_has_table( pcur, schema, 'revision_snapshots' ):
         return
+    pcur.execute("CREATE TABLE "+schema+".revision_snapshots ("
+        "rev_schema varchar PRIMARY KEY, "
+        "branch varchar, "
+        "rev integer, "
+        "size bigint, "
+        "created timestamp DEFAULT current_timestamp, "
+        "last_used timestamp DEFAULT current_timestamp, "
+        "nb_uses integer DEFAULT 0, "
+        "scans bigint DEFAULT 0)")
+
+def pg_refresh_snapshot_usage( pcur, schema ):
+    """Record the use of the materialized revisions of schema since the
+    last refresh, table scans counted by the statistics collector (e.g.
+    when QGIS loads the layers) are uses"""
+    pcur.execute("UPDATE "+schema+".revision_snapshots AS s "
+        "SET nb_uses = s.nb_uses + GREATEST(st.scans - s.scans, 1), "
+            "scans = st.scans, last_used = current_timestamp "
+        "FROM (SELECT schemaname, "
+                "SUM(COALESCE(seq_scan, 0) + COALESCE(idx_scan, 0)) AS scans "
+            "FROM pg_stat_user_tables GROUP BY schemaname) AS st "
+        "WHERE st.schemaname = s.rev_schema AND st.scans != s.scans")
+
+def pg_evict_revision_snapshots( pcur, schema, budget, keep = None ):
+    """Drop the least recently used materialized revisions of schema until
+    their total size fits in budget (bytes), the rev_schema keep is never
+    dropped. Returns the list of dropped schemas"""
+    pg_refresh_snapshot_usage( pcur, schema )
+    pcur.execute("SELECT rev_schema, size "
+        "FROM "+schema+".revision_snapshots "
+        "ORDER BY rev_schema = '"+str(keep)+"' DESC, "
+            "last_used DESC, nb_uses DESC")
+    total = 0
+    evicted = []
+    for [rev_schema, size] in pcur.fetchall():
+        total += size
+        if total > budget and rev_schema != keep:
+            evicted.append(rev_schema)
+            total -= size
+    for rev_schema in evicted:
+        print "evicting materialized revision", rev_schema
+        pcur.execute("DROP SCHEMA "+rev_schema+" CASCADE")
+        pcur.execute("DELETE FROM "+schema+".revision_snapshots "
+            "WHERE rev_schema = '"+rev_schema+"'")
+    return evicted
+
+def evict_revision_snapshots( pg_conn_info, schema, budget = None ):
+    """Drop the least recently used materialized revisions of schema that
+    do not fit in budget (bytes, pg_snapshot_budget() by default), a budget
+    of 0 drops them all. Returns the list of dropped schemas"""
+    with pg_connect(pg_conn_info) as pcur:
+        evicted = []
+        if pg_has_table( pcur, schema, 'revision_snapshots' ):
+            evicted = pg_evict_revision_snapshots( pcur, schema,
+                    pg_snapshot_budget() if budget is None else budget )
+        pcur.commit()
+        return evicted
+
+def pg_diff_cache_budget():
+    """Returns the size budget in bytes of the cached diffs of a schema, set
+    in MB by the VERSIONING_DIFF_CACHE_BUDGET environment variable, 1024 by
+    default"""
+    return int(float(os.environ.get('VERSIONING_DIFF_CACHE_BUDGET', 1024))
+            *1024*1024)
+
+def pg_diff_cache_age():
+    """Returns the age in hours after which a cached diff is dropped, set by
+    the VERSIONING_DIFF_CACHE_AGE environment variable, 24 by default"""
+    return float(os.environ.get('VERSIONING_DIFF_CACHE_AGE', 24))
+
+def pg_evict_diff_cache( pcur, schema, budget, age ):
+    """Drop the cached diffs of schema that are stale (a newer revision of
+    their branch exists, or they were created before the last restart of the
+    server, which may have truncated them), older than age (hours), then the
+    least recently used ones until their total size fits in budget (bytes).
+    Returns the list of dropped tables"""
+    pcur.execute("SELECT cache_table, size, "
+            "(to_rev < (SELECT MAX(rev) FROM "+schema+".revisions AS r "
+                "WHERE r.branch = c.branch) "
+            "OR created < pg_postmaster_start_time() "
+            "OR created < current_timestamp - interval '"+str(age)+" hours') "
+        "FROM "+schema+".diff_cache AS c "
+        "ORDER BY last_used DESC, hits DESC")
+    total = 0
+    evicted = []
+    for [cache_table, size, expired] in pcur.fetchall():
+        total += size
+        if expired or total > budget:
+            evicted.append(cache_table)
+            total -= size
+    for cache_table in evicted:
+        pcur.execute("DROP TABLE IF EXISTS "+cache_table)
+        pcur.execute("DELETE FROM "+schema+".diff_cache "
+            "WHERE cache_table = '"+cache_table+"'")
+    return evicted
+
+def pg_diff_cache( pcur, schema, table, branch, rev, max_rev, where ):
+    """Returns the table holding the rows of schema.table matching where,
+    the diff of branch from rev to max_rev, or None if the diff cache is not
+    enabled for schema. The first request of a diff creates the table and
+    commits, the following ones of the same range only read it"""
+    if not pg_has_table( pcur, schema, 'diff_cache' ):
+        return None
+    cache_table = (schema+"_diff_cache."+table+"_"+branch+"_"
+            +str(rev)+"_to_"+str(max_rev))
+    # concurrent updates of the same range wait for the first one
+    pcur.execute("SELECT pg_advisory_xact_lock(hashtext('"+cache_table+"'))")
+    pcur.execute("UPDATE "+schema+".diff_cache "
+        "SET hits = hits + 1, last_used = current_timestamp "
+        "WHERE cache_table = '"+cache_table+"' "
+        "AND created >= pg_postmaster_start_time() "
+        "RETURNING cache_table")
+    if pcur.fetchone():
+        pcur.commit()
+        return cache_table
+    pg_evict_diff_cache( pcur, schema, pg_diff_cache_budget(),
+            pg_diff_cache_age() )
+    pcur.execute("DROP TABLE IF EXISTS "+cache_table)
+    pcur.execute("CREATE UNLOGGED TABLE "+cache_table+" AS "
+        "SELECT * FROM "+schema+"."+table+" WHERE "+where)
+    pcur.execute("INSERT INTO "+schema+".diff_cache "
+        "(cache_table, table_name, branch, from_rev, to_rev, size) "
+        "VALUES ('"+cache_table+"', '"+table+"', '"+branch+"', "
+            +str(rev)+", "+str(max_rev)+", "
+            "pg_total_relation_size('"+cache_table+"'))")
+    pcur.commit()
+    return cache_table
+
+def enable_diff_cache( pg_conn_info, schema ):
+    """Keep the diffs streamed by update() in schema_diff_cache, such that
+    working copies updated over the same range of revisions read a
+    precomputed result. Cached diffs are recorded in schema.diff_cache and
+    dropped when stale, older than pg_diff_cache_age() or when their total
+    size exceeds pg_diff_cache_budget(). Partial working copies are not
+    cached"""
+    with pg_connect(pg_conn_info) as pcur:
+        pcur.execute("SELECT schema_name FROM information_schema.schemata "
+            "WHERE schema_name = '"+schema+"_diff_cache'")
+        if not pcur.fetchone():
+            pcur.execute("CREATE SCHEMA "+schema+"_diff_cache")
+        if not pg_has_table( pcur, schema, 'diff_cache' ):
+            pcur.execute("CREATE TABLE "+schema+".diff_cache ("
+                "cache_table varchar PRIMARY KEY, "
+                "table_name varchar, "
+                "branch varchar, "
+                "from_rev integer, "
+                "to_rev integer, "
+                "size bigint, "
+                "created timestamp with time zone DEFAULT current_timestamp, "
+                "last_used timestamp with time zone DEFAULT current_timestamp, "
+                "hits integer DEFAULT 0)")
+        pg_invalidate_metadata( pcur, schema )
+        pcur.commit()
 
-    security = ' WITH (security_barrier)'
-    pcur.execute("SELECT version()")
-    [version] = pcur.fetchone()
-    mtch = re.match( r'^PostgreSQL (\d+)\.(\d+)\.(\d+) ', version )
-    if mtch and int(mtch.group(1)) <= 9 and int(mtch.group(2)) <= 2 :
-        security = ''
+def evict_diff_cache( pg_conn_info, schema, budget = None, age = None ):
+    """Drop the cached diffs of schema that are stale, older than age
+    (hours, pg_diff_cache_age() by default) or do not fit in budget (bytes,
+    pg_diff_cache_budget() by default), a budget of 0 drops them all.
+    Returns the list of dropped tables"""
+    with pg_connect(pg_conn_info) as pcur:
+        evicted = []
+        if pg_has_table( pcur, schema, 'diff_cache' ):
+            evicted = pg_evict_diff_cache( pcur, schema,
+                    pg_diff_cache_budget() if budget is None else budget,
+                    pg_diff_cache_age() if age is None else age )
+        pcur.commit()
+        return evicted
 
-    pcur.execute("CREATE SCHEMA "+rev_schema)
+def add_revision_view(pg_conn_info, schema, branch, rev,
+        materialize = False, budget = None):
+    """Create schema with views of the specified revision
 
-    pcur.execute("SELECT table_name FROM information_schema.tables "
-        "WHERE table_schema = '"+schema+"' "
-        "AND table_type = 'BASE TABLE'")
+    If materialize is True, the revision is stored in indexed tables
+    instead of views. Materialized revisions are recorded in
+    schema.revision_snapshots and the least recently used ones are
+    dropped when their total size exceeds budget (bytes,
+    pg_snapshot_budget() by default)"""
+    with pg_connect(pg_conn_info) as pcur:
+        pg_check_revision( pcur, schema, branch, rev )
 
-    for [table] in pcur.fetchall():
-        if table == 'revisions':
-            continue
-        pcur.execute("SELECT column_name "
-                "FROM information_schema.columns "
-                "WHERE table_schema = '"+schema+"' "
-                "AND table_name = '"+table+"'")
-        cols = ""
-        for [col] in pcur.fetchall():
-            if col not in history_columns:
-                cols = quote_ident(col)+", "+cols
-        cols = cols[:-2] # remove last coma and space
-        pcur.execute("CREATE VIEW "+rev_schema+"."+table+" "+security+" AS "
-           "SELECT "+cols+" FROM "+schema+"."+table+" "
-           "WHERE ("+branch+"_rev_end IS NULL "
-                   "OR "+branch+"_rev_end >= "+str(rev)+") "
-           "AND "+branch+"_rev_begin <= "+str(rev))
+        history_columns = branch_columns( pg_branches( pcur, schema ) )
 
-    pcur.commit()
-    pcur.close()
+        rev_schema = schema+"_"+branch+"_rev_"+str(rev)
+
+        pcur.execute("SELECT schema_name FROM information_schema.schemata "
+            "WHERE schema_name = '"+rev_schema+"'")
+        if pcur.fetchone():
+            print rev_schema, ' already exists'
+            if pg_has_table( pcur, schema, 'revision_snapshots' ):
+                pcur.execute("UPDATE "+schema+".revision_snapshots "
+                    "SET nb_uses = nb_uses + 1, last_used = current_timestamp "
+                    "WHERE rev_schema = '"+rev_schema+"'")
+                pcur.commit()
+            return
+
+        security = ' WITH (security_barrier)'
+        pcur.execute("SELECT version()")
+        [version] = pcur.fetchone()
+        mtch = re.match( r'^PostgreSQL (\d+)\.(\d+)\.(\d+) ', version )
+        if mtch and int(mtch.group(1)) <= 9 and int(mtch.group(2)) <= 2 :
+            security = ''
+
+        pcur.execute("CREATE SCHEMA "+rev_schema)
+
+        for table in pg_versioned_tables( pcur, schema ):
+            cols = ""
+            for [col, data_type] in pg_columns( pcur, schema, table ):
+                if col not in history_columns:
+                    cols = quote_ident(col)+", "+cols
+            cols = cols[:-2] # remove last coma and space
+            if not materialize:
+                pcur.execute("CREATE VIEW "+rev_schema+"."+table+" "
+                   +security+" AS "
+                   "SELECT "+cols+" FROM "+schema+"."+table+" "
+                   "WHERE "+pg_revision_selection( branch, rev,
+                       pg_has_range_index( pcur, schema, table, branch ) ))
+                continue
+
+            pcur.execute("CREATE TABLE "+rev_schema+"."+table+" AS "
+               "SELECT "+cols+" FROM "+schema+"."+table+" "
+               "WHERE "+pg_revision_selection( branch, rev,
+                   pg_has_range_index( pcur, schema, table, branch ) ))
+            pkey = pg_table_metadata( pcur, schema, table )['pkey']
+            if pkey:
+                pcur.execute("ALTER TABLE "+rev_schema+"."+table+" "
+                    "ADD PRIMARY KEY ("+pkey+")")
+            for geom in pg_geoms( pcur, schema, table ):
+                pcur.execute("CREATE INDEX "+table+"_"+geom+"_idx "
+                    "ON "+rev_schema+"."+table+" USING gist ("+geom+")")
+            pcur.execute("ANALYZE "+rev_schema+"."+table)
+
+        if materialize:
+            pg_create_revision_snapshots( pcur, schema )
+            pcur.execute("INSERT INTO "+schema+".revision_snapshots "
+                    "(rev_schema, branch, rev, size, scans) "
+                "SELECT '"+rev_schema+"', '"+branch+"', "+str(rev)+", "
+                    "COALESCE(SUM(pg_total_relation_size(relid)), 0), "
+                    "COALESCE(SUM(COALESCE(seq_scan, 0) "
+                        "+ COALESCE(idx_scan, 0)), 0) "
+                "FROM pg_stat_user_tables "
+                "WHERE schemaname = '"+rev_schema+"'")
+            pg_evict_revision_snapshots( pcur, schema,
+                pg_snapshot_budget() if budget is None else budget, rev_schema )
+
+        pcur.commit()
+
+def pg_feature_columns( pcur, schema, table ):
+    """Returns the columns of schema.table without the history columns
+    and its geometry columns"""
+    history_columns = branch_columns( pg_branches( pcur, schema ) )
+    return [ [ col for [col, data_type] in pg_columns( pcur, schema, table )
+                if col not in history_columns ],
+            pg_geoms( pcur, schema, table ) ]
+
+def features( pg_conn_info, schema, table, branch = 'trunk', rev = 'head',
+        bbox = None, itersize = None ):
+    """Yield the features of schema.table in revision rev (a number or
+    'head') of branch as dicts of column values, without the history
+    columns and with geometries as WKB strings.
+    bbox is a (xmin, ymin, xmax, ymax) tuple or a WKT polygon in the srid
+    of the table, only the features intersecting it are returned.
+    Features are read from a server side cursor by batches of itersize,
+    no view is created (see add_revision_view)"""
+    with pg_connect(pg_conn_info) as pcur:
+        pg_check_revision( pcur, schema, branch, rev )
+        [cols, geoms] = pg_feature_columns( pcur, schema, table )
+        where = pg_revision_selection( branch, rev,
+                pg_has_range_index( pcur, schema, table, branch ) )
+        selection = pg_selection( pcur, schema, table, bbox, None )
+        if selection:
+            where += " AND "+selection
+        for row in pcur.iterate("SELECT "+', '.join(
+                [ "ST_AsBinary("+quote_ident(col)+")" if col in geoms
+                    else quote_ident(col) for col in cols ])+" "
+                "FROM "+schema+"."+table+" WHERE "+where, itersize):
+            yield dict( zip( cols, [ str(value) if col in geoms
+                    and value is not None else value
+                    for col, value in zip(cols, row) ] ) )
+
+def export_features( pg_conn_info, schema, table, filename,
+        branch = 'trunk', rev = 'head', bbox = None ):
+    """Write the features of schema.table in revision rev of branch to a
+    CSV file with a header line, geometries as hexadecimal WKB, see
+    features(). Returns the number of features written"""
+    with pg_connect(pg_conn_info) as pcur:
+        [cols, geoms] = pg_feature_columns( pcur, schema, table )
+
+    count = 0
+    start = time.time()
+    with open(filename, 'wb') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(cols)
+        for feature in features( pg_conn_info, schema, table, branch, rev,
+                bbox ):
+            row = []
+            for col in cols:
+                value = feature[col]
+                if value is None:
+                    value = ''
+                elif col in geoms:
+                    value = value.encode('hex')
+                elif isinstance(value, unicode):
+                    value = value.encode('utf-8')
+                row.append(value)
+            writer.writerow(row)
+            count += 1
+    print_throughput("exported "+schema+"."+table+":", count, start)
+    return count
 
 def pg_branches(pcur, schema):
     """returns a list of branches for this schema"""
-    pcur.execute("SELECT DISTINCT branch FROM "+schema+".revisions")
-    return [ res for [res] in pcur.fetchall() ]
+    return list(pg_metadata( pcur, schema )['branches'])
+
+def branch_columns(branches):
+    """returns the list of columns added to versioned tables for branches,
+    and the partitioning column which is not specific to a branch"""
+    return sum([[brch+'_rev_begin', brch+'_rev_end',
+        brch+'_parent', brch+'_child'] for brch in branches],
+        ['versioning_live'])
 
 def revisions(pg_conn_info, schema):
     """returns a list of revisions for this schema"""
-    pcur = Db(psycopg2.connect(pg_conn_info))
-    pcur.execute("SELECT rev FROM "+schema+".revisions")
-    revs = []
-    for [res] in pcur.fetchall():
-        revs.append(res)
-    pcur.close()
-    return revs
+    with pg_connect(pg_conn_info) as pcur:
+        revs = []
+        for [res] in pcur.iterate("SELECT rev FROM "+schema+".revisions"):
+            revs.append(res)
+        return revs
 
 # functions checkout, update and commit for a posgres working copy
 # we don't want to duplicate data
 # we need the initial_revision table all the same
 # for each table we need a diff and a view and triggers
 
-def pg_checkout(pg_conn_info, pg_table_names, working_copy_schema):
+def pg_create_wc_view( pcur, wcs, schema, table, branch, selection ):
+    """Create or replace the view of schema.table in the postgres working
+    copy wcs: the rows of the diff alive in the working copy and the rows of
+    the revision checked out (matching selection if not None) that are not
+    in the diff. The sources are combined without deduplication, the diff
+    keys being excluded with an anti-join on the primary key, so that
+    conditions on the view (e.g. the extent of the map) reach the indexes of
+    the table: rows still live use the partial indexes of
+    pg_add_history_indexes, rows ended since use the index on rev_end"""
+    pkey = pg_pk( pcur, schema, table )
+    history_columns = [pkey] + branch_columns( pg_branches( pcur, schema ) )
+    cols = ""
+    for [col, data_type] in pg_columns( pcur, schema, table ):
+        if col not in history_columns:
+            cols = quote_ident(col)+", "+cols
+    cols = cols[:-2] # remove last coma and space
+    current_rev_sub = "(SELECT MAX(rev) FROM "+wcs+".initial_revision)"
+    base = ("SELECT "+pkey+", "+cols+" FROM "+schema+"."+table+" AS t "
+        "WHERE NOT EXISTS (SELECT 1 FROM "+wcs+"."+table+"_diff AS d "
+            "WHERE d."+pkey+" = t."+pkey+") "
+        "AND t."+branch+"_rev_begin <= "+current_rev_sub+" "
+        +("AND ("+selection+") " if selection else ""))
+    pcur.execute("CREATE OR REPLACE VIEW "+wcs+"."+table+"_view AS "
+        "SELECT "+pkey+", "+cols+" FROM "+wcs+"."+table+"_diff "
+        "WHERE ("+branch+"_rev_end IS NULL "
+        "OR "+branch+"_rev_end >= "+current_rev_sub+"+1 ) "
+        "AND "+branch+"_rev_begin IS NOT NULL "
+        "UNION ALL "
+        +base+"AND t."+branch+"_rev_end IS NULL "
+        "AND t."+branch+"_rev_begin IS NOT NULL "
+        "UNION ALL "
+        +base+"AND t."+branch+"_rev_end >= "+current_rev_sub)
+
+def pg_install_wc_functions( pcur, schema ):
+    """Create the trigger functions shared by the views of the postgres
+    working copies of schema and the working_copy_edits table describing
+    the edits of each working copy table
+
+    versioning_queue_edit(table, pkey), row trigger of the views, queues
+    the rows edited by a statement in table_edits of the working copy
+
+    versioning_flush_edits(table), statement trigger of the views, applies
+    the queued edits with the statements of working_copy_edits, $1 is the
+    revision of the working copy, $2 the id after which the new features
+    are numbered for working copies without pkey sequence (see the max_fid
+    query). Otherwise the new features take their ids from the sequence,
+    the versioned table is then locked as by an insert using the sequence
+    default, so that the ids are not taken during a reservation (see
+    pg_reserve_pks)"""
+    if not pg_has_table( pcur, schema, 'working_copy_edits' ):
+        pcur.execute("CREATE TABLE "+schema+".working_copy_edits ("
+            "working_copy varchar, "
+            "table_name varchar, "
+            "max_fid text, "
+            "sequence text, "
+            "inserts text[], "
+            "updates text[], "
+            "deletes text[], "
+            "PRIMARY KEY (working_copy, table_name))")
+        pg_invalidate_metadata( pcur, schema )
+    elif not pg_has_wc_sequences( pcur, schema ):
+        pcur.execute("ALTER TABLE "+schema+".working_copy_edits "
+            "ADD COLUMN sequence text")
+
+    pcur.execute("CREATE OR REPLACE FUNCTION "
+            +schema+".versioning_queue_edit() "
+        "RETURNS trigger AS $$\n"
+        "DECLARE\n"
+            "edits text := quote_ident(TG_TABLE_SCHEMA)||'.'"
+                "||quote_ident(TG_ARGV[0]||'_edits');\n"
+            "pkey text := quote_ident(TG_ARGV[1]);\n"
+        "BEGIN\n"
+            "IF TG_OP = 'DELETE' THEN\n"
+                "EXECUTE 'INSERT INTO '||edits||' "
+                    "SELECT ($1).*, ''D'', ($1).'||pkey USING OLD;\n"
+            "ELSIF TG_OP = 'UPDATE' THEN\n"
+                "EXECUTE 'INSERT INTO '||edits||' "
+                    "SELECT ($1).*, ''U'', ($2).'||pkey USING NEW, OLD;\n"
+            "ELSE\n"
+                "EXECUTE 'INSERT INTO '||edits||' "
+                    "SELECT ($1).*, ''I'', NULL::integer' USING NEW;\n"
+            "END IF;\n"
+            "RETURN NULL;\n"
+        "END;\n"
+        "$$ LANGUAGE plpgsql;")
+
+    pcur.execute("CREATE OR REPLACE FUNCTION "
+            +schema+".versioning_flush_edits() "
+        "RETURNS trigger AS $$\n"
+        "DECLARE\n"
+            "wc_rev integer;\n"
+            "wc_max_fid integer;\n"
+            "max_fid_query text;\n"
+            "seq text;\n"
+            "stmts text[];\n"
+            "stmt text;\n"
+        "BEGIN\n"
+            "SELECT max_fid, sequence, CASE TG_OP "
+                "WHEN 'INSERT' THEN inserts "
+                "WHEN 'UPDATE' THEN updates ELSE deletes END "
+            "INTO max_fid_query, seq, stmts "
+            "FROM "+schema+".working_copy_edits "
+            "WHERE working_copy = TG_TABLE_SCHEMA "
+            "AND table_name = TG_ARGV[0];\n"
+            "EXECUTE 'SELECT MAX(rev) FROM '"
+                "||quote_ident(TG_TABLE_SCHEMA)||'.initial_revision' "
+                "INTO wc_rev;\n"
+            "IF seq IS NULL THEN\n"
+                "EXECUTE max_fid_query INTO wc_max_fid;\n"
+            "ELSIF TG_OP <> 'DELETE' THEN\n"
+                "EXECUTE 'LOCK TABLE "+schema+".'||quote_ident(TG_ARGV[0])"
+                    "||' IN ROW EXCLUSIVE MODE';\n"
+            "END IF;\n"
+            "FOREACH stmt IN ARRAY stmts LOOP\n"
+                "EXECUTE stmt USING wc_rev, wc_max_fid;\n"
+            "END LOOP;\n"
+            "RETURN NULL;\n"
+        "END;\n"
+        "$$ LANGUAGE plpgsql;")
+
+def pg_has_wc_sequences( pcur, schema ):
+    """Returns True if the postgres working copies of schema may allocate
+    their feature ids from the pkey sequences (see pg_install_wc_functions),
+    working_copy_edits was created without them before"""
+    pcur.execute("SELECT column_name FROM information_schema.columns "
+        "WHERE table_schema = '"+schema+"' "
+        "AND table_name = 'working_copy_edits' AND column_name = 'sequence'")
+    return pcur.fetchone() is not None
+
+def pg_wc_sequence( pcur, wcs, schema, table ):
+    """Returns the sequence the postgres working copy wcs allocates the
+    feature ids of schema.table from, None if they are allocated after the
+    max pkey and bumped by pg_update"""
+    if not pg_has_wc_sequences( pcur, schema ):
+        return None
+    pcur.execute("SELECT sequence FROM "+schema+".working_copy_edits "
+        "WHERE working_copy = '"+wcs+"' AND table_name = '"+table+"'")
+    res = pcur.fetchone()
+    return res[0] if res else None
+
+def pg_create_wc_triggers( pcur, wcs, schema, table, branch ):
+    """Bind the view of schema.table in the postgres working copy wcs to
+    the trigger functions of schema (see pg_install_wc_functions) and
+    record the statements applying its edits. Views can't have transition
+    tables: the rows of a statement are queued in the unlogged table_edits
+    and the queue is applied at the end of the statement with set based
+    queries, the new feature ids are taken from the sequence of the pkey,
+    if any, or allocated at once after the max pkey"""
+    if not ( pg_has_function( pcur, schema, 'versioning_flush_edits' )
+            and pg_has_wc_sequences( pcur, schema ) ):
+        pg_install_wc_functions( pcur, schema )
+    pkey = pg_pk( pcur, schema, table )
+    history_columns = [pkey] + branch_columns( pg_branches( pcur, schema ) )
+    cols = ""
+    qcols = ""
+    tcols = ""
+    setcols = ""
+    for [col, data_type] in pg_columns( pcur, schema, table ):
+        if col not in history_columns:
+            cols = quote_ident(col)+", "+cols
+            qcols = "q."+quote_ident(col)+", "+qcols
+            tcols = "t."+quote_ident(col)+", "+tcols
+            setcols = (quote_ident(col)+" = q."+quote_ident(col)+", "
+                +setcols)
+    cols = cols[:-2]
+    qcols = qcols[:-2]
+    tcols = tcols[:-2]
+    setcols = setcols[:-2] # remove last coma and space
+    hcols = (pkey+", "+branch+"_rev_begin, "+branch+"_rev_end, "
+            +branch+"_parent")
+    thcols = ("t."+pkey+", t."+branch+"_rev_begin, t."+branch+"_rev_end, "
+            "t."+branch+"_parent")
+    diff = wcs+"."+table+"_diff"
+    edits = wcs+"."+table+"_edits"
+
+    # in the revision checked out
+    alive = ("t."+branch+"_rev_begin <= $1 "
+        "AND (t."+branch+"_rev_end IS NULL OR t."+branch+"_rev_end >= $1)")
+    in_table = ("EXISTS (SELECT 1 FROM "+schema+"."+table+" AS t "
+        "WHERE t."+pkey+" = q.versioning_pk AND "+alive+")")
+    # anywhere in the history
+    in_history = ("EXISTS (SELECT 1 FROM "+schema+"."+table+" AS t "
+        "WHERE t."+pkey+" = q.versioning_pk)")
+
+    # the queue has the columns of the view, it is empty between statements
+    pcur.execute("DROP TABLE IF EXISTS "+edits)
+    pcur.execute("CREATE UNLOGGED TABLE "+edits+" "
+        "AS SELECT * FROM "+wcs+"."+table+"_view WHERE False")
+    pcur.execute("ALTER TABLE "+edits+" "
+        "ADD COLUMN versioning_op char(1), "
+        "ADD COLUMN versioning_pk integer")
+
+    max_fid = ("SELECT MAX(max_fid) FROM ("
+        "SELECT MAX("+pkey+") AS max_fid FROM "+diff+" "
+        "UNION SELECT max_pk AS max_fid FROM "+wcs+".initial_revision "
+        "WHERE table_name = '"+table+"') AS src")
+    sequence = pg_pk_sequence( pcur, schema, table )
+    new_fid = ("nextval('"+sequence+"')" if sequence
+            else "$2 + row_number() OVER ()")
+
+    inserts = [
+        "INSERT INTO "+diff+" ("+pkey+", "+cols+", "+branch+"_rev_begin) "
+        "SELECT "+new_fid+", "+qcols+", $1+1 "
+        "FROM "+edits+" AS q WHERE versioning_op = 'I'" ]
+
+    updates = [
+        # features added since the revision checked out are updated
+        "UPDATE "+diff+" AS d SET "+setcols+" "
+        "FROM "+edits+" AS q "
+        "WHERE q.versioning_op = 'U' AND d."+pkey+" = q.versioning_pk "
+        "AND d."+branch+"_rev_begin = $1+1 "
+        "AND NOT "+in_table,
+
+        # features of the revision get a child, their copy in the diff
+        # is ended
+        "INSERT INTO "+diff+" ("+cols+", "+hcols+") "
+        "SELECT "+tcols+", "+thcols+" "
+        "FROM "+schema+"."+table+" AS t "
+        "JOIN "+edits+" AS q ON t."+pkey+" = q.versioning_pk "
+        "WHERE q.versioning_op = 'U' AND "+alive+" "
+        "AND NOT EXISTS (SELECT 1 FROM "+diff+" AS d "
+            "WHERE d."+pkey+" = t."+pkey+")",
+
+        "INSERT INTO "+diff+" "
+        "("+pkey+", "+cols+", "+branch+"_rev_begin, "+branch+"_parent) "
+        "SELECT "+new_fid+", "+qcols+", $1+1, q.versioning_pk "
+        "FROM "+edits+" AS q "
+        "WHERE q.versioning_op = 'U' AND "+in_table,
+
+        "UPDATE "+diff+" AS p "
+        "SET ("+branch+"_rev_end, "+branch+"_child) = ($1, c."+pkey+") "
+        "FROM "+diff+" AS c "
+        "WHERE c."+branch+"_parent = p."+pkey+" "
+        "AND p."+branch+"_child IS NULL "
+        "AND p."+pkey+" IN (SELECT versioning_pk FROM "+edits+" "
+            "WHERE versioning_op = 'U')" ]
+
+    deletes = [
+        # features of the table are copied in the diff and ended
+        "INSERT INTO "+diff+" ("+cols+", "+hcols+") "
+        "SELECT "+tcols+", "+thcols+" "
+        "FROM "+schema+"."+table+" AS t "
+        "JOIN "+edits+" AS q ON t."+pkey+" = q.versioning_pk "
+        "WHERE q.versioning_op = 'D' "
+        "AND NOT EXISTS (SELECT 1 FROM "+diff+" AS d "
+            "WHERE d."+pkey+" = t."+pkey+")",
+
+        "UPDATE "+diff+" AS d SET "+branch+"_rev_end = $1 "
+        "FROM "+edits+" AS q "
+        "WHERE q.versioning_op = 'D' AND d."+pkey+" = q.versioning_pk "
+        "AND "+in_history,
+
+        # features only in the diff are removed from their parent and
+        # deleted
+        "UPDATE "+diff+" AS d SET "+branch+"_child = NULL "
+        "FROM "+edits+" AS q "
+        "WHERE q.versioning_op = 'D' AND d."+branch+"_child = q.versioning_pk "
+        "AND NOT "+in_history,
+
+        "DELETE FROM "+diff+" AS d "
+        "USING "+edits+" AS q "
+        "WHERE q.versioning_op = 'D' AND d."+pkey+" = q.versioning_pk "
+        "AND NOT "+in_history ]
+
+    arrays = []
+    for stmts in [inserts, updates, deletes]:
+        arrays.append("ARRAY['"+"', '".join([ escape_quote(stmt)
+            for stmt in stmts+["DELETE FROM "+edits] ])+"']")
+    pcur.execute("DELETE FROM "+schema+".working_copy_edits "
+        "WHERE working_copy = '"+wcs+"' AND table_name = '"+table+"'")
+    pcur.execute("INSERT INTO "+schema+".working_copy_edits "
+        "(working_copy, table_name, max_fid, sequence, "
+            "inserts, updates, deletes) "
+        "VALUES ('"+wcs+"', '"+table+"', '"+escape_quote(max_fid)+"', "
+            +("'"+escape_quote(sequence)+"'" if sequence else "NULL")+", "
+            +", ".join(arrays)+")")
+
+    pcur.execute("DROP TRIGGER IF EXISTS queue_"+table+" "
+        "ON "+wcs+"."+table+"_view")
+    pcur.execute("CREATE TRIGGER queue_"+table+" "
+        "INSTEAD OF INSERT OR UPDATE OR DELETE ON "+wcs+"."+table+"_view "
+        "FOR EACH ROW EXECUTE PROCEDURE "
+        +schema+".versioning_queue_edit('"+table+"', '"+pkey+"')")
+    pcur.execute("DROP TRIGGER IF EXISTS flush_"+table+" "
+        "ON "+wcs+"."+table+"_view")
+    pcur.execute("CREATE TRIGGER flush_"+table+" "
+        "AFTER INSERT OR UPDATE OR DELETE ON "+wcs+"."+table+"_view "
+        "FOR EACH STATEMENT EXECUTE PROCEDURE "
+        +schema+".versioning_flush_edits('"+table+"')")
+
+    # functions of working copies created before the shared ones
+    for op in ['update', 'insert', 'delete']:
+        pcur.execute("DROP TRIGGER IF EXISTS "+op+"_"+table+" "
+            "ON "+wcs+"."+table+"_view")
+    for op in ['update', 'insert', 'delete', 'queue', 'flush']:
+        pcur.execute("DROP FUNCTION IF EXISTS "+wcs+"."+op+"_"+table+"()")
+
+def pg_renumber_wc_inserts( pcur, wcs, schema, table, branch, rev, max_pk ):
+    """Give the features inserted in the postgres working copy wcs since
+    rev, numbered after max_pk, ids reserved from the sequence of the pkey
+    of schema.table. Nothing is done if the pkey has no sequence"""
+    pkey = pg_pk( pcur, schema, table )
+    diff = wcs+"."+table+"_diff"
+    local = (branch+"_rev_begin = "+str(rev+1)+" "
+        "AND "+pkey+" > "+str(max_pk))
+    pcur.execute("SELECT COUNT(*) FROM "+diff+" WHERE "+local)
+    [nb] = pcur.fetchone()
+    if not nb:
+        return
+    block = pg_reserve_pks( pcur, schema, table, nb )
+    if not block:
+        return
+    # negative ids first, the block may overlap the current ones, children
+    # follow thanks to the ON UPDATE CASCADE
+    pcur.execute("UPDATE "+diff+" SET "+pkey+" = -"+pkey+" WHERE "+local)
+    pcur.execute("UPDATE "+diff+" AS d SET "+pkey+" = m.new_pk "
+        "FROM (SELECT "+pkey+" AS old_pk, "+str(block[0]-1)+" "
+                "+ row_number() OVER (ORDER BY "+pkey+" DESC) AS new_pk "
+            "FROM "+diff+" WHERE "+pkey+" < 0) AS m "
+        "WHERE d."+pkey+" = m.old_pk")
+
+def upgrade_working_copy_views(pg_conn_info, working_copy_schema):
+    """Recreate the views of a postgres working copy and their triggers,
+    for working copies created before the views were combined without
+    deduplication (see pg_create_wc_view), the edits were applied by
+    statement (see pg_create_wc_triggers) and the feature ids were reserved
+    from the pkey sequences. Features inserted before get reserved ids"""
+    wcs = working_copy_schema
+    with pg_connect(pg_conn_info) as pcur:
+        pg_upgrade_initial_revision( pcur, wcs )
+        pcur.execute("SELECT rev, branch, table_schema, table_name, max_pk, "
+            "selection FROM "+wcs+".initial_revision")
+        for [rev, branch, schema, table, max_pk, selection] in pcur.fetchall():
+            for geom in pg_geoms( pcur, schema, table ):
+                pg_create_index( pcur, wcs, table+"_diff_"+geom+"_idx",
+                    "ON "+wcs+"."+table+"_diff USING gist ("+geom+")" )
+            pg_create_wc_view( pcur, wcs, schema, table, branch, selection )
+            renumber = not pg_wc_sequence( pcur, wcs, schema, table )
+            pg_pk_sequence( pcur, schema, table, True )
+            pg_create_wc_triggers( pcur, wcs, schema, table, branch )
+            if renumber:
+                pg_renumber_wc_inserts( pcur, wcs, schema, table, branch,
+                        rev, max_pk )
+        pcur.commit()
+
+def pg_checkout(pg_conn_info, pg_table_names, working_copy_schema,
+        extent = None, filters = None):
     """create posgress working copy from versioned database tables
     pg_table_names must be complete schema.table names
     the schema name must end with _branch_rev_head
     the working_copy_schema must not exists
     the views and trigger for local edition will be created
-    along with the tables and triggers for conflict resolution"""
-    pcur = Db(psycopg2.connect(pg_conn_info))
-    wcs = working_copy_schema
-    pcur.execute("SELECT schema_name FROM information_schema.schemata "
-        "WHERE schema_name = '"+wcs+"'")
-    if pcur.fetchone():
-        raise RuntimeError("Schema "+wcs+" already exists")
-
+    along with the tables and triggers for conflict resolution
+    all tables are read from the same snapshot
+    for a partial checkout, only features intersecting extent (see
+    pg_selection) and matching filters[pg_table_name], an SQL expression,
+    are visible"""
+    trace.phase('pg_checkout', 'create')
     for pg_table_name in pg_table_names:
         [schema, table] = pg_table_name.split('.')
         if not ( schema and table and schema[-9:] == "_rev_head"):
             raise RuntimeError("Schema names must end with suffix "
                 "_branch_rev_head")
 
+    with pg_connect(pg_conn_info) as pcur:
+        # the new features take their ids from the pkey sequences, moved past
+        # the pkeys that did not come from them once, in their own transaction
+        for pg_table_name in pg_table_names:
+            [schema, table] = pg_table_name.split('.')
+            pg_pk_sequence( pcur, schema[:-9].rpartition('_')[0], table, True )
+        pcur.commit()
+        pg_begin_snapshot( pcur )
+        wcs = working_copy_schema
+        pcur.execute("SELECT schema_name FROM information_schema.schemata "
+            "WHERE schema_name = '"+wcs+"'")
+        if pcur.fetchone():
+            raise RuntimeError("Schema "+wcs+" already exists")
 
-    pcur.execute("CREATE SCHEMA "+wcs)
+        pcur.execute("CREATE SCHEMA "+wcs)
 
-    first_table = True
-    for pg_table_name in pg_table_names:
-        [schema, table] = pg_table_name.split('.')
-        [schema, sep, branch] = schema[:-9].rpartition('_')
-        del sep
+        first_table = True
+        for pg_table_name in pg_table_names:
+            [schema, table] = pg_table_name.split('.')
+            [schema, sep, branch] = schema[:-9].rpartition('_')
+            del sep
 
-        pkey = pg_pk( pcur, schema, table )
-        history_columns = [pkey] + sum([
-            [brch+'_rev_end', brch+'_rev_begin',
-            brch+'_child', brch+'_parent' ] for brch in pg_branches( pcur, schema )],[])
+            pkey = pg_pk( pcur, schema, table )
+            history_columns = [pkey] + branch_columns( pg_branches( pcur, schema ) )
+
+            # fetch the current rev
+            pcur.execute("SELECT MAX(rev) FROM "+schema+".revisions")
+            current_rev = int(pcur.fetchone()[0])
+
+            # max pkey for this table
+            pcur.execute("SELECT MAX("+pkey+") FROM "+schema+"."+table)
+            [max_pg_pk] = pcur.fetchone()
+            if not max_pg_pk :
+                max_pg_pk = 0
+            selection = pg_selection( pcur, schema, table, extent,
+                    filters.get(pg_table_name) if filters else None )
+            selection_value = ("'"+escape_quote(selection)+"'"
+                    if selection else "NULL")
+            if first_table:
+                first_table = False
+                pcur.execute("CREATE TABLE "+wcs+".initial_revision AS SELECT "
+                        +str(current_rev)+" AS rev, '"
+                        +branch+"'::varchar AS branch, '"
+                        +schema+"'::varchar AS table_schema, '"
+                        +table+"'::varchar AS table_name, "
+                        +str(max_pg_pk)+" AS max_pk, "
+                        +selection_value+"::text AS selection")
+            else:
+                pcur.execute("INSERT INTO "+wcs+".initial_revision"
+                "(rev, branch, table_schema, table_name, max_pk, selection) "
+                "VALUES ("+str(current_rev)+", '"+branch+"', '"+schema+"', "
+                    "'"+table+"', "+str(max_pg_pk)+", "+selection_value+")" )
 
-        # fetch the current rev
-        pcur.execute("SELECT MAX(rev) FROM "+schema+".revisions")
-        current_rev = int(pcur.fetchone()[0])
-
-        # max pkey for this table
-        pcur.execute("SELECT MAX("+pkey+") FROM "+schema+"."+table)
-        [max_pg_pk] = pcur.fetchone()
-        if not max_pg_pk :
-            max_pg_pk = 0
-        if first_table:
-            first_table = False
-            pcur.execute("CREATE TABLE "+wcs+".initial_revision AS SELECT "
-                    +str(current_rev)+" AS rev, '"
-                    +branch+"'::varchar AS branch, '"
-                    +schema+"'::varchar AS table_schema, '"
-                    +table+"'::varchar AS table_name, "
-                    +str(max_pg_pk)+" AS max_pk")
-        else:
-            pcur.execute("INSERT INTO "+wcs+".initial_revision"
-            "(rev, branch, table_schema, table_name, max_pk) "
-            "VALUES ("+str(current_rev)+", '"+branch+"', '"+schema+"', "
-                "'"+table+"', "+str(max_pg_pk)+")" )
-
-        # create diff, views and triggers
-        pcur.execute("SELECT column_name "
-                "FROM information_schema.columns "
-                "WHERE table_schema = '"+schema+"' "
-                "AND table_name = '"+table+"'")
-        cols = ""
-        newcols = ""
-        for [col] in pcur.fetchall():
-            if col not in history_columns:
-                cols = quote_ident(col)+", "+cols
-                newcols = "new."+quote_ident(col)+", "+newcols
-        cols = cols[:-2]
-        newcols = newcols[:-2] # remove last coma and space
-        hcols = (pkey+", "+branch+"_rev_begin, "+branch+"_rev_end, "
-                +branch+"_parent, "+branch+"_child")
-
-        pcur.execute("CREATE TABLE "+wcs+"."+table+"_diff "
-                "AS SELECT "+cols+" FROM "+schema+"."+table+" WHERE False")
-
-        pcur.execute("ALTER TABLE "+wcs+"."+table+"_diff "
-            "ADD COLUMN "+pkey+" integer PRIMARY KEY, "
-            "ADD COLUMN "+branch+"_rev_begin integer, "
-            "ADD COLUMN "+branch+"_rev_end   integer, "
-            "ADD COLUMN "+branch+"_parent    integer,"
-            "ADD COLUMN "+branch+"_child     integer "
-            "REFERENCES "+wcs+"."+table+"_diff("+pkey+") "
-            "ON UPDATE CASCADE ON DELETE CASCADE")
-
-
-        current_rev_sub = "(SELECT MAX(rev) FROM "+wcs+".initial_revision)"
-        pcur.execute("CREATE VIEW "+wcs+"."+table+"_view AS "
-                "SELECT "+pkey+", "+cols+" "
-                "FROM (SELECT "+cols+", "+hcols+" FROM "+wcs+"."+table+"_diff "
-                        "WHERE ("+branch+"_rev_end IS NULL "
-                        "OR "+branch+"_rev_end >= "+current_rev_sub+"+1 ) "
-                        "AND "+branch+"_rev_begin IS NOT NULL "
-                        "UNION "
-                        "(SELECT DISTINCT ON ("+pkey+") "+cols+", t."+hcols+" "
-                        "FROM "+schema+"."+table+" AS t "
-                        "LEFT JOIN (SELECT "+pkey+" FROM "+wcs+"."+table+"_diff) "
-                        "AS d "
-                        "ON t."+pkey+" = d."+pkey+" "
-                        "WHERE d."+pkey+" IS NULL "
-                        "AND t."+branch+"_rev_begin <= "+current_rev_sub+" "
-                        "AND ((t."+branch+"_rev_end IS NULL "
-                            "OR t."+branch+"_rev_end >= "+current_rev_sub+") "
-                            "AND t."+branch+"_rev_begin IS NOT NULL ))"
-                        ") AS src ")
-
-        max_fid_sub = ("( SELECT MAX(max_fid) FROM ( SELECT MAX("+pkey+") "
-            "AS max_fid FROM "+wcs+"."+table+"_diff "
-            "UNION SELECT max_pk AS max_fid "
-            "FROM "+wcs+".initial_revision "
-            "WHERE table_name = '"+table+"') AS src )")
-
-        pcur.execute("CREATE OR REPLACE FUNCTION myprt(error_message text) "
-        "RETURNS void as $$\n"
-            "begin\n"
-                "raise notice '%', error_message;\n"
-            "end;\n"
-            "$$ language plpgsql;")
-
-        pcur.execute("CREATE FUNCTION "+wcs+".update_"+table+"() "
-        "RETURNS trigger AS $$\n"
-            "BEGIN\n"
-                # when we edit something we already added , we just update
-                "UPDATE "+wcs+"."+table+"_diff "
-                "SET ("+cols+") = ("+newcols+") "
-                "WHERE "+pkey+" = OLD."+pkey+" "
-                "AND "+branch+"_rev_begin = "+current_rev_sub+"+1 "
-                "AND "
-                "(SELECT COUNT(*) FROM "+schema+"."+table+" "
-                    "WHERE "+pkey+" = OLD."+pkey+" "
-                    "AND "+branch+"_rev_begin <= "+current_rev_sub+" "
-                    "AND ("+branch+"_rev_end IS NULL "
-                        "OR "+branch+"_rev_end >= "+current_rev_sub+" ) "
-                ") = 0 ;"
-
-                # insert the parent in diff if not already there
-                "INSERT INTO "+wcs+"."+table+"_diff "
-                "("+cols+", "+pkey+", "+branch+"_rev_begin, "
-                    +branch+"_rev_end, "+branch+"_parent ) "
-                "SELECT "+cols+", "+pkey+", "+branch+"_rev_begin, "
-                    +branch+"_rev_end, "+branch+"_parent "
-                "FROM "+schema+"."+table+" "
-                "WHERE "+pkey+" = OLD."+pkey+" "
-                "AND "+branch+"_rev_begin <= "+current_rev_sub+" "
-                "AND (SELECT COUNT(*) FROM "+wcs+"."+table+"_diff "
-                    "WHERE "+pkey+" = OLD."+pkey+" "
-                    "AND "+branch+"_rev_end = "+current_rev_sub+" ) = 0 ;"
-
-                # when we edit something old, we insert new
-                "INSERT INTO "+wcs+"."+table+"_diff "
-                "("+pkey+", "+cols+", "+branch+"_rev_begin, "+branch+"_parent) "
-                "SELECT "+max_fid_sub+"+1, "+newcols+", "
-                    +current_rev_sub+"+1, OLD."+pkey+" "
-                "WHERE (SELECT COUNT(*) FROM "+schema+"."+table+" "
-                    "WHERE "+pkey+" = OLD."+pkey+" "
-                    "AND "+branch+"_rev_begin <= "+current_rev_sub+" "
-                    "AND ("+branch+"_rev_end IS NULL "
-                        "OR "+branch+"_rev_end >= "+current_rev_sub+" ) "
-                    ") = 1; "
-
-                # update the parent in diff if it comes from the table
-                # (i.e not the diff)
-                "UPDATE "+wcs+"."+table+"_diff "
-                    "SET ("+branch+"_rev_end, "+branch+"_child) "
-                    "= ("+current_rev_sub+", "+max_fid_sub+") "
-                    "WHERE "+pkey+" = OLD."+pkey+" "
-                    "AND (SELECT COUNT(*) FROM "+schema+"."+table+" "
-                    "WHERE "+pkey+" = OLD."+pkey+" "
-                    "AND "+branch+"_rev_begin <= "+current_rev_sub+" "
-                    "AND ("+branch+"_rev_end IS NULL "
-                        "OR "+branch+"_rev_end >= "+current_rev_sub+")) = 1;\n"
-                "RETURN NULL;\n"
-            "END;\n"
-        "$$ LANGUAGE plpgsql;")
+            trace.phase('pg_checkout', 'views')
+            # create diff, views and triggers
+            cols = ""
+            for [col, data_type] in pg_columns( pcur, schema, table ):
+                if col not in history_columns:
+                    cols = quote_ident(col)+", "+cols
+            cols = cols[:-2] # remove last coma and space
 
-        pcur.execute("CREATE TRIGGER update_"+table+" "
-            "INSTEAD OF UPDATE ON "+wcs+"."+table+"_view "
-            "FOR EACH ROW EXECUTE PROCEDURE "+wcs+".update_"+table+"();")
+            pcur.execute("CREATE TABLE "+wcs+"."+table+"_diff "
+                    "AS SELECT "+cols+" FROM "+schema+"."+table+" WHERE False")
 
-        pcur.execute("CREATE FUNCTION "+wcs+".insert_"+table+"() "
-        "RETURNS trigger AS $$\n"
-            "BEGIN\n"
-                "INSERT INTO "+wcs+"."+table+"_diff "+
-                    "("+pkey+", "+cols+", "+branch+"_rev_begin) "
-                    "VALUES "
-                    "("+max_fid_sub+"+1, "+newcols+", "+current_rev_sub+"+1);\n"
-                "RETURN NULL;\n"
-            "END;\n"
-        "$$ LANGUAGE plpgsql;")
+            pcur.execute("ALTER TABLE "+wcs+"."+table+"_diff "
+                "ADD COLUMN "+pkey+" integer PRIMARY KEY, "
+                "ADD COLUMN "+branch+"_rev_begin integer, "
+                "ADD COLUMN "+branch+"_rev_end   integer, "
+                "ADD COLUMN "+branch+"_parent    integer,"
+                "ADD COLUMN "+branch+"_child     integer "
+                "REFERENCES "+wcs+"."+table+"_diff("+pkey+") "
+                "ON UPDATE CASCADE ON DELETE CASCADE")
 
-        pcur.execute("CREATE TRIGGER insert_"+table+" "
-            "INSTEAD OF INSERT ON "+wcs+"."+table+"_view "
-            "FOR EACH ROW EXECUTE PROCEDURE "+wcs+".insert_"+table+"();")
 
-        pcur.execute("CREATE FUNCTION "+wcs+".delete_"+table+"() "
-        "RETURNS trigger AS $$\n"
-            "BEGIN\n"
-                # insert if not already in diff
-                "INSERT INTO "+wcs+"."+table+"_diff "
-                    "SELECT "+cols+", "+hcols+" FROM epanet."+table+" "
-                    "WHERE "+pkey+" = OLD."+pkey+" "
-                    "AND (SELECT COUNT(*) FROM "+wcs+"."+table+"_diff "
-                    "WHERE "+pkey+" = OLD."+pkey+") = 0;\n"
-                # update if it comes from table (not diff)
-                "UPDATE "+wcs+"."+table+"_diff "
-                    "SET "+branch+"_rev_end = "+current_rev_sub+" "
-                    "WHERE "+pkey+" = OLD."+pkey+" "
-                    "AND (SELECT COUNT(*) FROM  "+schema+"."+table+" "
-                    "WHERE "+pkey+" = OLD."+pkey+") = 1; "
-
-                # if its just in diff, remove it from child
-                "UPDATE "+wcs+"."+table+"_diff "
-                    "SET "+branch+"_child = NULL "
-                    "WHERE "+branch+"_child = OLD."+pkey+" "
-                    "AND (SELECT COUNT(*) FROM  "+schema+"."+table+" "
-                    "WHERE "+pkey+" = OLD."+pkey+") = 0;\n"
-
-                # if it's just in diff, delete it
-                "DELETE FROM  "+wcs+"."+table+"_diff "
-                    "WHERE "+pkey+" = OLD."+pkey+" "
-                    "AND (SELECT COUNT(*) FROM  "+schema+"."+table+" "
-                    "WHERE "+pkey+" = OLD."+pkey+") = 0;\n"
-                "RETURN NULL;\n"
-            "END;\n"
-        "$$ LANGUAGE plpgsql;")
+            for geom in pg_geoms( pcur, schema, table ):
+                pg_create_index( pcur, wcs, table+"_diff_"+geom+"_idx",
+                    "ON "+wcs+"."+table+"_diff USING gist ("+geom+")" )
 
-        pcur.execute("CREATE TRIGGER delete_"+table+" "
-            "INSTEAD OF DELETE ON "+wcs+"."+table+"_view "
-            "FOR EACH ROW EXECUTE PROCEDURE "+wcs+".delete_"+table+"();")
+            pg_create_wc_view( pcur, wcs, schema, table, branch, selection )
 
-    pcur.commit()
-    pcur.close()
+            pcur.execute("CREATE OR REPLACE FUNCTION myprt(error_message text) "
+            "RETURNS void as $$\n"
+                "begin\n"
+                    "raise notice '%', error_message;\n"
+                "end;\n"
+                "$$ language plpgsql;")
+
+            pg_create_wc_triggers( pcur, wcs, schema, table, branch )
+
+        pcur.commit()
 
 def pg_update(pg_conn_info, working_copy_schema):
     """merge modifiactions since last update into working copy"""
     print "update"
+    trace.phase('pg_update', 'check')
     wcs = working_copy_schema
     if pg_unresolved_conflicts(pg_conn_info, wcs):
         raise RuntimeError("There are unresolved conflicts in "+wcs)
@@ -1318,237 +4080,173 @@ def pg_update(pg_conn_info, working_copy_schema):
     # merge changes and update target_revision
 
 
-    pcur = Db(psycopg2.connect(pg_conn_info))
-    pcur.execute("SELECT rev, branch, table_schema, table_name, max_pk "
-        "FROM "+wcs+".initial_revision")
-    versioned_layers = pcur.fetchall()
+    with pg_connect(pg_conn_info) as pcur:
+        pg_upgrade_initial_revision( pcur, wcs )
+        pcur.execute("SELECT rev, branch, table_schema, table_name, max_pk, "
+            "selection FROM "+wcs+".initial_revision")
+        versioned_layers = pcur.fetchall()
 
-    for [rev, branch, table_schema, table, current_max_pk] in versioned_layers:
-
-        pcur.execute("SELECT MAX(rev) FROM "+table_schema+".revisions "
-            "WHERE branch = '"+branch+"'")
-        [max_rev] = pcur.fetchone()
-        if max_rev == rev:
-            print ("Nothing new in branch "+branch+" "
-                "in "+table_schema+"."+table+" since last update")
-            continue
-
-        # get the max pkey
-        pkey = pg_pk( pcur, table_schema, table )
-        pgeom = pg_geom( pcur, table_schema, table )
-        pcur.execute("SELECT MAX("+pkey+") FROM "+table_schema+"."+table)
-        [max_pg_pk] = pcur.fetchone()
-        if not max_pg_pk :
-            max_pg_pk = 0
-
-        # create the diff
-        pcur.execute("SELECT column_name "
-                "FROM information_schema.columns "
-                "WHERE table_schema = '"+table_schema+"' "
-                "AND table_name = '"+table+"'")
-        cols = ""
-        for col in pcur.fetchall():
-            if col[0] != pgeom:
-                cols += quote_ident(col[0])+", "
-        cols = cols[:-2] # remove last coma and space
+        for [rev, branch, table_schema, table, current_max_pk, selection] \
+                in versioned_layers:
 
-        pcur.execute("SELECT srid, type "
-            "FROM geometry_columns "
-            "WHERE f_table_schema = '"+table_schema+"' "
-            "AND f_table_name ='"+table+"' AND f_geometry_column = '"+pgeom+"'")
-        srid_type = pcur.fetchone()
-        [srid, geom_type] = srid_type if srid_type else [None, None]
-        pcur.execute( "DROP TABLE IF EXISTS "+wcs+"."+table+"_update_diff "
-            "CASCADE")
-        geom = (", "+pgeom+"::geometry('"+geom_type+"', "+str(srid)+") "
-            "AS "+pgeom) if pgeom else ''
-        pcur.execute( "CREATE TABLE "+wcs+"."+table+"_update_diff AS "
-                "SELECT "+cols+geom+" "
-                "FROM "+table_schema+"."+table+" "
-                "WHERE "+branch+"_rev_end = "+str(rev)+" "
-                "OR "+branch+"_rev_begin > "+str(rev))
-        pcur.execute( "ALTER TABLE "+wcs+"."+table+"_update_diff "
-                "ADD CONSTRAINT "+table+"_"+branch+"_pk_pk "
-                "PRIMARY KEY ("+pkey+")")
-
-        # update the initial revision
-        pcur.execute("UPDATE "+wcs+".initial_revision "
-            "SET rev = "+str(max_rev)+", max_pk = "+str(max_pg_pk)+" "
-            "WHERE table_name = '"+table+"'")
+            pcur.execute("SELECT MAX(rev) FROM "+table_schema+".revisions "
+                "WHERE branch = '"+branch+"'")
+            [max_rev] = pcur.fetchone()
+            if max_rev == rev:
+                print ("Nothing new in branch "+branch+" "
+                    "in "+table_schema+"."+table+" since last update")
+                continue
 
-        pcur.execute("UPDATE "+wcs+"."+table+"_diff "
-                "SET "+branch+"_rev_end = "+str(max_rev)+" "
-                "WHERE "+branch+"_rev_end = "+str(rev))
-        pcur.execute("UPDATE "+wcs+"."+table+"_diff "
-                "SET "+branch+"_rev_begin = "+str(max_rev+1)+" "
-                "WHERE "+branch+"_rev_begin = "+str(rev+1))
+            trace.phase('pg_update', 'diff')
+            # get the max pkey
+            pkey = pg_pk( pcur, table_schema, table )
+            pgeom = pg_geom( pcur, table_schema, table )
+            pcur.execute("SELECT MAX("+pkey+") FROM "+table_schema+"."+table)
+            [max_pg_pk] = pcur.fetchone()
+            if not max_pg_pk :
+                max_pg_pk = 0
 
-        bump = max_pg_pk - current_max_pk
-        assert( bump >= 0)
-        # now bump the pks of inserted rows in working copy
-        # parents will be updated thanks to the ON UPDATE CASCADE
-        pcur.execute("UPDATE "+wcs+"."+table+"_diff "
-                "SET "+pkey+" = "+pkey+" + "+str(bump)+" "
-                "WHERE "+branch+"_rev_begin = "+str(max_rev+1))
-
-        # detect conflicts: conflict occur if two lines with the same pkey have
-        # been modified (i.e. have a non null child) or one has been removed
-        # and the other modified
-        pcur.execute("DROP VIEW IF EXISTS "+wcs+"."+table+"_conflicts_pk")
-        pcur.execute("CREATE VIEW "+wcs+"."+table+"_conflicts_pk AS "
-            "SELECT DISTINCT d."+pkey+" as conflict_deleted_pk "
-            "FROM "+wcs+"."+table+"_diff AS d, "
-                +wcs+"."+table+"_update_diff AS ud "
-            "WHERE d."+pkey+" = ud."+pkey+" "
-                "AND (d."+branch+"_child != ud."+branch+"_child "
-                "OR (d."+branch+"_child IS NULL "
-                    "AND ud."+branch+"_child IS NOT NULL) "
-                "OR (d."+branch+"_child IS NOT NULL "
-                    "AND ud."+branch+"_child IS NULL)) ")
-        pcur.execute("SELECT conflict_deleted_pk "
-            "FROM  "+wcs+"."+table+"_conflicts_pk" )
-        geom = ', '+pgeom if pgeom else ''
-        if pcur.fetchone():
-            print "there are conflicts"
-            # add layer for conflicts
-            pcur.execute("DROP TABLE IF EXISTS "+wcs+"."+table+"_cflt ")
-            pcur.execute("CREATE TABLE "+wcs+"."+table+"_cflt AS "
-                # insert new features from mine
-                "SELECT "+branch+"_parent AS conflict_id, 'mine' AS origin, "
-                    "'modified' AS action, "+cols+geom+" "
-                "FROM "+wcs+"."+table+"_diff, "
-                    +wcs+"."+table+"_conflicts_pk AS cflt "
-                "WHERE "+pkey+" = (SELECT "+branch+"_child "
-                                "FROM "+wcs+"."+table+"_diff "
-                                "WHERE "+pkey+" = conflict_deleted_pk) "
-                "UNION ALL "
-                # insert new features from theirs
-                "SELECT "+branch+"_parent AS conflict_id, 'theirs' AS origin, "
-                    "'modified' AS action, "+cols+geom+" "
-                "FROM "+wcs+"."+table+"_update_diff "+", "
-                    +wcs+"."+table+"_conflicts_pk AS cflt "
-                "WHERE "+pkey+" = (SELECT "+branch+"_child "
-                                "FROM "+wcs+"."+table+"_update_diff "
-                                "WHERE "+pkey+" = conflict_deleted_pk) "
-                 # insert deleted features from mine
-                "UNION ALL "
-                "SELECT "+branch+"_parent AS conflict_id, 'mine' AS origin, "
-                    "'deleted' AS action, "+cols+geom+" "
-                "FROM "+wcs+"."+table+"_diff, "
-                    +wcs+"."+table+"_conflicts_pk AS cflt "
-                "WHERE "+pkey+" = conflict_deleted_pk "
-                "AND "+branch+"_child IS NULL "
-                 # insert deleted features from theirs
-                "UNION ALL "
-                "SELECT "+branch+"_parent AS conflict_id, 'theirs' AS origin, "
-                    "'deleted' AS action, "+cols+geom+" "
-                "FROM "+wcs+"."+table+"_update_diff, "
-                    +wcs+"."+table+"_conflicts_pk AS cflt "
-                "WHERE "+pkey+" = conflict_deleted_pk "
-                "AND "+branch+"_child IS NULL" )
-
-            # identify conflicts for deleted
-            pcur.execute("UPDATE "+wcs+"."+table+"_cflt "
-                "SET conflict_id = "+pkey+" "+ "WHERE action = 'deleted'")
-
-            # now follow child if any for 'theirs' 'modified'
-            # since several edition could be made
-            # we want the very last child
-            while True:
-                pcur.execute("SELECT conflict_id, "+pkey+", "+branch+"_child "
-                    "FROM "+wcs+"."+table+"_cflt "
-                    "WHERE origin='theirs' "
-                    "AND action='modified' "
-                    "AND "+branch+"_child IS NOT NULL")
-                res = pcur.fetchall()
-                if not res :
-                    break
-                # replaces each entries by it's child
-                for [cflt_id, fid, child] in res:
-                    pcur.execute("DELETE FROM "+wcs+"."+table+"_cflt "
-                        "WHERE "+pkey+" = "+str(fid))
-                    pcur.execute("INSERT INTO "+wcs+"."+table+"_cflt "
-                        "SELECT "+str(cflt_id)+" AS conflict_id, "
-                            "'theirs' AS origin, 'modified' AS action, "
-                            +cols+" FROM "+wcs+"."+table+"_update_diff "
-                        "WHERE "+pkey+" = "+str(child)+" "
-                        "AND "+branch+"_rev_end IS NULL" )
-                    pcur.execute("INSERT INTO "+wcs+"."+table+"_cflt "
-                        "SELECT "+str(cflt_id)+" AS conflict_id, "
-                            "'theirs' AS origin, 'deleted' AS action, "
-                            +cols+" FROM "+wcs+"."+table+"_update_diff "
-                        "WHERE "+pkey+" = "+str(child)+" "
-                        "AND "+branch+"_rev_end IS NOT NULL" )
-
-            # create trigers such that on delete the conflict is resolved
-            # if we delete 'theirs', we set their child to our fid
-            # and their rev_end
-            # if we delete 'mine'... well, we delete 'mine'
-
-            pcur.execute("SELECT column_name "
-                    "FROM information_schema.columns "
-                    "WHERE table_schema = '"+wcs+"' "
-                    "AND table_name = '"+table+"_diff'")
+            # create the diff
             cols = ""
-            for col in pcur.fetchall():
-                cols += quote_ident(col[0])+", "
+            for [col, data_type] in pg_columns( pcur, table_schema, table ):
+                if col not in [pgeom, 'versioning_live']:
+                    cols += quote_ident(col)+", "
             cols = cols[:-2] # remove last coma and space
 
-            pcur.execute("CREATE OR REPLACE VIEW "
-                +wcs+"."+table+"_conflicts AS SELECT * "
-                "FROM  "+wcs+"."+table+"_cflt" )
-
-            pcur.execute("CREATE OR REPLACE FUNCTION "
-                +wcs+".delete_"+table+"_conflicts() RETURNS trigger AS $$\n"
-                "BEGIN\n"
-                    "DELETE FROM "+wcs+"."+table+"_diff "
-                    "WHERE "+pkey+" = OLD."+pkey+" AND OLD.origin = 'mine';\n"
-
-                    # we need to insert their parent to update it
-                    # if it's not already there
-                    "INSERT INTO "+wcs+"."+table+"_diff("+cols+") "
-                    "SELECT "+cols+" FROM "+table_schema+"."+table+" "
-                    "WHERE "+pkey+" = OLD."+branch+"_parent "
-                    "AND OLD.origin = 'theirs' "
-                    "AND (SELECT COUNT(*) FROM "+wcs+"."+table+"_diff "
-                        "WHERE "+pkey+" =  OLD."+branch+"_parent ) = 0;\n"
-
-                    "UPDATE "+wcs+"."+table+"_diff "
-                    "SET "+branch+"_child = (SELECT "+pkey+" "
-                                          "FROM "+wcs+"."+table+"_cflt "
-                                          "WHERE origin = 'mine' "
-                                          "AND conflict_id = OLD.conflict_id), "
-                          +branch+"_rev_end = "+str(max_rev)+" "
-                    "WHERE "+pkey+" = OLD."+pkey+" AND OLD.origin = 'theirs';\n"
-
-                    "UPDATE "+wcs+"."+table+"_diff "
-                    "SET "+branch+"_parent = OLD."+pkey+" "
-                    "WHERE "+pkey+" = (SELECT "+pkey+" FROM "+wcs+"."+table+"_cflt "
-                                    "WHERE origin = 'mine' "
-                                    "AND conflict_id = OLD.conflict_id) "
-                    "AND OLD.origin = 'theirs';\n"
-
-                    "DELETE FROM "+wcs+"."+table+"_cflt "
-                    "WHERE conflict_id = OLD.conflict_id;\n"
-                    "RETURN NULL;\n"
-                "END;\n"
-            "$$ LANGUAGE plpgsql;")
-
-            pcur.execute("DROP TRIGGER IF EXISTS "
-                "delete_"+table+"_conflicts ON "+wcs+"."+table+"_conflicts ")
-            pcur.execute("CREATE TRIGGER "
-                "delete_"+table+"_conflicts "
-                "INSTEAD OF DELETE ON "+wcs+"."+table+"_conflicts "
-                "FOR EACH ROW "
-                "EXECUTE PROCEDURE "+wcs+".delete_"+table+"_conflicts();")
-            pcur.commit()
-
-            pcur.execute("ALTER TABLE "+wcs+"."+table+"_cflt "
-                "ADD CONSTRAINT "+table+"_"+branch+"conflicts_pk_pk "
-                "PRIMARY KEY ("+pkey+")")
+            [srid, geom_type] = pg_geom_type( pcur, table_schema, table, pgeom )
+            pcur.execute( "DROP TABLE IF EXISTS "+wcs+"."+table+"_update_diff "
+                "CASCADE")
+            geom = (", "+pgeom+"::geometry('"+pg_typmod( geom_type,
+                pg_coord_dimension( pcur, table_schema, table, pgeom ) )+"', "
+                +str(srid)+") AS "+pgeom) if pgeom else ''
+            # throwaway data, not worth the WAL
+            pcur.execute( "CREATE UNLOGGED TABLE "
+                    +wcs+"."+table+"_update_diff AS "
+                    "SELECT "+cols+geom+" "
+                    "FROM "+table_schema+"."+table+" "
+                    "WHERE "+pg_diff_selection( table_schema, table, pkey,
+                        branch, rev, selection,
+                        "SELECT "+pkey+" FROM "+wcs+"."+table+"_diff" ))
+            pcur.execute( "ALTER TABLE "+wcs+"."+table+"_update_diff "
+                    "ADD CONSTRAINT "+table+"_"+branch+"_pk_pk "
+                    "PRIMARY KEY ("+pkey+")")
+
+            trace.phase('pg_update', 'bump')
+            # update the initial revision
+            pcur.execute("UPDATE "+wcs+".initial_revision "
+                "SET rev = "+str(max_rev)+", max_pk = "+str(max_pg_pk)+" "
+                "WHERE table_name = '"+table+"'")
+
+            pcur.execute("UPDATE "+wcs+"."+table+"_diff "
+                    "SET "+branch+"_rev_end = "+str(max_rev)+" "
+                    "WHERE "+branch+"_rev_end = "+str(rev))
+            pcur.execute("UPDATE "+wcs+"."+table+"_diff "
+                    "SET "+branch+"_rev_begin = "+str(max_rev+1)+" "
+                    "WHERE "+branch+"_rev_begin = "+str(rev+1))
+
+            bump = max_pg_pk - current_max_pk
+            assert( bump >= 0)
+            # now bump the pks of inserted rows in working copy, unless they
+            # were reserved from the sequence of the pkey
+            # parents will be updated thanks to the ON UPDATE CASCADE
+            if bump and not pg_wc_sequence( pcur, wcs, table_schema, table ):
+                pcur.execute("UPDATE "+wcs+"."+table+"_diff "
+                        "SET "+pkey+" = "+pkey+" + "+str(bump)+" "
+                        "WHERE "+branch+"_rev_begin = "+str(max_rev+1))
+
+            trace.phase('pg_update', 'conflicts')
+            # detect conflicts: conflict occur if two lines with the same pkey have
+            # been modified (i.e. have a non null child) or one has been removed
+            # and the other modified
+            pcur.execute("DROP VIEW IF EXISTS "+wcs+"."+table+"_conflicts_pk")
+            pcur.execute("CREATE VIEW "+wcs+"."+table+"_conflicts_pk AS "
+                "SELECT DISTINCT d."+pkey+" as conflict_deleted_pk "
+                "FROM "+wcs+"."+table+"_diff AS d, "
+                    +wcs+"."+table+"_update_diff AS ud "
+                "WHERE d."+pkey+" = ud."+pkey+" "
+                    "AND (d."+branch+"_child != ud."+branch+"_child "
+                    "OR (d."+branch+"_child IS NULL "
+                        "AND ud."+branch+"_child IS NOT NULL) "
+                    "OR (d."+branch+"_child IS NOT NULL "
+                        "AND ud."+branch+"_child IS NULL)) ")
+            pcur.execute("SELECT conflict_deleted_pk "
+                "FROM  "+wcs+"."+table+"_conflicts_pk LIMIT 1" )
+            if pcur.fetchone():
+                print "there are conflicts"
+                # add layer for conflicts
+                pcur.execute("DROP TABLE IF EXISTS "+wcs+"."+table+"_cflt ")
+                columns = [ col for [col, data_type]
+                        in pg_columns( pcur, wcs, table+"_diff" ) ]
+                pcur.execute("CREATE TABLE "+wcs+"."+table+"_cflt AS "
+                    +conflicts_query( wcs+"."+table+"_diff",
+                        wcs+"."+table+"_update_diff",
+                        wcs+"."+table+"_conflicts_pk", "conflict_deleted_pk",
+                        pkey, branch, columns ))
+
+                # create trigers such that on delete the conflict is resolved
+                # if we delete 'theirs', we set their child to our fid
+                # and their rev_end
+                # if we delete 'mine'... well, we delete 'mine'
+
+                cols = ""
+                for [col, data_type] in pg_columns( pcur, wcs, table+"_diff" ):
+                    cols += quote_ident(col)+", "
+                cols = cols[:-2] # remove last coma and space
+
+                pcur.execute("CREATE OR REPLACE VIEW "
+                    +wcs+"."+table+"_conflicts AS SELECT * "
+                    "FROM  "+wcs+"."+table+"_cflt" )
+
+                pcur.execute("CREATE OR REPLACE FUNCTION "
+                    +wcs+".delete_"+table+"_conflicts() RETURNS trigger AS $$\n"
+                    "BEGIN\n"
+                        "DELETE FROM "+wcs+"."+table+"_diff "
+                        "WHERE "+pkey+" = OLD."+pkey+" AND OLD.origin = 'mine';\n"
+
+                        # we need to insert their parent to update it
+                        # if it's not already there
+                        "INSERT INTO "+wcs+"."+table+"_diff("+cols+") "
+                        "SELECT "+cols+" FROM "+table_schema+"."+table+" "
+                        "WHERE "+pkey+" = OLD."+branch+"_parent "
+                        "AND OLD.origin = 'theirs' "
+                        "AND (SELECT COUNT(*) FROM "+wcs+"."+table+"_diff "
+                            "WHERE "+pkey+" =  OLD."+branch+"_parent ) = 0;\n"
+
+                        "UPDATE "+wcs+"."+table+"_diff "
+                        "SET "+branch+"_child = (SELECT "+pkey+" "
+                                              "FROM "+wcs+"."+table+"_cflt "
+                                              "WHERE origin = 'mine' "
+                                              "AND conflict_id = OLD.conflict_id), "
+                              +branch+"_rev_end = "+str(max_rev)+" "
+                        "WHERE "+pkey+" = OLD."+pkey+" AND OLD.origin = 'theirs';\n"
+
+                        "UPDATE "+wcs+"."+table+"_diff "
+                        "SET "+branch+"_parent = OLD."+pkey+" "
+                        "WHERE "+pkey+" = (SELECT "+pkey+" FROM "+wcs+"."+table+"_cflt "
+                                        "WHERE origin = 'mine' "
+                                        "AND conflict_id = OLD.conflict_id) "
+                        "AND OLD.origin = 'theirs';\n"
+
+                        "DELETE FROM "+wcs+"."+table+"_cflt "
+                        "WHERE conflict_id = OLD.conflict_id;\n"
+                        "RETURN NULL;\n"
+                    "END;\n"
+                "$$ LANGUAGE plpgsql;")
+
+                pcur.execute("DROP TRIGGER IF EXISTS "
+                    "delete_"+table+"_conflicts ON "+wcs+"."+table+"_conflicts ")
+                pcur.execute("CREATE TRIGGER "
+                    "delete_"+table+"_conflicts "
+                    "INSTEAD OF DELETE ON "+wcs+"."+table+"_conflicts "
+                    "FOR EACH ROW "
+                    "EXECUTE PROCEDURE "+wcs+".delete_"+table+"_conflicts();")
+                pcur.commit()
+
+                pcur.execute("ALTER TABLE "+wcs+"."+table+"_cflt "
+                    "ADD CONSTRAINT "+table+"_"+branch+"conflicts_pk_pk "
+                    "PRIMARY KEY ("+pkey+")")
 
-    pcur.commit()
-    pcur.close()
+        pcur.commit()
 
 def pg_commit(pg_conn_info, working_copy_schema, commit_msg):
     """merge modifications into database
@@ -1566,134 +4264,150 @@ def pg_commit(pg_conn_info, working_copy_schema, commit_msg):
             "is not up to date. It's late by "+str(late_by)+" commit(s).\n\n"
             "Please update before commiting your modifications")
 
-    pcur = Db(psycopg2.connect(pg_conn_info))
-    pcur.execute("SELECT rev, branch, table_schema, table_name "
-        "FROM "+wcs+".initial_revision")
-    versioned_layers = pcur.fetchall()
-
-    if not versioned_layers:
-        raise RuntimeError("Cannot find a versioned layer in "+wcs)
-
-
-    nb_of_updated_layer = 0
-    next_rev = 0
-    for [rev, branch, table_schema, table] in versioned_layers:
-        if next_rev:
-            assert( next_rev == rev + 1 )
-        else: next_rev = rev + 1
-
-        pkey = pg_pk( pcur, table_schema, table )
-        history_columns = [pkey] + sum([
-            [brch+'_rev_end', brch+'_rev_begin',
-            brch+'_child', brch+'_parent' ] for brch in pg_branches( pcur, table_schema )],[])
-        pcur.execute("SELECT column_name "
-                "FROM information_schema.columns "
-                "WHERE table_schema = '"+table_schema+"' "
-                "AND table_name = '"+table+"'")
-        cols = ""
-        for [col] in pcur.fetchall():
-            if col not in history_columns:
-                cols = quote_ident(col)+", "+cols
-        cols = cols[:-2] # remove last coma and space
-        hcols = (pkey+", "+branch+"_rev_begin, "+branch+"_rev_end, "
-                +branch+"_parent, "+branch+"_child")
+    trace.phase('pg_commit', 'diff')
+    with pg_connect(pg_conn_info) as pcur:
+        pcur.execute("SELECT rev, branch, table_schema, table_name "
+            "FROM "+wcs+".initial_revision")
+        versioned_layers = pcur.fetchall()
 
-        pcur.execute( "SELECT "+pkey+" FROM "+wcs+"."+table+"_diff")
-        there_is_something_to_commit = pcur.fetchone()
+        if not versioned_layers:
+            raise RuntimeError("Cannot find a versioned layer in "+wcs)
 
-        if not there_is_something_to_commit:
-            print "nothing to commit for ", table
-            continue
-        nb_of_updated_layer += 1
 
-        pcur.execute("SELECT rev FROM "+table_schema+".revisions "
-            "WHERE rev = "+str(rev+1))
-        if not pcur.fetchone():
-            print "inserting rev ", str(rev+1)
-            pcur.execute("INSERT INTO "+table_schema+".revisions "
-                "(rev, commit_msg, branch, author) "
-                "VALUES ("+str(rev+1)+", '"+escape_quote(commit_msg)+
-                "', '"+branch+"', '"+get_username()+"')")
-
-        # insert inserted and modified
-        pcur.execute("INSERT INTO "+table_schema+"."+table+" "
-            "("+cols+", "+hcols+") "
-            "SELECT "+cols+", "+hcols+" FROM "+wcs+"."+table+"_diff "
-            "WHERE "+branch+"_rev_begin = "+str(rev+1))
-
-        # update deleted and modified
-        pcur.execute("UPDATE "+table_schema+"."+table+" AS dest "
-                "SET ("+branch+"_rev_end, "+branch+"_child)"
-                    "=(src."+branch+"_rev_end, src."+branch+"_child) "
-                "FROM "+wcs+"."+table+"_diff AS src "
-                "WHERE dest."+pkey+" = src."+pkey+" "
-                "AND src."+branch+"_rev_end = "+str(rev))
-
-        # clears the diff
-        pcur.execute("DELETE FROM "+wcs+"."+table+"_diff")
-        #pcur.execute("DELETE FROM "+wcs+"."+table+"_diff_pkey")
-
-    if nb_of_updated_layer:
+        functions = {} # versioning_apply_diff is installed, by schema
+        nb_of_updated_layer = 0
+        next_rev = 0
         for [rev, branch, table_schema, table] in versioned_layers:
+            if next_rev:
+                assert( next_rev == rev + 1 )
+            else: next_rev = rev + 1
+
             pkey = pg_pk( pcur, table_schema, table )
-            pcur.execute("UPDATE "+wcs+".initial_revision "
-                "SET (rev, max_pk) "
-                "= ((SELECT MAX(rev) FROM "+table_schema+".revisions), "
-                    "(SELECT MAX("+pkey+") FROM "+table_schema+"."+table+")) "
-                "WHERE table_schema = '"+table_schema+"' "
-                "AND table_name = '"+table+"' "
-                "AND branch = '"+branch+"'")
+            history_columns = [pkey] + branch_columns(
+                    pg_branches( pcur, table_schema ) )
+            cols = ""
+            for [col, data_type] in pg_columns( pcur, table_schema, table ):
+                if col not in history_columns:
+                    cols = quote_ident(col)+", "+cols
+            cols = cols[:-2] # remove last coma and space
+            hcols = (pkey+", "+branch+"_rev_begin, "+branch+"_rev_end, "
+                    +branch+"_parent, "+branch+"_child")
+
+            if table_schema not in functions:
+                functions[table_schema] = pg_has_function( pcur, table_schema,
+                        'versioning_apply_diff' )
+            if functions[table_schema]:
+                # one round trip to merge the diff
+                trace.phase('pg_commit', 'apply')
+                pcur.execute("SELECT "+table_schema+".versioning_apply_diff("
+                    "'"+table+"', '"+wcs+"."+table+"_diff', "
+                    "'"+branch+"', "+str(rev)+", "
+                    "'"+escape_quote(commit_msg)+"', '"+get_username()+"')")
+                [there_is_something_to_commit] = pcur.fetchone()
+            else:
+                pcur.execute( "SELECT "+pkey+" FROM "+wcs+"."+table+"_diff "
+                    "LIMIT 1")
+                there_is_something_to_commit = pcur.fetchone()
+
+            if not there_is_something_to_commit:
+                print "nothing to commit for ", table
+                continue
+            nb_of_updated_layer += 1
+
+            if not functions[table_schema]:
+                pcur.execute("SELECT rev FROM "+table_schema+".revisions "
+                    "WHERE rev = "+str(rev+1))
+                if not pcur.fetchone():
+                    print "inserting rev ", str(rev+1)
+                    pcur.execute("INSERT INTO "+table_schema+".revisions "
+                        "(rev, commit_msg, branch, author) "
+                        "VALUES ("+str(rev+1)+", '"+escape_quote(commit_msg)+
+                        "', '"+branch+"', '"+get_username()+"')")
+
+                trace.phase('pg_commit', 'apply')
+                # insert inserted and modified
+                pcur.execute("INSERT INTO "+table_schema+"."+table+" "
+                    "("+cols+", "+hcols+") "
+                    "SELECT "+cols+", "+hcols+" FROM "+wcs+"."+table+"_diff "
+                    "WHERE "+branch+"_rev_begin = "+str(rev+1))
+
+                # update deleted and modified
+                pcur.execute("UPDATE "+table_schema+"."+table+" AS dest "
+                        "SET ("+branch+"_rev_end, "+branch+"_child)"
+                            "=(src."+branch+"_rev_end, src."+branch+"_child) "
+                        "FROM "+wcs+"."+table+"_diff AS src "
+                        "WHERE dest."+pkey+" = src."+pkey+" "
+                        "AND src."+branch+"_rev_end = "+str(rev))
+
+            if pg_is_partitioned( pcur, table_schema, table ):
+                pg_repartition( pcur, table_schema, table,
+                        pg_branches( pcur, table_schema ),
+                        ended = "SELECT "+pkey+" FROM "+wcs+"."+table+"_diff "
+                            "WHERE "+branch+"_rev_end = "+str(rev) )
+
+            # clears the diff
+            pcur.execute("DELETE FROM "+wcs+"."+table+"_diff")
+            #pcur.execute("DELETE FROM "+wcs+"."+table+"_diff_pkey")
+
+        if nb_of_updated_layer:
+            for [rev, branch, table_schema, table] in versioned_layers:
+                pkey = pg_pk( pcur, table_schema, table )
+                pcur.execute("UPDATE "+wcs+".initial_revision "
+                    "SET (rev, max_pk) "
+                    "= ((SELECT MAX(rev) FROM "+table_schema+".revisions), "
+                        "(SELECT MAX("+pkey+") FROM "+table_schema+"."+table+")) "
+                    "WHERE table_schema = '"+table_schema+"' "
+                    "AND table_name = '"+table+"' "
+                    "AND branch = '"+branch+"'")
 
-    pcur.commit()
-    pcur.close()
-    return nb_of_updated_layer
+        pcur.commit()
+        return nb_of_updated_layer
 
 def pg_unresolved_conflicts(pg_conn_info, working_copy_schema):
     """return a list of tables with unresolved conflicts"""
     found = []
-    pcur = Db(psycopg2.connect(pg_conn_info))
-    pcur.execute("SELECT table_name FROM information_schema.tables "
-        "WHERE table_schema='"+working_copy_schema+"' "
-        "AND table_name LIKE '%_cflt'")
-    for table_conflicts in pcur.fetchall():
-        print 'table_conflicts:', table_conflicts[0]
-        pcur.execute("SELECT * "
-            "FROM "+working_copy_schema+"."+table_conflicts[0])
-        if pcur.fetchone():
-            found.append( table_conflicts[0][:-5] )
-    pcur.commit()
-    pcur.close()
-    return found
+    with pg_connect(pg_conn_info) as pcur:
+        tables = pg_metadata( pcur, working_copy_schema )['tables']
+        for table_conflicts in sorted(tables):
+            if not table_conflicts.endswith('_cflt') \
+                    or tables[table_conflicts]['kind'] != 'r':
+                continue
+            print 'table_conflicts:', table_conflicts
+            pcur.execute("SELECT * "
+                "FROM "+working_copy_schema+"."+table_conflicts+" LIMIT 1")
+            if pcur.fetchone():
+                found.append( table_conflicts[:-5] )
+        pcur.commit()
+        return found
 
 def pg_late(pg_conn_info, working_copy_schema):
     """Return 0 if up to date, the number of commits in between otherwize"""
-    pcur = Db(psycopg2.connect(pg_conn_info))
-    pcur.execute("SELECT rev, branch, table_schema "
-        "FROM "+working_copy_schema+".initial_revision")
-    versioned_layers = pcur.fetchall()
-    if not versioned_layers:
-        raise RuntimeError("Cannot find versioned layer in "
-                +working_copy_schema)
+    with pg_connect(pg_conn_info) as pcur:
+        pcur.execute("SELECT rev, branch, table_schema "
+            "FROM "+working_copy_schema+".initial_revision")
+        versioned_layers = pcur.fetchall()
+        if not versioned_layers:
+            raise RuntimeError("Cannot find versioned layer in "
+                    +working_copy_schema)
 
-    late_by = 0
+        late_by = 0
 
-    for [rev, branch, table_schema] in versioned_layers:
-        pcur.execute("SELECT MAX(rev) FROM "+table_schema+".revisions "
-            "WHERE branch = '"+branch+"'")
-        [max_rev] = pcur.fetchone()
-        late_by = max(max_rev - rev, late_by)
+        for [rev, branch, table_schema] in versioned_layers:
+            pcur.execute("SELECT MAX(rev) FROM "+table_schema+".revisions "
+                "WHERE branch = '"+branch+"'")
+            [max_rev] = pcur.fetchone()
+            late_by = max(max_rev - rev, late_by)
 
-    return late_by
+        return late_by
 
 def pg_revision( pg_conn_info, working_copy_schema ):
     """returns the revision the working copy was created from plus one"""
-    pcur = Db(psycopg2.connect(pg_conn_info))
-    pcur.execute("SELECT rev "+ "FROM "+working_copy_schema+".initial_revision")
-    rev = 0
-    for [res] in pcur.fetchall():
-        if rev :
-            assert( res == rev )
-        else :
-            rev = res
-    pcur.close()
-    return rev + 1
+    with pg_connect(pg_conn_info) as pcur:
+        pcur.execute("SELECT rev "+ "FROM "+working_copy_schema+".initial_revision")
+        rev = 0
+        for [res] in pcur.fetchall():
+            if rev :
+                assert( res == rev )
+            else :
+                rev = res
+        return rev + 1